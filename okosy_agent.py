@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+OpenAIのFunction Callingを使った旅のしおり生成 (エージェントループ)。
+1ターンで要求された複数のTool Callはスレッドプールで並列に実行し、
+モデルがツールを呼ばなくなるか、ラウンド数/時間の上限に達するまで繰り返す。
+"""
+import contextvars
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import openai
+import streamlit as st
+
+from okosy_google import get_coordinates, search_google_places
+from okosy_media import prefetch_places_result
+from okosy_models import PHASE_PLAN, PHASE_WRITE, create_chat_completion
+from okosy_prompt import (PROMPT_TOKEN_BUDGET, build_day_messages, build_plan_messages, compact_tool_result,
+                          count_tokens, fit_messages_to_budget, parse_trip_plan)
+from okosy_trace import current_span, sampled_log, span
+
+# --- エージェントループの設定 ---
+# 呼び出すモデルはフェーズ毎に okosy_models.py で選ぶ (OKOSY_PLAN_MODELS / OKOSY_WRITE_MODELS)
+MAX_TOOL_ROUNDS = int(os.getenv("OKOSY_MAX_TOOL_ROUNDS", 3))           # ツール実行ラウンドの上限
+TOOL_TIME_BUDGET = float(os.getenv("OKOSY_TOOL_TIME_BUDGET", 45))      # ツール実行に使う時間の上限(秒)
+TOOL_MAX_WORKERS = int(os.getenv("OKOSY_TOOL_MAX_WORKERS", 8))
+
+# --- 長期旅行 (日毎の並列生成) の設定 ---
+LONG_TRIP_MIN_DAYS = int(os.getenv("OKOSY_LONG_TRIP_MIN_DAYS", 4))          # この日数以上は日毎に並列生成する
+LONG_TRIP_MAX_PARALLEL_DAYS = int(os.getenv("OKOSY_LONG_TRIP_PARALLEL", 10)) # 同時に生成する日数の上限 (全リクエスト共有)
+DAY_MAX_ATTEMPTS = int(os.getenv("OKOSY_DAY_MAX_ATTEMPTS", 2))              # 1日分の生成に失敗したときの再試行を含めた回数
+
+# 生成に失敗したときに本文の代わりに返すメッセージ (キャッシュ等で成功と区別するため定数化)
+API_ERROR_REPLY = "申し訳ありません、AIとの通信中にAPIエラーが発生しました。"
+RATE_LIMIT_REPLY = "申し訳ありません、AIへのリクエストが混み合っています。しばらくしてから再度お試しください。"
+UNEXPECTED_ERROR_REPLY = "申し訳ありません、AIとの通信中に予期せぬエラーが発生しました。"
+ERROR_REPLIES = (API_ERROR_REPLY, RATE_LIMIT_REPLY, UNEXPECTED_ERROR_REPLY)
+
+# ツール実行用のスレッドプール (全セッション共有・同時実行数に上限)
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="okosy-tool")
+# 長期旅行の各日の生成用 (ツール実行用とは分け、日の生成がツール実行の枠を埋めて止まらないようにする)
+_day_executor = ThreadPoolExecutor(max_workers=LONG_TRIP_MAX_PARALLEL_DAYS, thread_name_prefix="okosy-day")
+
+# ★★★ OpenAI v1.x 対応: functions -> tools 形式に変更 ★★★
+tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_google_places",
+            "description": "Google Places APIを使って観光名所やレストランなどを検索する。隠れ家的なお店や、静かなカフェ、旅館など具体的な場所情報が必要なときに呼び出す。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "検索したい場所のキーワード (例: '京都 抹茶 スイーツ')"},
+                    "location_bias": {"type": "string", "description": "検索の中心とする緯度経度 (例: '35.0116,135.7681')。行き先の座標を指定すると精度が上がる。"},
+                    "place_type": {
+                        "type": "string",
+                        "description": "検索する場所の種類",
+                        "enum": [
+                            "tourist_attraction", "restaurant", "lodging", "cafe",
+                            "museum", "park", "art_gallery", "store"
+                        ]
+                    },
+                    "min_rating": {"type": "number", "description": "検索結果に含める最低評価 (例: 4.0)"},
+                    "price_levels": {"type": "string", "description": "検索結果に含める価格帯（カンマ区切り、例: '1,2'）。1:安い, 2:普通, 3:やや高い, 4:高い"}
+                },
+                "required": ["query", "place_type"]
+            }
+        }
+    }
+]
+# --- ここまで tools 定義 ---
+
+# --- 呼び出し可能な関数名と実際の関数オブジェクトのマッピング ---
+# (各関数はモデルが指定する引数に加えて、実行期限の deadline を受け取る)
+available_functions = {
+    "search_google_places": search_google_places
+}
+# --- ここまで 関数マッピング ---
+
+_tools_tokens = None
+
+def _get_tools_tokens():
+    """ツール定義の分のトークン数 (プロンプトの上限から差し引く)"""
+    global _tools_tokens
+    if _tools_tokens is None:
+        _tools_tokens = count_tokens(json.dumps(tools, ensure_ascii=False))
+    return _tools_tokens
+
+
+def _show_error(message):
+    """画面にエラーを表示する (バックグラウンドのジョブから呼ばれた場合はログのみ)"""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    if get_script_run_ctx() is not None:
+        st.error(message)
+    else:
+        print(message)
+
+
+def _tool_call_to_dict(tool_call):
+    """SDKのTool Callオブジェクトを、メッセージ履歴にそのまま積める辞書に変換する"""
+    return {
+        "id": tool_call.id,
+        "type": "function",
+        "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+    }
+
+
+def describe_tool_call(tool_call):
+    """進捗表示用の短い説明 (例: "Places検索中: 京都 旅館")"""
+    function = tool_call["function"]
+    if function["name"] == "search_google_places":
+        try:
+            return f"Places検索中: {json.loads(function['arguments']).get('query', '')}"
+        except json.JSONDecodeError:
+            pass
+    return f"{function['name']} を実行中"
+
+
+def _execute_tool_call(tool_call, location_bias, deadline=None):
+    """1件のTool Call(辞書)を実行し、結果(JSON文字列)を返す"""
+    function_name = tool_call["function"]["name"]
+    function_to_call = available_functions.get(function_name)
+    if not function_to_call:
+        print(f"Error: Function '{function_name}' not found in available_functions.")
+        return json.dumps({"error": f"内部関数 '{function_name}' が見つかりません。"}, ensure_ascii=False)
+    try:
+        function_args = json.loads(tool_call["function"]["arguments"])
+    except json.JSONDecodeError as e:
+        return json.dumps({"error": f"引数の解析エラー: {e}"}, ensure_ascii=False)
+
+    # location_biasの補完ロジック
+    if 'location_bias' not in function_args and location_bias:
+        function_args['location_bias'] = location_bias
+    # ツール実行の残り時間を超えてHTTPのリトライを続けないよう、期限を渡す (モデルからは指定させない)
+    function_args['deadline'] = deadline
+    try:
+        with span(f"tool.{function_name}", arguments=tool_call["function"]["arguments"][:200]):
+            result = function_to_call(**function_args)
+    except Exception as e:
+        print(f"Tool実行エラー ({function_name}): {e}")
+        return json.dumps({"error": f"ツール実行エラー: {e}"}, ensure_ascii=False)
+    if function_name == "search_google_places":
+        # 場所カード・地図用の詳細と写真を裏で取得しておく (完了は待たない)
+        prefetch_places_result(result)
+    return result
+
+
+def execute_tool_calls(tool_calls, location_bias=None, timeout=None):
+    """
+    Tool Callをスレッドプールで並列実行し、tool_calls と同じ順序で結果(JSON文字列)のリストを返す。
+    timeout 秒以内に終わらなかったものはタイムアウトのエラー結果になる
+    (各ツールにも同じ期限を渡し、上流の呼び出しが裏で続かないようにする)。
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    # 実行中のトレースをワーカースレッドに引き継ぐため、呼び出し元のcontextで実行する
+    futures = [
+        _tool_executor.submit(contextvars.copy_context().run, _execute_tool_call, tool_call, location_bias, deadline)
+        for tool_call in tool_calls
+    ]
+    wait(futures, timeout=timeout)
+    results = []
+    for future in futures:
+        if future.done():
+            results.append(future.result())
+        else:
+            future.cancel()
+            results.append(json.dumps({"error": "ツールの実行がタイムアウトしました。"}, ensure_ascii=False))
+    return results
+
+
+def merge_places_results(function_responses):
+    """
+    複数回の search_google_places の結果(JSON文字列)を1つのリストにまとめる (place_idで重複除去)。
+    場所が1件も無ければ最後のエラー結果を、ツールが呼ばれていなければ None を返す。
+    """
+    merged, seen_ids, last_error = [], set(), None
+    for function_response in function_responses:
+        try:
+            data = json.loads(function_response)
+        except (TypeError, json.JSONDecodeError):
+            continue
+        if isinstance(data, list):
+            for place in data:
+                place_id = place.get("place_id")
+                if place_id in seen_ids: continue
+                seen_ids.add(place_id)
+                merged.append(place)
+        else:
+            last_error = function_response
+    if merged:
+        return json.dumps(merged, ensure_ascii=False)
+    return last_error
+
+
+def _create_chat_completion(client, messages, request_kwargs, on_token=None, phase=PHASE_WRITE):
+    """
+    チャット補完を1回実行し、(本文, Tool Callの辞書リスト) を返す。
+    on_token が指定された場合はストリーミングで受信し、本文の断片を届いた順に渡す。
+    phase: 呼び出すモデルの候補 (PHASE_PLAN: ツールの選択・計画 / PHASE_WRITE: 本文の作成)
+    """
+    with span("openai.chat", phase=phase, stream=on_token is not None,
+              tools="tools" in request_kwargs, messages=len(messages)) as current:
+        if on_token is None:
+            response, decision = create_chat_completion(client, phase, messages, **request_kwargs)
+            current.set(**decision)
+            _record_usage(current, response.usage)
+            response_message = response.choices[0].message
+            tool_calls = [_tool_call_to_dict(tc) for tc in (response_message.tool_calls or [])]
+            current.set(tool_calls=len(tool_calls))
+            return response_message.content, tool_calls
+
+        content, tool_calls = _stream_chat_completion(client, messages, request_kwargs, on_token, current, phase)
+        current.set(tool_calls=len(tool_calls))
+        return content, tool_calls
+
+
+def _record_usage(current, usage):
+    """response.usage のトークン数をスパンに記録する"""
+    if usage is not None:
+        current.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                    total_tokens=usage.total_tokens)
+
+
+def _stream_chat_completion(client, messages, request_kwargs, on_token, current, phase):
+    started = time.perf_counter()
+    stream, decision = create_chat_completion(
+        client, phase, messages, stream=True,
+        stream_options={"include_usage": True}, # 最後のチャンクでトークン数を受け取る
+        **request_kwargs
+    )
+    current.set(**decision)
+    content_parts = []
+    tool_calls = {}  # index -> Tool Call辞書 (断片を連結して組み立てる)
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            _record_usage(current, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            if not content_parts:
+                current.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+            content_parts.append(delta.content)
+            on_token(delta.content)
+        for tool_call_delta in delta.tool_calls or []:
+            entry = tool_calls.setdefault(tool_call_delta.index, {
+                "id": None, "type": "function", "function": {"name": "", "arguments": ""}
+            })
+            if tool_call_delta.id:
+                entry["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                entry["function"]["name"] += tool_call_delta.function.name or ""
+                entry["function"]["arguments"] += tool_call_delta.function.arguments or ""
+    content = "".join(content_parts) if content_parts else None
+    return content, [tool_calls[index] for index in sorted(tool_calls)]
+
+
+def run_conversation_with_function_calling(client, messages, dest=None, on_progress=None, on_token=None):
+    """
+    OpenAIに対しチャットを送信し、Tool Callがあれば全て並列に実行して結果を再度OpenAIに渡す。
+    これをモデルがツールを呼ばなくなるか、ラウンド数/時間の上限に達するまで繰り返す。
+    最終的に得られたアシスタントからのテキスト返信と、関数が呼ばれた場合はその結果(JSON文字列)を返す。
+
+    on_progress: ツール実行の進捗メッセージを受け取るコールバック (呼び出し元スレッドで呼ばれる)
+    on_token: 指定するとストリーミングモードになり、応答本文の断片を受け取る
+    """
+    function_responses = []
+    location_bias = None
+    started = time.monotonic()
+    tokens_saved = 0       # ツール結果のコンパクト化で減らしたトークン数
+    tokens_truncated = 0   # 上限に合わせて切り詰めたトークン数
+    try:
+        for round_index in range(MAX_TOOL_ROUNDS + 1):
+            remaining = TOOL_TIME_BUDGET - (time.monotonic() - started)
+            allow_tools = round_index < MAX_TOOL_ROUNDS and remaining > 0
+            request_kwargs = {"tools": tools, "tool_choice": "auto"} if allow_tools else {}
+            if round_index > 0:
+                # 履歴全体は大きいので、一部のリクエストだけ長さを制限して出力する
+                sampled_log(f"Messages sent (round {round_index + 1})", messages)
+            request_messages, truncated = fit_messages_to_budget(
+                messages, PROMPT_TOKEN_BUDGET, reserved_tokens=_get_tools_tokens() if allow_tools else 0)
+            tokens_truncated += truncated
+            # 最初のラウンド(どのツールを呼ぶかの判断)は速いモデル、ツールの結果を受けた本文の作成は品質の高いモデル。
+            # 判断のラウンドの本文は最終版にしないので、ストリーミングしない
+            phase = PHASE_PLAN if allow_tools and round_index == 0 else PHASE_WRITE
+            content, tool_calls = _create_chat_completion(
+                client, request_messages, request_kwargs, on_token if phase == PHASE_WRITE else None, phase)
+            if not tool_calls and phase == PHASE_PLAN:
+                # ツールが不要と判断された: 速いモデルの本文は捨て、品質の高いモデルにツールなしで書かせる
+                request_messages, truncated = fit_messages_to_budget(messages, PROMPT_TOKEN_BUDGET)
+                tokens_truncated += truncated
+                content, _ = _create_chat_completion(client, request_messages, {}, on_token, PHASE_WRITE)
+                return content, merge_places_results(function_responses)
+            if not tool_calls or not allow_tools:
+                # --- Tool Call なし (または上限到達) の最終応答 ---
+                return content, merge_places_results(function_responses)
+
+            # location_bias の補完用に行き先の座標を1回だけ求める (キャッシュ済みなら即時)
+            if location_bias is None and dest:
+                location_bias = get_coordinates(dest, deadline=started + TOOL_TIME_BUDGET)
+                if location_bias:
+                    print(f"座標が見つかりました。location_bias を補完: {location_bias}")
+                else:
+                    print(f"座標が見つかりませんでした。location_bias はなしで検索します。")
+                    location_bias = ""
+
+            if on_progress:
+                for tool_call in tool_calls:
+                    on_progress(describe_tool_call(tool_call))
+
+            # ★ 全てのTool Callを並列実行し、結果をtool_call_id付きで履歴に追加
+            results = execute_tool_calls(tool_calls, location_bias, timeout=max(remaining, 1))
+            # AIの応答（Tool Call指示）を履歴に追加
+            messages.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
+            for tool_call, function_response in zip(tool_calls, results):
+                # モデルには短い表現を渡し、保存・表示用には元のJSONを残す
+                compact_response, saved = compact_tool_result(function_response)
+                tokens_saved += saved
+                messages.append(
+                    {
+                        "tool_call_id": tool_call["id"],
+                        "role": "tool",
+                        "name": tool_call["function"]["name"],
+                        "content": compact_response,
+                    }
+                )
+                if tool_call["function"]["name"] == "search_google_places":
+                    function_responses.append(function_response)
+
+        # ループは必ず最終ラウンドで return する
+        return None, merge_places_results(function_responses)
+
+    except openai.RateLimitError as e:
+        # レート制限 (呼び出し元のジョブキューはこれを見て投入を抑える)
+        print(f"OpenAI Rate Limit: {e.message}")
+        return RATE_LIMIT_REPLY, None
+    except openai.APIError as e:
+        # OpenAI API自体から返されたエラー (例: 認証エラー)
+        _show_error(f"OpenAI APIエラーが発生しました: {e}")
+        print(f"OpenAI API Error: {getattr(e, 'status_code', None)} - {e.message}") # 詳細ログ
+        return API_ERROR_REPLY, None
+    except Exception as e:
+        # その他の予期せぬエラー
+        _show_error(f"OpenAIとの通信中に予期せぬエラーが発生しました: {e}")
+        _show_error(traceback.format_exc()) # 詳細なトレースバックを表示
+        return UNEXPECTED_ERROR_REPLY, None
+    finally:
+        current_span().set(tool_result_tokens_saved=tokens_saved, prompt_tokens_truncated=tokens_truncated)
+        if tokens_saved or tokens_truncated:
+            print(f"プロンプトのトークン削減: ツール結果 -{tokens_saved} / 上限による切り詰め -{tokens_truncated}")
+
+
+# --- 長期旅行: 計画 → 日毎の並列生成 → 結合 ---
+
+def _plan_trip(client, dest, purp, comp, days, budg, preferences):
+    """各日のエリアとテーマを1回のリクエストで決める (失敗した場合は行き先全体の計画にする)"""
+    try:
+        with span("agent.plan", days=days):
+            content, _ = _create_chat_completion(
+                client, build_plan_messages(dest, purp, comp, days, budg, preferences),
+                {"response_format": {"type": "json_object"}}, phase=PHASE_PLAN)
+    except openai.APIError as e:
+        print(f"旅程の計画に失敗しました (行き先全体で各日を生成します): {e}")
+        content = None
+    return parse_trip_plan(content, days, dest)
+
+
+def _generate_day(client, request, plan, day, on_progress=None):
+    """1日分を生成する。失敗した場合はその日だけ再試行し、(本文, places結果JSON) を返す"""
+    day_plan = plan["days"][day - 1]
+    content = None
+    for attempt in range(1, DAY_MAX_ATTEMPTS + 1):
+        messages = build_day_messages(
+            request["dest"], request["purp"], request["comp"], request["days"], request["budg"],
+            request["preferences"], plan, day)
+        with span("agent.day", day=day, attempt=attempt, area=day_plan["area"]):
+            # 場所の検索はその日のエリアを中心にする
+            content, places = run_conversation_with_function_calling(
+                client, messages, dest=f"{request['dest']} {day_plan['area']}",
+                on_progress=(lambda message: on_progress(f"{day}日目: {message}")) if on_progress else None)
+        if content and content not in ERROR_REPLIES:
+            return content, places
+        print(f"{day}日目の生成に失敗しました ({attempt}/{DAY_MAX_ATTEMPTS}): {content}")
+        if content == RATE_LIMIT_REPLY and attempt < DAY_MAX_ATTEMPTS:
+            time.sleep(2 * attempt)
+    return content, None
+
+
+def run_long_trip_generation(client, request, on_progress=None, on_token=None):
+    """
+    長期旅行のしおりを、計画 → 各日の並列生成 → 結合 の順に作成し、
+    (本文, places結果JSON, 作成できなかった日のリスト) を返す。
+    一部の日だけ失敗した場合、本文のその日は作成できなかった旨の文になる (呼び出し元でキャッシュしないこと)。
+    request: {"dest", "purp", "comp", "days", "budg", "preferences"}
+
+    on_progress: 進捗メッセージを受け取るコールバック (各日のスレッドから呼ばれる)
+    on_token: 指定すると、1日目から順に完成した日の本文を渡す (途中表示用)
+    """
+    days = int(request["days"])
+    if on_progress:
+        on_progress(f"{days}日間の旅程を計画しています...")
+    plan = _plan_trip(client, request["dest"], request["purp"], request["comp"], days,
+                      request["budg"], request["preferences"])
+    if on_progress:
+        on_progress(" / ".join(f"{p['day']}日目:{p['area']}" for p in plan["days"]))
+
+    header = f"# {request['dest']} {days}日間の旅のしおり\n\n" + (f"{plan['overview']}\n\n" if plan["overview"] else "")
+    if on_token:
+        on_token(header)
+    futures = [
+        _day_executor.submit(contextvars.copy_context().run, _generate_day, client, request, plan, day, on_progress)
+        for day in range(1, days + 1)
+    ]
+    sections, places_results, failed_days = [], [], []
+    for day, future in enumerate(futures, start=1):
+        # 完成した日から順に途中表示に流す (後の日が先に終わっても、前の日を待ってから出す)
+        content, places = future.result()
+        if content in (None, RATE_LIMIT_REPLY) or content in ERROR_REPLIES:
+            failed_days.append(day)
+            section = f"## {day}日目\n\n(この日の提案を作成できませんでした。もう一度お試しください。)"
+        else:
+            section = content.strip()
+        if places:
+            places_results.append(places)
+        sections.append(section)
+        if on_token:
+            on_token(section + "\n\n")
+        if on_progress:
+            on_progress(f"{day}/{days}日目まで完成しました")
+
+    current_span().set(long_trip_days=days, failed_days=len(failed_days))
+    if len(failed_days) == days:
+        # 全日失敗したときはジョブ側でレート制限の再試行などを判断できるよう、最後のエラー応答を返す
+        return content, None, failed_days
+    return header + "\n\n".join(sections), merge_places_results(places_results), failed_days
+
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+しおり・思い出のエクスポート / インポート (バックアップ・環境間の移行用)。
+DBの大きさに関わらずメモリ使用量が一定になるよう、行をまとまり(チャンク)毎に読み書きし、
+tarにストリームで書き出す・読み込む。
+
+アーカイブ (tar。ファイル名が .tar.gz / .tgz なら gzip 圧縮) の中身 (この順に並ぶ):
+    manifest.json                 アーカイブのid・形式のバージョン・作成日時
+    itineraries/000001.jsonl ...  しおり (好み・本文・場所を含む) を1行1件で、ARCHIVE_BATCH_SIZE 件毎に
+    media/<写真ストアの相対パス>   思い出の写真ファイル (参照する memories のチャンクより前に置く)
+    memories/000001.jsonl ...     思い出
+    summary.json                  件数
+
+使い方:
+    python okosy_archive.py export backup.tar.gz [--no-photos]
+    python okosy_archive.py import backup.tar.gz
+
+取り込みはチャンク毎に1トランザクションで行い、取り込んだ行は archive_imports に記録する。
+途中で止まっても同じコマンドをもう一度実行すれば、取り込み済みの行を飛ばして続きから取り込む。
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import uuid
+
+from okosy_db import db_connection, load_itinerary_places, save_itinerary_places, sync_itinerary_bigrams
+
+# --- アーカイブの設定 ---
+ARCHIVE_FORMAT_VERSION = 1
+ARCHIVE_BATCH_SIZE = int(os.getenv("OKOSY_ARCHIVE_BATCH_SIZE", 500))  # 1チャンク(=取り込み時の1トランザクション)の件数
+ARCHIVE_DIR = os.getenv("OKOSY_ARCHIVE_DIR", "okosy_archives")      # 画面から作成したアーカイブの置き場所
+# 画面からのダウンロードは、この大きさ毎に区切った部分ファイルで渡す (1回のダウンロードでメモリに載るのはこの大きさまで)
+ARCHIVE_DOWNLOAD_PART_BYTES = int(float(os.getenv("OKOSY_ARCHIVE_DOWNLOAD_PART_MB", 64)) * 1024 * 1024)
+
+_MEDIA_PREFIX = "media/"
+_MEDIA_KINDS = ("photos", "display", "thumbs")  # 写真ストアのディレクトリ (okosy_photos.py)
+_BLOB_KIND = "blobs"                                        # 写真ストアへ未移行のBLOB行の写真
+_PHOTO_COLUMNS = ("photo_path", "display_path", "thumb_path")
+
+
+class ArchiveError(Exception):
+    """アーカイブの形式が正しくないことを表す"""
+
+
+def _photo_store():
+    # okosy_photos は PIL を読み込むので、写真を扱うときだけインポートする
+    import okosy_photos
+    return okosy_photos
+
+
+def _tar_write_mode(path):
+    return "w|gz" if path.endswith((".tar.gz", ".tgz")) else "w|"
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_jsonl(tar, name, records):
+    _add_bytes(tar, name, "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+
+
+def _iter_batches(sql, batch_size):
+    """id のキーセットページングで行を batch_size 件ずつ返す (sql は id > ? と LIMIT ? を受け取る)"""
+    last_id = 0
+    while True:
+        # 書き出し中にコネクションを借りたままにしないよう、チャンク毎に借りて返す
+        with db_connection() as conn:
+            rows = conn.execute(sql, (last_id, batch_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+# --- エクスポート ---
+
+def export_archive(path, include_photos=True, batch_size=ARCHIVE_BATCH_SIZE, on_progress=None):
+    """
+    全てのしおりと思い出を path にアーカイブとして書き出し、件数の辞書を返す。
+    書き出し中は path.part に書き、完了してから path に置き換える (失敗したら path.part は削除する)。
+    on_progress: 進捗メッセージを受け取るコールバック
+    """
+    counts = {"itineraries": 0, "memories": 0, "media_files": 0, "media_bytes": 0}
+    manifest = {
+        "archive_id": uuid.uuid4().hex,
+        "format_version": ARCHIVE_FORMAT_VERSION,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "include_photos": include_photos,
+    }
+    report = on_progress or print
+    part_path = f"{path}.part"
+    try:
+        with tarfile.open(part_path, _tar_write_mode(path)) as tar:
+            _add_bytes(tar, "manifest.json", json.dumps(manifest, ensure_ascii=False).encode("utf-8"))
+
+            for index, rows in enumerate(_iter_batches(
+                    "SELECT id, name, creation_date, preferences, generated_content, places_data "
+                    "FROM itineraries WHERE id > ? ORDER BY id LIMIT ?", batch_size), start=1):
+                with db_connection() as conn:
+                    records = [{
+                        "id": itinerary_id, "name": name, "creation_date": creation_date, "preferences": preferences,
+                        "generated_content": content, "places_data": places_data,
+                        "places": load_itinerary_places(conn, itinerary_id),
+                    } for itinerary_id, name, creation_date, preferences, content, places_data in rows]
+                _add_jsonl(tar, f"itineraries/{index:06d}.jsonl", records)
+                counts["itineraries"] += len(records)
+                report(f"しおり {counts['itineraries']} 件を書き出しました")
+
+            # 同じ写真を参照する思い出が複数あっても、ファイルは1回だけ書き出す
+            # (保持するのは書き出したパスの集合だけで、写真の中身は1枚ずつ読む)
+            exported_media = set()
+            for index, rows in enumerate(_iter_batches(
+                    "SELECT id, itinerary_id, caption, creation_date, photo_path, display_path, thumb_path, "
+                    "photo_width, photo_height, original_bytes, stored_bytes, photo IS NOT NULL AND photo_path IS NULL "
+                    "FROM memories WHERE id > ? ORDER BY id LIMIT ?", batch_size), start=1):
+                records = []
+                for row in rows:
+                    record = dict(zip(("id", "itinerary_id", "caption", "creation_date", *_PHOTO_COLUMNS, "photo_width",
+                                       "photo_height", "original_bytes", "stored_bytes"), row[:11]))
+                    has_blob = bool(row[11])
+                    if include_photos:
+                        for column in _PHOTO_COLUMNS:
+                            relative_path = record[column]
+                            if not relative_path or relative_path in exported_media:
+                                continue
+                            file_path = _photo_store().photo_abspath(relative_path)
+                            if not os.path.exists(file_path):
+                                print(f"写真ファイルが見つからないため書き出しません: {relative_path}")
+                                record[column] = None
+                                continue
+                            tar.add(file_path, arcname=_MEDIA_PREFIX + relative_path)
+                            exported_media.add(relative_path)
+                            counts["media_files"] += 1
+                            counts["media_bytes"] += os.path.getsize(file_path)
+                        if has_blob:
+                            with db_connection() as conn:
+                                blob = conn.execute("SELECT photo FROM memories WHERE id = ?", (record["id"],)).fetchone()[0]
+                            record["blob"] = f"{_BLOB_KIND}/{record['id']}.bin"
+                            _add_bytes(tar, _MEDIA_PREFIX + record["blob"], blob)
+                            counts["media_files"] += 1
+                            counts["media_bytes"] += len(blob)
+                    else:
+                        for column in _PHOTO_COLUMNS:
+                            record[column] = None
+                    records.append(record)
+                _add_jsonl(tar, f"memories/{index:06d}.jsonl", records)
+                counts["memories"] += len(records)
+                report(f"思い出 {counts['memories']} 件を書き出しました (写真 {counts['media_files']} ファイル)")
+
+            _add_bytes(tar, "summary.json", json.dumps(counts, ensure_ascii=False).encode("utf-8"))
+    except BaseException:
+        # 失敗・中断(KeyboardInterrupt を含む)したら書きかけのファイルを残さない
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(part_path, path)
+    return counts
+
+
+# --- 画面からのダウンロード ---
+
+def archive_download_parts(path, part_bytes=ARCHIVE_DOWNLOAD_PART_BYTES):
+    """アーカイブを part_bytes 毎に区切った (開始位置, 長さ) のリストを返す"""
+    size = os.path.getsize(path)
+    return [(offset, min(part_bytes, size - offset)) for offset in range(0, size, part_bytes)] or [(0, 0)]
+
+
+def read_archive_part(path, offset, length):
+    """アーカイブの一部分を読み込む (ダウンロードの押下時に呼ばれる)"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+# --- インポート ---
+
+def _safe_media_path(relative_path):
+    """アーカイブ内の写真のパスを検証する (写真ストアの外を指すものは ArchiveError)"""
+    normalized = os.path.normpath(relative_path)
+    parts = normalized.split(os.sep)
+    if os.path.isabs(normalized) or ".." in parts or parts[0] not in (*_MEDIA_KINDS, _BLOB_KIND):
+        raise ArchiveError(f"不正な写真のパスです: {relative_path}")
+    return normalized
+
+
+def _staging_dir(archive_id):
+    # 未移行のBLOB写真は、参照する思い出を取り込むまで一時的に置いておく
+    return os.path.join(_photo_store().PHOTO_STORE_DIR, "import_staging", archive_id)
+
+
+def _import_media(tar, member, archive_id):
+    """写真ファイルを写真ストアへ書き込む。既にあるファイル(内容のハッシュが同じ)は書き込まない"""
+    relative_path = _safe_media_path(member.name[len(_MEDIA_PREFIX):])
+    if relative_path.startswith(_BLOB_KIND + os.sep):
+        target = os.path.join(_staging_dir(archive_id), os.path.basename(relative_path))
+    else:
+        target = _photo_store().photo_abspath(relative_path)
+    if os.path.exists(target):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # 一時ファイル名はスレッド毎に分ける (同じプロセスで同じアーカイブを同時に取り込んでも衝突しない)
+    tmp_path = f"{target}.tmp{os.getpid()}.{threading.get_ident()}"
+    with tar.extractfile(member) as source, open(tmp_path, "wb") as destination:
+        shutil.copyfileobj(source, destination)
+    os.replace(tmp_path, target)
+    return True
+
+
+def _read_jsonl(tar, member):
+    with tar.extractfile(member) as f:
+        # ストリームとして読んでいるので TextIOWrapper は使えない (json.loads はUTF-8のバイト列を受け付ける)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _imported_ids(conn, archive_id, kind, source_ids):
+    """取り込み済みの行の アーカイブ内のid → このDBでのid を返す"""
+    if not source_ids:
+        return {}
+    placeholders = ",".join("?" * len(source_ids))
+    return dict(conn.execute(
+        f"SELECT source_id, target_id FROM archive_imports WHERE archive_id = ? AND kind = ? AND source_id IN ({placeholders})",
+        (archive_id, kind, *source_ids)
+    ).fetchall())
+
+
+def _import_itineraries(archive_id, records):
+    """1チャンクのしおりを1トランザクションで取り込み、取り込んだ件数を返す"""
+    with db_connection() as conn:
+        done = _imported_ids(conn, archive_id, "itinerary", [record["id"] for record in records])
+        cursor = conn.cursor()
+        imported = 0
+        for record in records:
+            if record["id"] in done:
+                continue
+            cursor.execute(
+                "INSERT INTO itineraries (name, creation_date, preferences, generated_content, places_data) VALUES (?, ?, ?, ?, ?)",
+                (record["name"], record["creation_date"], record["preferences"], record["generated_content"],
+                 record["places_data"])
+            )
+            itinerary_id = cursor.lastrowid
+            save_itinerary_places(cursor, itinerary_id, record.get("places") or record["places_data"])
+            cursor.execute(
+                "INSERT INTO archive_imports (archive_id, kind, source_id, target_id) VALUES (?, 'itinerary', ?, ?)",
+                (archive_id, record["id"], itinerary_id)
+            )
+            imported += 1
+        # 2文字の語の検索用インデックスも同じトランザクションで登録する
+        sync_itinerary_bigrams(cursor)
+    return imported
+
+
+def _import_memories(archive_id, records):
+    """1チャンクの思い出を1トランザクションで取り込み、取り込んだ件数を返す"""
+    staged_blobs = []
+    with db_connection() as conn:
+        done = _imported_ids(conn, archive_id, "memory", [record["id"] for record in records])
+        itinerary_ids = _imported_ids(conn, archive_id, "itinerary",
+                                      list({record["itinerary_id"] for record in records}))
+        cursor = conn.cursor()
+        imported = 0
+        for record in records:
+            if record["id"] in done:
+                continue
+            itinerary_id = itinerary_ids.get(record["itinerary_id"])
+            if itinerary_id is None:
+                print(f"しおりが取り込まれていないため思い出を飛ばします (アーカイブ内のid={record['id']})")
+                continue
+            refs = {column: record.get(column) for column in (*_PHOTO_COLUMNS, "photo_width", "photo_height",
+                                                              "original_bytes", "stored_bytes")}
+            for column in _PHOTO_COLUMNS:
+                if refs[column]:
+                    refs[column] = _safe_media_path(refs[column])
+            if record.get("blob"):
+                blob_path = os.path.join(_staging_dir(archive_id), os.path.basename(_safe_media_path(record["blob"])))
+                with open(blob_path, "rb") as f:
+                    refs.update(_photo_store().store_photo(f.read()))
+                staged_blobs.append(blob_path)
+            cursor.execute(
+                '''INSERT INTO memories (itinerary_id, caption, creation_date, photo_path, display_path, thumb_path,
+                                         photo_width, photo_height, original_bytes, stored_bytes)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (itinerary_id, record["caption"], record["creation_date"], refs["photo_path"], refs["display_path"],
+                 refs["thumb_path"], refs["photo_width"], refs["photo_height"], refs["original_bytes"],
+                 refs["stored_bytes"])
+            )
+            cursor.execute(
+                "INSERT INTO archive_imports (archive_id, kind, source_id, target_id) VALUES (?, 'memory', ?, ?)",
+                (archive_id, record["id"], cursor.lastrowid)
+            )
+            imported += 1
+    # コミットできてから一時ファイルを消す (失敗して再実行したときにまた使う)
+    for blob_path in staged_blobs:
+        os.remove(blob_path)
+    return imported
+
+
+def import_archive(path, on_progress=None):
+    """
+    アーカイブを取り込み、件数の辞書を返す。取り込み済みの行は飛ばすので、途中で止まっても再実行できる。
+    形式が正しくない場合は ArchiveError を送出する。
+    """
+    counts = {"itineraries": 0, "memories": 0, "skipped": 0, "media_files": 0}
+    report = on_progress or print
+    archive_id = None
+    # "r|*" はアーカイブを先頭から順に1回だけ読む (全体をメモリやディスクに展開しない)
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name == "manifest.json":
+                with tar.extractfile(member) as f:
+                    manifest = json.load(f)
+                if manifest.get("format_version") != ARCHIVE_FORMAT_VERSION:
+                    raise ArchiveError(f"対応していない形式のバージョンです: {manifest.get('format_version')}")
+                archive_id = manifest["archive_id"]
+                continue
+            if archive_id is None:
+                raise ArchiveError("アーカイブの先頭に manifest.json がありません")
+            if member.name.startswith(_MEDIA_PREFIX):
+                if _import_media(tar, member, archive_id):
+                    counts["media_files"] += 1
+            elif member.name.startswith("itineraries/"):
+                records = _read_jsonl(tar, member)
+                imported = _import_itineraries(archive_id, records)
+                counts["itineraries"] += imported
+                counts["skipped"] += len(records) - imported
+                report(f"しおり {counts['itineraries']} 件を取り込みました (取り込み済みのため飛ばした行: {counts['skipped']} 件)")
+            elif member.name.startswith("memories/"):
+                records = _read_jsonl(tar, member)
+                imported = _import_memories(archive_id, records)
+                counts["memories"] += imported
+                counts["skipped"] += len(records) - imported
+                report(f"思い出 {counts['memories']} 件を取り込みました (取り込み済みのため飛ばした行: {counts['skipped']} 件)")
+    if archive_id is None:
+        raise ArchiveError("manifest.json が見つかりません")
+    # 最後まで取り込めたら、再実行で置き直された分も含めて一時ファイルを消す
+    shutil.rmtree(_staging_dir(archive_id), ignore_errors=True)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="しおり・思い出のエクスポート / インポート")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export", help="アーカイブを書き出す")
+    export_parser.add_argument("path", help="書き出すファイル (.tar / .tar.gz)")
+    export_parser.add_argument("--no-photos", action="store_true", help="写真ファイルを含めない")
+    export_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    import_parser = subcommands.add_parser("import", help="アーカイブを取り込む (途中で止まったら同じコマンドで再開)")
+    import_parser.add_argument("path")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    try:
+        if args.command == "export":
+            result = export_archive(args.path, include_photos=not args.no_photos, batch_size=args.batch_size)
+        else:
+            result = import_archive(args.path)
+    except ArchiveError as e:
+        sys.exit(f"エラー: {e}")
+    print(f"完了 ({time.perf_counter() - started:.1f}秒): {json.dumps(result, ensure_ascii=False)}")
@@ -0,0 +1,699 @@
+# -*- coding: utf-8 -*-
+"""
+オフラインのベンチマーク。
+有料のAPIを呼ばずに、しおり生成(エージェントループ)・Places検索・保存・過去のしおり閲覧の
+レイテンシとスループットを計測する。
+
+- OpenAI / Google Maps のレスポンスは bench_fixtures/ のファイルから返す
+  (ローカルのスタブHTTPサーバーを立て、遅延を注入して本番に近い待ち時間を再現する)
+- DB系のシナリオは件数を指定した合成DB (bench_data/ に作成して再利用) に対して実行する
+- 結果 (p50/p95/p99・RPS・ピークメモリ) はJSONで出力する
+
+使い方:
+    python okosy_bench.py                                   # 全シナリオ・1,000件のDB
+    python okosy_bench.py --itineraries 1000,100000 --photos 5000 --output bench_result.json
+    python okosy_bench.py --scenarios generation --stream --openai-latency-ms 1500 --concurrency 4
+    python okosy_bench.py --scenarios long_trip --long-trip-days 1,10 # 日毎の並列生成 (日数による所要時間の違い)
+    python okosy_bench.py --scenarios generation --slow-model gpt-4o:20000 # モデルの遅延時のフォールバック・ヘッジ
+    python okosy_bench.py --baseline bench_result.json      # p95が基準より悪化していたら終了コード1
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# --- ベンチマークの設定 ---
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, "bench_fixtures")
+SCENARIOS = ("generation", "long_trip", "places", "save", "viewer", "rerun", "search")
+DB_SCENARIOS = ("save", "viewer", "rerun", "search")  # 合成DBの件数毎に実行するシナリオ
+PLACE_POOL_SIZE = 2000          # 合成DBの場所の種類数
+PLACES_PER_ITINERARY = 5
+DISTINCT_PHOTOS = 50            # 合成DBで実際に作る写真ファイルの数 (思い出はこれを共有して参照する)
+PHOTOS_PER_ITINERARY = 5
+
+# しおり生成シナリオの入力 (行き先, 目的, 同行者, 日数, 予算, 好み)
+BENCH_ITINERARY_INPUT = ("京都", "静かに過ごしたい", "一人旅", 3, "普通", {
+    "pace": "のんびり", "nature": 4, "culture": 5, "art": 3, "food_local": "隠れ家的なお店",
+    "food_style": ["和食", "カフェ"], "accom_type": "旅館", "accom_view": True,
+    "vibe_quiet": "静かで落ち着いた", "vibe_discover": True, "experience": ["寺社仏閣"],
+})
+PLACES_QUERIES = [
+    ("京都 静かな 寺院 庭園", "tourist_attraction"),
+    ("京都 町家 カフェ 抹茶", "cafe"),
+    ("京都 京料理 おばんざい", "restaurant"),
+    ("京都 小さな 美術館", "museum"),
+    ("京都 旅館 一人旅", "lodging"),
+]
+SEARCH_TERMS = ["京都", "カフェ", "庭園", "抹茶", "寺", "おばんざい", "温泉", "美術館"]
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# --- 1. スタブHTTPサーバー (OpenAI / Google Maps の代わり) ---
+
+class StubServer(ThreadingHTTPServer):
+    """フィクスチャを返すローカルのHTTPサーバー。遅延の注入とリクエスト数の集計を行う"""
+
+    daemon_threads = True
+
+    def __init__(self, openai_latency_ms, google_latency_ms, jitter_ms, token_interval_ms, model_latency_ms=None):
+        super().__init__(("127.0.0.1", 0), _StubHandler)
+        self.openai_latency_ms = openai_latency_ms
+        self.model_latency_ms = model_latency_ms or {}  # モデル毎に追加する遅延 (プロバイダ側の遅延の再現)
+        self.google_latency_ms = google_latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_interval_ms = token_interval_ms
+        self.fixtures = {
+            "openai_tool_calls": load_fixture("openai_tool_calls.json"),
+            "openai_final": load_fixture("openai_final.json"),
+            "openai_plan": load_fixture("openai_plan.json"),
+            "openai_day": load_fixture("openai_day.json"),
+            "geocode": load_fixture("google_geocode.json"),
+            "places": load_fixture("google_places_textsearch.json"),
+        }
+        # Place Details は Text Search のフィクスチャの場所に営業時間などを加えて返す
+        self.place_details = {
+            place["place_id"]: dict(place, website="https://example.com/", url=f"https://maps.google.com/?cid={index}",
+                                    opening_hours={"weekday_text": ["月曜日: 9時00分～17時00分", "火曜日: 定休日"]})
+            for index, place in enumerate(self.fixtures["places"]["results"])
+        }
+        self.place_photo = _synthetic_photo(0, size=(400, 300))
+        self.request_counts = {}
+        self._counts_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self._counts_lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def reset_counts(self):
+        with self._counts_lock:
+            counts, self.request_counts = self.request_counts, {}
+        return counts
+
+    def handle_error(self, request, client_address):
+        # クライアントがkeep-aliveの接続を閉じただけのものは無視する
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def delay(self, latency_ms):
+        jitter = random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        time.sleep(max(0.0, latency_ms + jitter) / 1000)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive (本番のコネクションプールと同じ条件にする)
+    disable_nagle_algorithm = True  # ヘッダーと本文を別々に書くので、遅延ACKで40ms待たされないようにする
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.endswith("/geocode/json"):
+            name = "geocode"
+        elif path.endswith("/place/textsearch/json"):
+            name = "places"
+        elif path.endswith("/place/details/json"):
+            self.server.count("place_details")
+            self.server.delay(self.server.google_latency_ms)
+            place_id = parse_qs(urlsplit(self.path).query).get("place_id", [""])[0]
+            place = self.server.place_details.get(place_id)
+            self._send_json({"status": "OK", "result": place} if place else {"status": "NOT_FOUND"})
+            return
+        elif path.endswith("/place/photo"):
+            self.server.count("place_photo")
+            self.server.delay(self.server.google_latency_ms)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(self.server.place_photo)))
+            self.end_headers()
+            self.wfile.write(self.server.place_photo)
+            return
+        else:
+            self._send_json({"error": f"unknown path: {path}"}, status=404)
+            return
+        self.server.count(name)
+        self.server.delay(self.server.google_latency_ms)
+        self._send_json(self.server.fixtures[name])
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not path.endswith("/chat/completions"):
+            self._send_json({"error": {"message": f"unknown path: {path}"}}, status=404)
+            return
+        request = json.loads(body or b"{}")
+        # ツールが使える状態で、まだツールの結果を受け取っていなければTool Callを返す
+        has_tool_results = any(m.get("role") == "tool" for m in request.get("messages", []))
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            name = "openai_plan"  # 長期旅行の計画リクエスト
+        elif request.get("tools") and not has_tool_results:
+            name = "openai_tool_calls"
+        elif "日目 エリア:" in request["messages"][1].get("content", ""):
+            name = "openai_day"  # 長期旅行の1日分
+        else:
+            name = "openai_final"
+        self.server.count(name)
+        self.server.count(f"model:{request.get('model')}")
+        self.server.delay(self.server.openai_latency_ms + self.server.model_latency_ms.get(request.get("model"), 0))
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage", False)
+            self._send_stream(self.server.fixtures[name], include_usage)
+        else:
+            self._send_json(self.server.fixtures[name])
+
+    def _send_stream(self, completion, include_usage=False):
+        """完了レスポンスのフィクスチャをSSEのチャンク列に分解して返す"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index, chunk in enumerate(_completion_to_chunks(completion, include_usage)):
+            if index and self.server.token_interval_ms:
+                time.sleep(self.server.token_interval_ms / 1000)
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def _completion_to_chunks(completion, include_usage=False, piece_size=8):
+    choice = completion["choices"][0]
+    message = choice["message"]
+    base = {"id": completion["id"], "object": "chat.completion.chunk",
+            "created": completion["created"], "model": completion["model"]}
+
+    def chunk(delta, finish_reason=None):
+        return dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+
+    yield chunk({"role": "assistant", "content": ""})
+    content = message.get("content") or ""
+    for start in range(0, len(content), piece_size):
+        yield chunk({"content": content[start:start + piece_size]})
+    for index, tool_call in enumerate(message.get("tool_calls") or []):
+        yield chunk({"tool_calls": [{
+            "index": index, "id": tool_call["id"], "type": "function",
+            "function": {"name": tool_call["function"]["name"], "arguments": tool_call["function"]["arguments"]},
+        }]})
+    yield chunk({}, finish_reason=choice["finish_reason"])
+    if include_usage:
+        yield dict(base, choices=[], usage=completion["usage"])
+
+
+# --- 2. 合成DB ---
+
+def _synthetic_place(index):
+    place_types = ["tourist_attraction", "cafe", "restaurant", "museum", "park", "lodging"]
+    return {
+        "name": f"ベンチ用スポット {index}",
+        "address": f"日本、京都府京都市左京区 {index}",
+        "rating": round(3.0 + (index % 20) / 10, 1),
+        "price_level": index % 4 + 1 if index % 3 else None,
+        "types": [place_types[index % len(place_types)], "point_of_interest", "establishment"],
+        "place_id": f"bench-place-{index:06d}",
+    }
+
+
+def _synthetic_content(index, rng):
+    sentences = [
+        "朝の澄んだ空気の中、庭園で静かに過ごしましょう。",
+        "町家を改装したカフェで抹茶とわらび餅を。",
+        "路地を歩きながら気になった小さなお店に立ち寄るのもおすすめです。",
+        "季節の京野菜を使ったおばんざいで、やさしい味わいの夕食を。",
+        "温泉でゆっくりと旅の疲れを癒やしてください。",
+        "小さな美術館で、地元の作家の作品に触れてみましょう。",
+    ]
+    days = []
+    for day in range(1, 4):
+        days.append(f"## {day}日目\n" + "\n".join(rng.choice(sentences) for _ in range(4)))
+    return f"# しおり {index}\n\n" + "\n\n".join(days)
+
+
+def build_synthetic_db(path, itinerary_count, photo_count, batch_size=1000):
+    """
+    しおり itinerary_count 件・思い出 photo_count 件の合成DBを作る。
+    同じ件数のDBが作成済みなら作り直さない。作成した場合は True を返す。
+    """
+    import okosy_db
+
+    okosy_db.DATABASE_NAME = path
+    okosy_db.init_db()
+    with okosy_db.db_connection() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM itineraries").fetchone()[0]
+        existing_photos = conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+    if existing == itinerary_count and existing_photos == photo_count:
+        return False
+    if existing or existing_photos:
+        raise SystemExit(f"{path} の件数が指定と異なります。ファイルを削除してから再実行してください。")
+
+    print(f"合成DBを作成中: {path} (しおり {itinerary_count} 件, 写真 {photo_count} 件)", file=sys.stderr)
+    rng = random.Random(itinerary_count)
+    places = [_synthetic_place(i) for i in range(PLACE_POOL_SIZE)]
+    started = datetime.datetime(2024, 1, 1)
+    with okosy_db.db_connection() as conn:
+        cursor = conn.cursor()
+        for batch_start in range(0, itinerary_count, batch_size):
+            for index in range(batch_start, min(batch_start + batch_size, itinerary_count)):
+                itinerary_places = rng.sample(places, PLACES_PER_ITINERARY)
+                places_data = json.dumps(itinerary_places, ensure_ascii=False)
+                creation_date = started + datetime.timedelta(minutes=index * 5)
+                cursor.execute(
+                    "INSERT INTO itineraries (name, preferences, generated_content, places_data, creation_date) VALUES (?, ?, ?, ?, ?)",
+                    (f"しおり {index} ({rng.choice(SEARCH_TERMS)})", "{}", _synthetic_content(index, rng),
+                     places_data, creation_date.strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                okosy_db.save_itinerary_places(cursor, cursor.lastrowid, itinerary_places)
+            conn.commit()
+            print(f"  {min(batch_start + batch_size, itinerary_count)} / {itinerary_count}", file=sys.stderr)
+
+        if photo_count:
+            from okosy_photos import store_photo
+            refs = [store_photo(_synthetic_photo(i)) for i in range(min(DISTINCT_PHOTOS, photo_count))]
+            # 新しいしおりから順に PHOTOS_PER_ITINERARY 件ずつ思い出を付ける
+            rows = []
+            for index in range(photo_count):
+                ref = refs[index % len(refs)]
+                itinerary_id = max(1, itinerary_count - index // PHOTOS_PER_ITINERARY)
+                rows.append((itinerary_id, f"思い出 {index}", ref["photo_path"], ref["thumb_path"],
+                             ref["photo_width"], ref["photo_height"]))
+            cursor.executemany(
+                "INSERT INTO memories (itinerary_id, caption, photo_path, thumb_path, photo_width, photo_height) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+    with okosy_db.db_connection() as conn:
+        conn.execute("ANALYZE")
+    return True
+
+
+def _synthetic_photo(index, size=(1600, 1200)):
+    """ベンチ用の写真 (既定はスマホ写真程度の解像度のJPEG) のバイト列"""
+    from PIL import Image
+
+    image = Image.new("RGB", size, ((index * 37) % 256, (index * 91) % 256, (index * 53) % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+# --- 3. 計測 ---
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # macOSはバイト、Linuxはキロバイト
+
+
+def run_scenario(name, operation, iterations, concurrency, warmup, trace_memory=False, before_each=None):
+    """
+    operation(i) を iterations 回 (concurrency 並列で) 実行し、レイテンシの統計を返す。
+    warmup 回は計測前に実行して捨てる。
+    """
+    from okosy_http import LatencyHistogram
+
+    for i in range(warmup):
+        if before_each:
+            before_each()
+        operation(i)
+
+    histogram = LatencyHistogram(sample_size=iterations)
+    errors = []
+
+    def timed(i):
+        if before_each:
+            before_each()
+        start = time.perf_counter()
+        try:
+            operation(i)
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            histogram.record((time.perf_counter() - start) * 1000)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for i in range(iterations):
+            timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(iterations)))
+    wall_s = time.perf_counter() - started
+    tracemalloc_peak_kb = None
+    if trace_memory:
+        tracemalloc_peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+
+    latency = histogram.snapshot()
+    return {
+        "scenario": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "wall_s": round(wall_s, 4),
+        "rps": round(iterations / wall_s, 2) if wall_s else None,
+        "p50_ms": latency["p50_ms"],
+        "p95_ms": latency["p95_ms"],
+        "p99_ms": latency["p99_ms"],
+        "mean_ms": latency["mean_ms"],
+        "latency_buckets": latency["buckets"],
+        "peak_rss_kb": _peak_rss_kb(),
+        "tracemalloc_peak_kb": tracemalloc_peak_kb,
+    }
+
+
+def _clear_api_caches():
+    """Geocoding / Places のキャッシュ(位置索引の検索済み範囲を含む)を空にして、毎回上流(スタブ)まで呼ぶ状態にする"""
+    import okosy_db
+    import okosy_google
+
+    okosy_google._geocode_memory_cache.clear()
+    okosy_google._places_cache.clear()
+    with okosy_db.db_connection() as conn:
+        conn.execute("DELETE FROM geocode_cache")
+        conn.execute("DELETE FROM places_coverage")
+
+
+# --- 4. シナリオ ---
+
+def make_generation_operation(client, stream):
+    from okosy_agent import ERROR_REPLIES, run_conversation_with_function_calling
+    from okosy_prompt import build_itinerary_messages
+
+    def operation(i):
+        messages, _ = build_itinerary_messages(*BENCH_ITINERARY_INPUT)
+        content, places = run_conversation_with_function_calling(
+            client, messages, dest=BENCH_ITINERARY_INPUT[0], on_token=(lambda token: None) if stream else None)
+        if content in ERROR_REPLIES or not places:
+            raise RuntimeError(f"しおり生成に失敗しました: {content}")
+    return operation
+
+
+def make_long_trip_operation(client, days):
+    """日毎の並列生成。days=1 との比較で、日数が増えても所要時間がほぼ変わらないことを確かめる"""
+    from okosy_agent import ERROR_REPLIES, run_long_trip_generation
+
+    dest, purp, comp, _, budg, preferences = BENCH_ITINERARY_INPUT
+    request = {"dest": dest, "purp": purp, "comp": comp, "days": days, "budg": budg, "preferences": preferences}
+
+    def operation(i):
+        content, places, failed_days = run_long_trip_generation(client, request)
+        if content in ERROR_REPLIES or not places or failed_days:
+            raise RuntimeError(f"長期旅行のしおり生成に失敗しました: {content[:200]}")
+    return operation
+
+
+def make_places_operation():
+    from okosy_google import search_google_places
+
+    def operation(i):
+        query, place_type = PLACES_QUERIES[i % len(PLACES_QUERIES)]
+        result = json.loads(search_google_places(query, location_bias="35.0116,135.7681", place_type=place_type))
+        if not isinstance(result, list):
+            raise RuntimeError(f"Places検索に失敗しました: {result}")
+    return operation
+
+
+def make_save_operation():
+    """okpre4.py の保存処理 (しおり本体と places の正規化) と同じ書き込みを行う"""
+    import okosy_db
+
+    final = load_fixture("openai_final.json")["choices"][0]["message"]["content"]
+    places = [_synthetic_place(i) for i in range(PLACE_POOL_SIZE)]
+    rng = random.Random(0)
+
+    def operation(i):
+        places_data = json.dumps(rng.sample(places, PLACES_PER_ITINERARY), ensure_ascii=False)
+        with okosy_db.db_connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO itineraries (name, preferences, generated_content, places_data) VALUES (?, ?, ?, ?)",
+                (f"ベンチ保存 {i}", "{}", final, places_data)
+            )
+            okosy_db.save_itinerary_places(cursor, cursor.lastrowid, places_data)
+    return operation
+
+
+def make_viewer_operation(with_photos):
+    """過去のしおりページ: 一覧の1ページ目 → 1件の本文・場所・思い出(サムネイル読み込み)"""
+    import okosy_db
+    from okosy_photos import photo_abspath
+
+    with okosy_db.db_connection() as conn:
+        if with_photos:
+            ids = [row[0] for row in conn.execute("SELECT DISTINCT itinerary_id FROM memories")]
+        else:
+            ids = [row[0] for row in conn.execute("SELECT id FROM itineraries")]
+    rng = random.Random(1)
+
+    def operation(i):
+        with okosy_db.db_connection() as conn:
+            page = okosy_db.list_itineraries(conn)
+            okosy_db.list_itineraries(conn, after=(page[-1][2], page[-1][0]))  # 次のページ
+            itinerary_id = rng.choice(ids)
+            itinerary = okosy_db.load_itinerary(conn, itinerary_id)
+            if itinerary is None:
+                raise RuntimeError(f"しおり {itinerary_id} が見つかりません")
+            okosy_db.load_itinerary_places(conn, itinerary_id)
+            memories = conn.execute(
+                "SELECT id, caption, photo_path, thumb_path, creation_date FROM memories WHERE itinerary_id = ? ORDER BY creation_date DESC",
+                (itinerary_id,)
+            ).fetchall()
+        for memory in memories:
+            if memory[3]:
+                with open(photo_abspath(memory[3]), "rb") as f:
+                    f.read()
+    return operation
+
+
+def make_rerun_operation():
+    """
+    同じしおりのページのリラン (キャプション入力などの操作の度の再実行):
+    思い出の最も多いしおりの表示用データをキャッシュ(okosy_views.py)から取得する
+    """
+    import okosy_db
+    from okosy_views import load_itinerary_view
+
+    with okosy_db.db_connection() as conn:
+        row = conn.execute(
+            "SELECT itinerary_id FROM memories GROUP BY itinerary_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+        itinerary_id = row[0] if row else conn.execute("SELECT MIN(id) FROM itineraries").fetchone()[0]
+
+    def operation(i):
+        with okosy_db.db_connection() as conn:
+            okosy_db.list_itineraries(conn)
+            if load_itinerary_view(conn, itinerary_id) is None:
+                raise RuntimeError(f"しおり {itinerary_id} が見つかりません")
+    return operation
+
+
+def make_search_operation():
+    import okosy_db
+
+    def operation(i):
+        with okosy_db.db_connection() as conn:
+            okosy_db.search_itineraries(conn, SEARCH_TERMS[i % len(SEARCH_TERMS)])
+    return operation
+
+
+# --- 5. 基準との比較 ---
+
+def _result_key(result):
+    if result.get("days"):
+        return f"{result['scenario']}@{result['days']}days"
+    return f"{result['scenario']}@{result.get('db_itineraries')}"
+
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    """p95 が基準の (1 + max_regression) 倍を超えたシナリオの一覧を返す"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {_result_key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get(_result_key(result))
+        if not base or not base.get("p95_ms") or result["p95_ms"] is None:
+            continue
+        ratio = result["p95_ms"] / base["p95_ms"]
+        if ratio > 1 + max_regression:
+            regressions.append({"scenario": _result_key(result), "baseline_p95_ms": base["p95_ms"],
+                                "p95_ms": result["p95_ms"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+# --- 6. エントリポイント ---
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Okosy のオフラインベンチマーク")
+    parser.add_argument("--scenarios", default="all", help=f"カンマ区切り ({', '.join(SCENARIOS)}) または all")
+    parser.add_argument("--itineraries", default="1000", help="合成DBのしおり件数 (カンマ区切りで複数指定、例: 1000,100000)")
+    parser.add_argument("--photos", type=int, default=1000, help="合成DBの思い出(写真)の件数")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--openai-latency-ms", type=float, default=800, help="OpenAIの1リクエストあたりの注入遅延")
+    parser.add_argument("--google-latency-ms", type=float, default=150, help="Google Mapsの1リクエストあたりの注入遅延")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="注入遅延に加える ± のばらつき")
+    parser.add_argument("--token-interval-ms", type=float, default=2, help="ストリーミング時のチャンク間隔")
+    parser.add_argument("--long-trip-days", default="10", help="long_trip シナリオの日数 (カンマ区切りで複数指定)")
+    parser.add_argument("--slow-model", action="append", default=[], metavar="MODEL:MS",
+                        help="指定したモデルへのリクエストだけ遅延を追加する (複数指定可、例: gpt-4o:20000)")
+    parser.add_argument("--stream", action="store_true", help="しおり生成をストリーミングで実行する")
+    parser.add_argument("--warm-cache", action="store_true",
+                        help="Geocoding/Places のキャッシュを毎回消さない (既定は毎回上流まで呼ぶ)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="tracemalloc でシナリオ毎のPythonヒープのピークを計測する (計測中は遅くなる)")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "bench_data"), help="合成DB・写真の置き場所")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル (省略時は標準出力)")
+    parser.add_argument("--baseline", help="比較する過去の結果JSON")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="許容するp95の悪化率 (0.2 = 20%%)")
+    parser.add_argument("--verbose", action="store_true", help="アプリ側のログを表示する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = SCENARIOS if args.scenarios == "all" else tuple(s.strip() for s in args.scenarios.split(","))
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"不明なシナリオ: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.itineraries.split(",")]
+
+    model_latency_ms = {model: float(ms) for model, ms in (item.rsplit(":", 1) for item in args.slow_model)}
+    server = StubServer(args.openai_latency_ms, args.google_latency_ms, args.jitter_ms, args.token_interval_ms,
+                        model_latency_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # アプリのモジュールは接続先などを環境変数から読むので、設定してからインポートする
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ["OKOSY_GOOGLE_MAPS_BASE_URL"] = server.base_url
+    os.environ["OKOSY_PHOTO_DIR"] = os.path.join(args.data_dir, "photos")
+    os.environ["OKOSY_MEDIA_DIR"] = os.path.join(args.data_dir, "media")
+    os.environ.setdefault("GOOGLE_PLACES_API_KEY", "bench")
+    os.environ["OPENAI_API_KEY"] = "bench"
+    from okosy_http import get_http_stats
+    from okosy_models import get_model_stats
+
+    app_log = sys.stderr if args.verbose else open(os.devnull, "w")
+    before_each = None if args.warm_cache else _clear_api_caches
+    results = []
+
+    def record(result, **extra):
+        result.update(extra)
+        result["upstream_requests"] = server.reset_counts()
+        results.append(result)
+        print(f"{_result_key(result)}: p50={result['p50_ms']:.1f}ms p95={result['p95_ms']:.1f}ms "
+              f"rps={result['rps']} errors={result['errors']}", file=sys.stderr)
+
+    with contextlib.redirect_stdout(app_log):
+        # API系のシナリオは最小の合成DB (geocode_cache のみ使用) で実行する
+        build_synthetic_db(os.path.join(args.data_dir, f"okosy_bench_{sizes[0]}.db"), sizes[0], args.photos)
+        server.reset_counts()
+        if "generation" in scenarios:
+            from openai import OpenAI
+            client = OpenAI(base_url=f"{server.base_url}/v1", api_key="bench", max_retries=0)
+            record(run_scenario("generation", make_generation_operation(client, args.stream), args.iterations,
+                                args.concurrency, args.warmup, args.trace_memory, before_each),
+                   db_itineraries=None, stream=args.stream, warm_cache=args.warm_cache)
+        if "long_trip" in scenarios:
+            from openai import OpenAI
+            client = OpenAI(base_url=f"{server.base_url}/v1", api_key="bench", max_retries=0)
+            for days in (int(d) for d in args.long_trip_days.split(",")):
+                record(run_scenario("long_trip", make_long_trip_operation(client, days), args.iterations,
+                                    args.concurrency, args.warmup, args.trace_memory, before_each),
+                       db_itineraries=None, days=days, warm_cache=args.warm_cache)
+        if "places" in scenarios:
+            record(run_scenario("places", make_places_operation(), args.iterations, args.concurrency,
+                                args.warmup, args.trace_memory, before_each),
+                   db_itineraries=None, warm_cache=args.warm_cache)
+
+        for size in sizes:
+            if not set(scenarios) & set(DB_SCENARIOS):
+                break
+            path = os.path.join(args.data_dir, f"okosy_bench_{size}.db")
+            build_synthetic_db(path, size, args.photos)
+            db_info = {"db_itineraries": size, "db_photos": args.photos, "db_size_kb": os.path.getsize(path) // 1024}
+            if "viewer" in scenarios:
+                record(run_scenario("viewer", make_viewer_operation(args.photos > 0), args.iterations,
+                                    args.concurrency, args.warmup, args.trace_memory), **db_info)
+            if "rerun" in scenarios:
+                record(run_scenario("rerun", make_rerun_operation(), args.iterations,
+                                    args.concurrency, args.warmup, args.trace_memory), **db_info)
+            if "search" in scenarios:
+                record(run_scenario("search", make_search_operation(), args.iterations,
+                                    args.concurrency, args.warmup, args.trace_memory), **db_info)
+            if "save" in scenarios:
+                import okosy_db
+                # 保存したしおりは計測後に消し、合成DBの件数を保つ
+                with okosy_db.db_connection() as conn:
+                    last_id = conn.execute("SELECT MAX(id) FROM itineraries").fetchone()[0] or 0
+                try:
+                    record(run_scenario("save", make_save_operation(), args.iterations, args.concurrency,
+                                        args.warmup, args.trace_memory), **db_info)
+                finally:
+                    with okosy_db.db_connection() as conn:
+                        conn.execute("DELETE FROM itineraries WHERE id > ?", (last_id,))
+
+    report = {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+        "http": get_http_stats(),
+        "models": get_model_stats(),
+    }
+    exit_code = 0
+    if args.baseline:
+        report["regressions"] = compare_with_baseline(results, args.baseline, args.max_regression)
+        if report["regressions"]:
+            exit_code = 1
+            for regression in report["regressions"]:
+                print(f"性能劣化: {regression}", file=sys.stderr)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    server.shutdown()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
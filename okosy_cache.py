@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+プロセス内で共有するキャッシュの部品。
+モジュールとしてインポートされたオブジェクトはStreamlitのリランやセッションを
+またいで生き残るため、ここに置いたキャッシュは全ユーザーで共有される。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# キャッシュに存在しないことを表す番兵 (None をキャッシュできるようにするため)
+MISSING = object()
+
+
+def normalize_text(text):
+    """キャッシュキー用に文字列を正規化する (NFKC・前後空白除去・空白の連続を1つに・小文字化)"""
+    if text is None:
+        return ""
+    text = unicodedata.normalize("NFKC", str(text))
+    return " ".join(text.split()).lower()
+
+
+class TTLCache:
+    """
+    有効期限(TTL)付きのスレッドセーフなLRUキャッシュ。
+    maxsize を超えると最も長く使われていないエントリから追い出す。
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING, count=True):
+        """
+        キーに対応する値を返す。無い・期限切れの場合は default を返す。
+        count=False のときはヒット/ミス数に数えない (内部での再確認用)
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                if count:
+                    self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """値を保存する。ttl を指定するとこのエントリだけ有効期限を変えられる"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """エントリを削除する (存在しなくてもエラーにしない)"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """ヒット・ミス数などの統計を辞書で返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+            }
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    同じキーの処理が同時に実行中なら、後から来た呼び出しはその完了を待って結果を共有する。
+    (同一リクエストの同時実行を1回の上流呼び出しにまとめる)
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """key に対して fn() を高々1つだけ同時実行し、その結果(または例外)を返す"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _InFlightCall()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+# --- 旅のしおり全体のキャッシュ ---
+# 生成プロンプトは行き先・目的・同行者・日数・予算・好みから決定的に作られるため、
+# それらを正規化したキーで完成したしおり (本文, places_data) を再利用する
+ITINERARY_CACHE_TTL = float(os.getenv("OKOSY_ITINERARY_CACHE_TTL", 24 * 3600))
+ITINERARY_CACHE_SIZE = int(os.getenv("OKOSY_ITINERARY_CACHE_SIZE", 256))
+
+itinerary_cache = TTLCache(maxsize=ITINERARY_CACHE_SIZE, ttl=ITINERARY_CACHE_TTL)
+
+
+def itinerary_cache_key(dest, purp, comp, days, budg, preferences):
+    """しおり生成の入力を正規化してハッシュ化したキャッシュキーを返す"""
+    canonical_preferences = {
+        # 複数選択は選んだ順序に意味がないので並べ替える
+        key: sorted(value) if isinstance(value, list) else value
+        for key, value in (preferences or {}).items()
+    }
+    payload = {
+        "dest": normalize_text(dest),
+        "purp": normalize_text(purp),
+        "comp": comp,
+        "days": int(days),
+        "budg": budg,
+        "preferences": canonical_preferences,
+    }
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
@@ -0,0 +1,889 @@
+# -*- coding: utf-8 -*-
+"""
+Okosy のデータアクセス層 (SQLite)。
+Streamlitのリラン毎に再実行されるスクリプト本体ではなく、
+インポートされるモジュールに置くことでプロセス内で共有できるようにしている。
+
+- コネクションはプールして使い回す (db_connection() で借りて、抜けると返却)
+- WALモードで、書き込み中も読み込みがブロックされないようにする
+- スキーマはバージョン付きのマイグレーションで管理し、プロセス毎に1回だけ適用する
+"""
+import json
+import math
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from okosy_trace import TRACING_ENABLED, span
+
+# --- データベースの設定 ---
+DATABASE_NAME = "okosy_data_noauth.db"
+ITINERARY_PAGE_SIZE = 20 # 過去のしおり一覧の1ページの件数
+DB_POOL_SIZE = int(os.getenv("OKOSY_DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("OKOSY_DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHE_SIZE_KB = int(os.getenv("OKOSY_DB_CACHE_SIZE_KB", 16000))
+
+# 接続毎に設定するPRAGMA
+# (journal_mode=WAL はDBファイルに記録されるので初期化時に1回だけ設定する)
+_CONNECTION_PRAGMAS = (
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous = NORMAL",  # WALモードではNORMALでも壊れない (電源断で直近のコミットが失われうるのみ)
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+)
+
+def _query_span(sql, **attributes):
+    # スパン名は文の種類 (db.select / db.insert ...)、SQLは空白を詰めて先頭だけ記録する
+    sql_text = " ".join(sql.split())
+    verb = sql_text.split(" ", 1)[0].lower() if sql_text else "query"
+    return span(f"db.{verb}", sql=sql_text[:160], **attributes)
+
+
+class _TracedCursor(sqlite3.Cursor):
+    """execute / executemany をスパンとして計測するカーソル"""
+
+    def execute(self, sql, parameters=()):
+        with _query_span(sql):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with _query_span(sql, many=True):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class _TracedConnection(sqlite3.Connection):
+    """conn.execute() も含めて _TracedCursor を使うコネクション"""
+
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def get_db_connection():
+    """
+    SQLiteデータベースへの新しいコネクションを取得する (PRAGMA設定済み)。
+    呼び出し側で close() すること。通常の読み書きは db_connection() を使う。
+    """
+    conn = sqlite3.connect(DATABASE_NAME, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           factory=_TracedConnection if TRACING_ENABLED else sqlite3.Connection)
+    for pragma in _CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """
+    SQLiteコネクションの小さなプール。
+    1つのコネクションを同時に使うのは借りている1スレッドだけなので check_same_thread=False で共有する。
+    """
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._database = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """コネクションを借りる。正常終了ならコミット、例外ならロールバックして返却する"""
+        conn = self._acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            # st.rerun() / st.stop() も例外で抜けてくるので BaseException で受ける
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def _acquire(self):
+        with self._lock:
+            # DATABASE_NAME が差し替えられた場合 (ベンチマーク用DBなど) は古い接続を捨てる
+            if self._database != DATABASE_NAME:
+                self.close_all()
+                self._database = DATABASE_NAME
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return get_db_connection()
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool = ConnectionPool()
+
+def db_connection():
+    """
+    プールからコネクションを借りるコンテキストマネージャ。
+        with db_connection() as conn:
+            conn.execute(...)
+    ブロックを抜けると自動でコミット (例外時はロールバック) される。
+    """
+    init_db()
+    return _pool.connection()
+
+
+# --- スキーマのマイグレーション ---
+# マイグレーション導入前のDBは各テーブルを IF NOT EXISTS で作っていたため、各手順は冪等にしておく
+
+def _ensure_columns(cursor, table, columns):
+    """既存のテーブルに足りない列を追加する (columns: 列名 -> 型)"""
+    existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+def _migration_1_base_tables(cursor):
+    """しおり(itineraries)・思い出(memories)"""
+    # しおりテーブル (usernameなし)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itineraries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            preferences TEXT,
+            generated_content TEXT,
+            places_data TEXT,
+            creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 思い出テーブル
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            itinerary_id INTEGER NOT NULL,
+            caption TEXT,
+            photo BLOB,
+            creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (itinerary_id) REFERENCES itineraries (id)
+        )
+    ''')
+
+def _migration_2_photo_refs(cursor):
+    """思い出の写真への参照列"""
+    # 写真はファイルストア(okosy_photos.py)に置き、DBには参照とサイズだけを持つ
+    # (photo BLOB列は移行前の古い行のためだけに残している)
+    _ensure_columns(cursor, "memories", {
+        "photo_path": "TEXT",
+        "thumb_path": "TEXT",
+        "photo_width": "INTEGER",
+        "photo_height": "INTEGER",
+    })
+
+def _migration_3_geocode_cache(cursor):
+    """ジオコーディングキャッシュ(geocode_cache)"""
+    # coords が NULL の行は「見つからなかった」結果
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            address_key TEXT PRIMARY KEY,
+            coords TEXT,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_4_indexes(cursor):
+    """一覧のページング用・思い出の取得用のインデックス"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_itineraries_creation_date ON itineraries (creation_date DESC, id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memories_itinerary ON memories (itinerary_id, creation_date DESC)")
+
+def _migration_5_itinerary_search(cursor):
+    """しおりの全文検索インデックス(itineraries_fts)"""
+    _init_itinerary_search(cursor)
+
+def _migration_6_places(cursor):
+    """場所(places)・場所の種類(place_types)・しおりと場所の対応(itinerary_places)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS places (
+            place_id TEXT PRIMARY KEY,
+            name TEXT,
+            address TEXT,
+            rating REAL,
+            price_level INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS place_types (
+            place_id TEXT NOT NULL REFERENCES places (place_id) ON DELETE CASCADE,
+            type TEXT NOT NULL,
+            PRIMARY KEY (place_id, type)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itinerary_places (
+            itinerary_id INTEGER NOT NULL REFERENCES itineraries (id) ON DELETE CASCADE,
+            place_id TEXT NOT NULL REFERENCES places (place_id),
+            position INTEGER NOT NULL,
+            PRIMARY KEY (itinerary_id, place_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_places_rating ON places (rating)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_places_price_level ON places (price_level)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_place_types_type ON place_types (type, place_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_itinerary_places_place ON itinerary_places (place_id)")
+    # 既存の places_data (JSON文字列) を正規化したテーブルへ移す
+    rows = cursor.connection.execute("SELECT id, places_data FROM itineraries WHERE places_data IS NOT NULL")
+    for itinerary_id, places_data in rows:
+        save_itinerary_places(cursor, itinerary_id, places_data)
+
+def _migration_7_generation_jobs(cursor):
+    """しおり生成ジョブ(generation_jobs)"""
+    # status: queued / running / succeeded / partial (一部の日が欠けた長期旅行) / failed
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id TEXT PRIMARY KEY,
+            job_key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            progress TEXT,
+            partial_content TEXT,
+            result_content TEXT,
+            places_data TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_key ON generation_jobs (job_key, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, created_at)")
+
+def _migration_8_place_media(cursor):
+    """場所の詳細・写真のキャッシュ(place_media)"""
+    # 写真ファイルは okosy_media.py の MEDIA_CACHE_DIR に置き、ここには相対パスとサイズを記録する
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS place_media (
+            place_id TEXT PRIMARY KEY,
+            details TEXT,
+            photo_path TEXT,
+            photo_bytes INTEGER NOT NULL DEFAULT 0,
+            fetched_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_place_media_last_access ON place_media (last_access)")
+
+def _migration_9_photo_derivatives(cursor):
+    """思い出の写真の拡大表示用ファイルと容量の列"""
+    # original_bytes: アップロードされたファイルのサイズ / stored_bytes: 保存した全ファイル(写真・拡大表示用・サムネイル)の合計
+    _ensure_columns(cursor, "memories", {
+        "display_path": "TEXT",
+        "original_bytes": "INTEGER",
+        "stored_bytes": "INTEGER",
+    })
+
+def _migration_10_itinerary_version(cursor):
+    """しおりの版数(version)と、しおり・思い出・場所の変更で版数を上げるトリガー"""
+    # 表示用データのキャッシュ(okosy_views.py)は (id, version) が変わったときだけ作り直す
+    _ensure_columns(cursor, "itineraries", {"version": "INTEGER NOT NULL DEFAULT 0"})
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS itineraries_version_update
+        AFTER UPDATE OF name, preferences, generated_content, places_data ON itineraries BEGIN
+            UPDATE itineraries SET version = version + 1 WHERE id = new.id;
+        END
+    ''')
+    for table in ("memories", "itinerary_places"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_insert AFTER INSERT ON {table} BEGIN
+                UPDATE itineraries SET version = version + 1 WHERE id = new.itinerary_id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_version_delete AFTER DELETE ON {table} BEGIN
+                UPDATE itineraries SET version = version + 1 WHERE id = old.itinerary_id;
+            END
+        ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS memories_version_update AFTER UPDATE ON memories BEGIN
+            UPDATE itineraries SET version = version + 1 WHERE id IN (old.itinerary_id, new.itinerary_id);
+        END
+    ''')
+
+def _migration_11_place_locations(cursor):
+    """検索結果で見た場所の位置(place_locations と R*Tree 索引)・検索済みの範囲(places_coverage)"""
+    # R*Tree は整数のidが必要なので、place_id と対応させる表を別に持つ
+    # (places の rowid は VACUUM で変わることがあるため使わない)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS place_locations (
+            id INTEGER PRIMARY KEY,
+            place_id TEXT NOT NULL UNIQUE REFERENCES places (place_id),
+            lat REAL NOT NULL,
+            lng REAL NOT NULL,
+            user_ratings_total INTEGER,
+            seen_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS place_locations_rtree USING rtree(
+            id, min_lat, max_lat, min_lng, max_lng
+        )
+    ''')
+    # (種類, 正規化した検索語, 約10kmの格子) 毎に、最後にPlaces APIで検索した時刻と、返った場所の place_id (JSON)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS places_coverage (
+            place_type TEXT NOT NULL,
+            query TEXT NOT NULL,
+            cell TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            result_count INTEGER NOT NULL,
+            place_ids TEXT NOT NULL,
+            PRIMARY KEY (place_type, query, cell)
+        )
+    ''')
+
+def _migration_12_archive_imports(cursor):
+    """アーカイブの取り込み記録(archive_imports)"""
+    # 取り込みを途中から再開できるよう、アーカイブ内のid → このDBでのid を記録する (kind: itinerary / memory)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_imports (
+            archive_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            PRIMARY KEY (archive_id, kind, source_id)
+        )
+    ''')
+
+def _migration_13_itinerary_bigram_search(cursor):
+    """2文字の語の全文検索インデックス(itineraries_bigram)"""
+    _init_itinerary_bigram_search(cursor)
+
+# (バージョン, 手順) の一覧。スキーマを変えるときは末尾に追加する
+MIGRATIONS = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_photo_refs),
+    (3, _migration_3_geocode_cache),
+    (4, _migration_4_indexes),
+    (5, _migration_5_itinerary_search),
+    (6, _migration_6_places),
+    (7, _migration_7_generation_jobs),
+    (8, _migration_8_place_media),
+    (9, _migration_9_photo_derivatives),
+    (10, _migration_10_itinerary_version),
+    (11, _migration_11_place_locations),
+    (12, _migration_12_archive_imports),
+    (13, _migration_13_itinerary_bigram_search),
+]
+
+_initialized_database = None
+_init_lock = threading.Lock()
+
+def init_db():
+    """
+    WALモードを有効にし、未適用のマイグレーションを適用する。
+    プロセス内で1回だけ実行され、2回目以降はすぐに戻る。
+    """
+    global _initialized_database
+    if _initialized_database == DATABASE_NAME:
+        return
+    with _init_lock:
+        if _initialized_database == DATABASE_NAME:
+            return
+        conn = get_db_connection()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.commit()
+            applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+            for version, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                # 1つのマイグレーションは1トランザクションで適用する (DDLも含めてロールバックできるよう明示的にBEGIN)
+                # 別プロセスが同時に適用している場合に備えて、書き込みロックを取ってから再確認する
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                        conn.rollback()
+                        continue
+                    migration(conn.cursor())
+                    conn.execute("INSERT INTO schema_migrations (version, description) VALUES (?, ?)",
+                                 (version, migration.__doc__))
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+                print(f"DBマイグレーションを適用しました: {version} {migration.__doc__}")
+        finally:
+            conn.close()
+        _initialized_database = DATABASE_NAME
+
+
+# --- しおりの全文検索 (FTS5) ---
+# 日本語は単語の区切りが無いので trigram トークナイザで部分一致検索する。
+# places 列には places_data(JSON) に含まれる場所名だけを空白区切りで入れる。
+
+# places_data から場所名を取り出すSQL式 (不正なJSONやエラー結果の場合は NULL)
+_PLACE_NAMES_SQL = """(
+    SELECT group_concat(json_extract(value, '$.name'), ' ')
+    FROM json_each(CASE WHEN json_valid({col}) AND json_type({col}) = 'array' THEN {col} ELSE '[]' END)
+)"""
+
+def _init_itinerary_search(cursor):
+    """全文検索用の仮想テーブルと同期用トリガーを作成する。初回作成時は既存のしおりを登録する"""
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'itineraries_fts'"
+    ).fetchone()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS itineraries_fts USING fts5(
+            name, content, places, tokenize = 'trigram'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS itineraries_fts_insert AFTER INSERT ON itineraries BEGIN
+            INSERT INTO itineraries_fts (rowid, name, content, places)
+            VALUES (new.id, new.name, new.generated_content, {_PLACE_NAMES_SQL.format(col="new.places_data")});
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS itineraries_fts_delete AFTER DELETE ON itineraries BEGIN
+            DELETE FROM itineraries_fts WHERE rowid = old.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS itineraries_fts_update AFTER UPDATE OF name, generated_content, places_data ON itineraries BEGIN
+            DELETE FROM itineraries_fts WHERE rowid = old.id;
+            INSERT INTO itineraries_fts (rowid, name, content, places)
+            VALUES (new.id, new.name, new.generated_content, {_PLACE_NAMES_SQL.format(col="new.places_data")});
+        END
+    ''')
+    if not exists:
+        backfill_itinerary_search(cursor)
+
+def backfill_itinerary_search(cursor):
+    """検索インデックスに未登録のしおりを一括登録し、登録件数を返す"""
+    cursor.execute(f'''
+        INSERT INTO itineraries_fts (rowid, name, content, places)
+        SELECT id, name, generated_content, {_PLACE_NAMES_SQL.format(col="places_data")}
+        FROM itineraries
+        WHERE id NOT IN (SELECT rowid FROM itineraries_fts)
+    ''')
+    return cursor.rowcount
+
+
+# 2文字以下の語 (嵐山・旅館など、日本語の地名や名詞の多く) は trigram で引けないので、
+# 文字の連なりを2文字ずつずらした語 (bigram) に分けたものを別の仮想テーブルに入れる。
+# 分割は Python で行う。itineraries のトリガーは変更のあったidを itineraries_bigram_pending に記録するだけにして
+# (SQLだけで動くので、sqlite3 コマンドなど別のコネクションからの書き込みも失敗しない)、
+# sync_itinerary_bigrams() で記録されたしおりを登録し直す (保存・取り込みの後と、bigram で検索する前に呼ぶ)
+_WORD_RUN = re.compile(r"[^\W_]+")
+
+def _bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+def bigram_text(text):
+    """
+    文章を空白区切りの bigram に分ける ("京都の嵐山" → "京都 都の の嵐 嵐山 山")。
+    連なりの最後の1文字も語にして、1文字の語を前方一致で検索したときに末尾の文字も引けるようにする。
+    """
+    if not text:
+        return text
+    return " ".join(" ".join(_bigrams(run) + [run[-1]]) for run in _WORD_RUN.findall(text))
+
+def _bigram_match(terms):
+    """検索語を itineraries_bigram の MATCH 式にする。語にならない(記号だけの)場合は None"""
+    clauses = []
+    for term in terms:
+        for run in _WORD_RUN.findall(term):
+            # 2文字以上は連続する bigram のフレーズ、1文字はその文字で始まる語の前方一致
+            clauses.append(f'"{" ".join(_bigrams(run))}"' if len(run) > 1 else f'"{run}"*')
+    return " AND ".join(clauses) or None
+
+def _init_itinerary_bigram_search(cursor):
+    """bigram の検索用仮想テーブル・変更の記録用テーブルとトリガーを作成し、既存のしおりを登録する"""
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS itineraries_bigram USING fts5(
+            name, content, places, tokenize = 'unicode61 remove_diacritics 0'
+        )
+    ''')
+    cursor.execute("CREATE TABLE IF NOT EXISTS itineraries_bigram_pending (id INTEGER PRIMARY KEY)")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS itineraries_bigram_insert AFTER INSERT ON itineraries BEGIN
+            INSERT OR IGNORE INTO itineraries_bigram_pending (id) VALUES (new.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS itineraries_bigram_delete AFTER DELETE ON itineraries BEGIN
+            INSERT OR IGNORE INTO itineraries_bigram_pending (id) VALUES (old.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS itineraries_bigram_update AFTER UPDATE OF id, name, generated_content, places_data ON itineraries BEGIN
+            INSERT OR IGNORE INTO itineraries_bigram_pending (id) VALUES (old.id), (new.id);
+        END
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO itineraries_bigram_pending (id) SELECT id FROM itineraries")
+    sync_itinerary_bigrams(cursor)
+
+def sync_itinerary_bigrams(cursor, batch_size=500):
+    """itineraries_bigram_pending に記録されたしおりを bigram のインデックスに登録し直し、件数を返す"""
+    # 大半の呼び出しでは記録が無いので、書き込みロックを取る前に読むだけで確かめる
+    if not cursor.execute("SELECT 1 FROM itineraries_bigram_pending LIMIT 1").fetchone():
+        return 0
+    synced = 0
+    while True:
+        # 記録の削除を最初の書き込みにして、以降はこのトランザクションの中で最新の内容を読む
+        ids = [row[0] for row in cursor.execute(
+            "DELETE FROM itineraries_bigram_pending WHERE id IN (SELECT id FROM itineraries_bigram_pending LIMIT ?) RETURNING id",
+            (batch_size,)
+        ).fetchall()]
+        if not ids:
+            return synced
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(f"DELETE FROM itineraries_bigram WHERE rowid IN ({placeholders})", ids)
+        rows = cursor.execute(f'''
+            SELECT id, name, generated_content, {_PLACE_NAMES_SQL.format(col="places_data")}
+            FROM itineraries WHERE id IN ({placeholders})
+        ''', ids).fetchall()
+        cursor.executemany(
+            "INSERT INTO itineraries_bigram (rowid, name, content, places) VALUES (?, ?, ?, ?)",
+            [(itinerary_id, bigram_text(name), bigram_text(content), bigram_text(places))
+             for itinerary_id, name, content, places in rows]
+        )
+        synced += len(ids)
+
+
+# --- しおりの読み込み ---
+
+def list_itineraries(conn, limit=ITINERARY_PAGE_SIZE, after=None, name_filter=None):
+    """
+    しおりの一覧 (id, name, creation_date) を作成日の新しい順に最大 limit 件返す。
+    本文などの大きな列は読まない。
+    after: 前ページ最後の行の (creation_date, id)。その次の行から返す (キーセットページング)
+    name_filter: 名前に含まれる文字列で絞り込む
+    """
+    conditions, params = [], []
+    if after is not None:
+        conditions.append("(creation_date < ? OR (creation_date = ? AND id < ?))")
+        params.extend([after[0], after[0], after[1]])
+    if name_filter:
+        conditions.append("name LIKE ? ESCAPE '\\'")
+        params.append(f"%{_escape_like(name_filter)}%")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(limit)
+    return conn.execute(
+        f"SELECT id, name, creation_date FROM itineraries {where} ORDER BY creation_date DESC, id DESC LIMIT ?",
+        params
+    ).fetchall()
+
+
+def load_itinerary(conn, itinerary_id):
+    """
+    1件のしおりを (id, name, creation_date, preferences, generated_content, places_data) で返す。
+    見つからなければ None。
+    """
+    return conn.execute(
+        "SELECT id, name, creation_date, preferences, generated_content, places_data FROM itineraries WHERE id = ?",
+        (itinerary_id,)
+    ).fetchone()
+
+
+def get_itinerary_version(conn, itinerary_id):
+    """しおりの版数を返す (しおり・思い出・場所が変わる度に増える)。見つからなければ None"""
+    row = conn.execute("SELECT version FROM itineraries WHERE id = ?", (itinerary_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _like_snippet(text, term, width=40):
+    """LIKE検索の結果用に、最初に一致した箇所の前後を切り出して強調する"""
+    if not text:
+        return ""
+    position = text.find(term)
+    if position < 0:
+        return text[:width] + ("…" if len(text) > width else "")
+    start = max(0, position - width // 2)
+    end = min(len(text), position + len(term) + width // 2)
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    return f"{prefix}{text[start:position]}**{term}**{text[position + len(term):end]}{suffix}"
+
+def search_itineraries(conn, query, limit=20):
+    """
+    しおりの名前・本文・場所名をキーワード検索し、関連度順に
+    (id, name, creation_date, snippet) のリストを返す。snippet は一致箇所を **太字** にしたもの。
+    空白区切りの複数キーワードはすべてを含むものに絞り込む。
+    """
+    terms = query.split()
+    if not terms:
+        return []
+    if all(len(term) >= 3 for term in terms):
+        # 3文字以上の語は trigram インデックスで検索し、bm25 で順位付けする (名前 > 場所名 > 本文)
+        match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        return conn.execute('''
+            SELECT i.id, i.name, i.creation_date,
+                   snippet(itineraries_fts, -1, '**', '**', '…', 24)
+            FROM itineraries_fts
+            JOIN itineraries AS i ON i.id = itineraries_fts.rowid
+            WHERE itineraries_fts MATCH ?
+            ORDER BY bm25(itineraries_fts, 10.0, 1.0, 5.0)
+            LIMIT ?
+        ''', (match, limit)).fetchall()
+
+    # 2文字以下の語 (例: "嵐山") を含む場合は bigram のインデックスで検索し、同じ重みの bm25 で順位付けする
+    match = _bigram_match(terms)
+    if match is None:
+        return []
+    sync_itinerary_bigrams(conn.cursor())
+    # bigram のテーブルは分割後の文字列なので、抜粋は trigram のテーブルに入っている元の文章から作る
+    rows = conn.execute('''
+        SELECT i.id, i.name, i.creation_date, f.name, f.content, f.places
+        FROM itineraries_bigram
+        JOIN itineraries AS i ON i.id = itineraries_bigram.rowid
+        JOIN itineraries_fts AS f ON f.rowid = itineraries_bigram.rowid
+        WHERE itineraries_bigram MATCH ?
+        ORDER BY bm25(itineraries_bigram, 10.0, 1.0, 5.0)
+        LIMIT ?
+    ''', (match, limit)).fetchall()
+    results = []
+    for iti_id, iti_name, iti_date, fts_name, fts_content, fts_places in rows:
+        # 抜粋は、検索語のうちこの行に実際に含まれる最初のものの周りから作る
+        term, source = next(((term, text) for term in terms for text in (fts_content, fts_places, fts_name)
+                             if text and term in text), (terms[0], fts_content))
+        results.append((iti_id, iti_name, iti_date, _like_snippet(source, term)))
+    return results
+
+
+# --- 場所 (places / itinerary_places) ---
+# search_google_places の結果は place_id で重複をまとめて places に保存し、
+# しおりとは itinerary_places で結び付ける
+
+def _parse_places(places_data):
+    """places_data (JSON文字列 or リスト) から場所の辞書リストを取り出す。エラー結果などは空リスト"""
+    if isinstance(places_data, str):
+        try:
+            places_data = json.loads(places_data)
+        except json.JSONDecodeError:
+            return []
+    if not isinstance(places_data, list):
+        return []
+    return [place for place in places_data if isinstance(place, dict) and place.get("place_id")]
+
+def upsert_places(cursor, places):
+    """場所を places / place_types に保存する (既にある place_id は最新の内容で更新する)"""
+    for place in places:
+        cursor.execute('''
+            INSERT INTO places (place_id, name, address, rating, price_level, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (place_id) DO UPDATE SET
+                name = excluded.name, address = excluded.address, rating = excluded.rating,
+                price_level = excluded.price_level, updated_at = excluded.updated_at
+        ''', (place["place_id"], place.get("name"), place.get("address"), place.get("rating"), place.get("price_level")))
+        cursor.execute("DELETE FROM place_types WHERE place_id = ?", (place["place_id"],))
+        cursor.executemany(
+            "INSERT OR IGNORE INTO place_types (place_id, type) VALUES (?, ?)",
+            [(place["place_id"], place_type) for place_type in place.get("types") or []]
+        )
+
+def save_itinerary_places(cursor, itinerary_id, places_data):
+    """しおりに含まれる場所を保存し、しおりと結び付ける。保存した件数を返す"""
+    places = _parse_places(places_data)
+    upsert_places(cursor, places)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO itinerary_places (itinerary_id, place_id, position) VALUES (?, ?, ?)",
+        [(itinerary_id, place["place_id"], position) for position, place in enumerate(places)]
+    )
+    return len(places)
+
+_PLACE_COLUMNS_SQL = '''
+    p.name, p.address, p.rating, p.price_level,
+    (SELECT json_group_array(t.type) FROM place_types AS t WHERE t.place_id = p.place_id) AS types,
+    p.place_id
+'''
+
+def _place_row_to_dict(row):
+    name, address, rating, price_level, types, place_id = row[:6]
+    return {
+        "name": name, "address": address, "rating": rating, "price_level": price_level,
+        "types": json.loads(types) if types else [], "place_id": place_id,
+    }
+
+def load_itinerary_places(conn, itinerary_id):
+    """しおりに含まれる場所を、保存時の順序で辞書のリストとして返す"""
+    rows = conn.execute(f'''
+        SELECT {_PLACE_COLUMNS_SQL}
+        FROM itinerary_places AS ip
+        JOIN places AS p ON p.place_id = ip.place_id
+        WHERE ip.itinerary_id = ?
+        ORDER BY ip.position
+    ''', (itinerary_id,)).fetchall()
+    return [_place_row_to_dict(row) for row in rows]
+
+def most_recommended_places(conn, area=None, place_type=None, min_rating=None, limit=20):
+    """
+    多くのしおりで提案されている場所を、提案回数の多い順に返す。
+    area: 住所に含まれる文字列 (例: "京都")、place_type: 場所の種類 (例: "cafe")
+    各要素は場所の辞書に "itinerary_count" を加えたもの。
+    """
+    conditions, params = [], []
+    if area:
+        conditions.append("p.address LIKE ? ESCAPE '\\'")
+        params.append(f"%{_escape_like(area)}%")
+    if place_type:
+        conditions.append("EXISTS (SELECT 1 FROM place_types AS t WHERE t.place_id = p.place_id AND t.type = ?)")
+        params.append(place_type)
+    if min_rating is not None:
+        conditions.append("p.rating >= ?")
+        params.append(min_rating)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(limit)
+    rows = conn.execute(f'''
+        SELECT {_PLACE_COLUMNS_SQL}, COUNT(*) AS itinerary_count
+        FROM itinerary_places AS ip
+        JOIN places AS p ON p.place_id = ip.place_id
+        {where}
+        GROUP BY p.place_id
+        ORDER BY itinerary_count DESC, p.rating DESC
+        LIMIT ?
+    ''', params).fetchall()
+    return [dict(_place_row_to_dict(row), itinerary_count=row[6]) for row in rows]
+
+def itineraries_using_place(conn, place_id):
+    """指定した place_id を含むしおりを (id, name, creation_date) のリストで返す"""
+    return conn.execute('''
+        SELECT i.id, i.name, i.creation_date
+        FROM itinerary_places AS ip
+        JOIN itineraries AS i ON i.id = ip.itinerary_id
+        WHERE ip.place_id = ?
+        ORDER BY i.creation_date DESC, i.id DESC
+    ''', (place_id,)).fetchall()
+
+
+# --- 場所の位置索引 (近くの場所の検索) ---
+# Places APIの検索結果で見た場所を位置付きで蓄積し、よく検索される地域は
+# APIを呼ばずに「種類・評価・価格帯・半径」で答えられるようにする
+
+COVERAGE_CELL_DEGREES = 0.1 # 検索済み範囲を記録する格子の大きさ (緯度方向で約11km)
+_EARTH_RADIUS_M = 6371000.0
+
+def coverage_cell(lat, lng):
+    """緯度経度が属する格子のキーを返す"""
+    return f"{math.floor(lat / COVERAGE_CELL_DEGREES)},{math.floor(lng / COVERAGE_CELL_DEGREES)}"
+
+def index_seen_places(cursor, raw_places, place_type=None, center=None, query=None):
+    """
+    Places APIの生の検索結果を位置索引に保存し、保存した件数を返す。
+    place_type, center (lat, lng), query (正規化した検索語) を指定すると、その検索語でその格子を
+    この時刻に検索済みとして、返った場所の place_id と共に記録する。
+    """
+    now = time.time()
+    located = []
+    for place in raw_places:
+        location = (place.get("geometry") or {}).get("location") or {}
+        if place.get("place_id") and location.get("lat") is not None and location.get("lng") is not None:
+            located.append((place, location["lat"], location["lng"]))
+    upsert_places(cursor, [{
+        "place_id": place["place_id"], "name": place.get("name"), "address": place.get("formatted_address"),
+        "rating": place.get("rating"), "price_level": place.get("price_level"), "types": place.get("types") or [],
+    } for place, _, _ in located])
+    for place, lat, lng in located:
+        location_id = cursor.execute('''
+            INSERT INTO place_locations (place_id, lat, lng, user_ratings_total, seen_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (place_id) DO UPDATE SET
+                lat = excluded.lat, lng = excluded.lng,
+                user_ratings_total = excluded.user_ratings_total, seen_at = excluded.seen_at
+            RETURNING id
+        ''', (place["place_id"], lat, lng, place.get("user_ratings_total"), now)).fetchone()[0]
+        cursor.execute(
+            "INSERT OR REPLACE INTO place_locations_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+            (location_id, lat, lat, lng, lng)
+        )
+    if place_type and center and query is not None:
+        cursor.execute(
+            '''INSERT OR REPLACE INTO places_coverage (place_type, query, cell, fetched_at, result_count, place_ids)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (place_type, query, coverage_cell(*center), now, len(located),
+             json.dumps([place["place_id"] for place, _, _ in located]))
+        )
+    return len(located)
+
+def query_coverage(conn, place_type, query, lat, lng):
+    """
+    その種類・検索語で、その地点の格子を最後にAPIで検索した時刻と、その検索で返った place_id のリストを
+    (fetched_at, place_ids) で返す (未検索なら None)
+    """
+    row = conn.execute(
+        "SELECT fetched_at, place_ids FROM places_coverage WHERE place_type = ? AND query = ? AND cell = ?",
+        (place_type, query, coverage_cell(lat, lng))
+    ).fetchone()
+    return (row[0], json.loads(row[1])) if row else None
+
+def _distance_m(lat1, lng1, lat2, lng2):
+    """2点間の距離(m) (haversine)"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * _EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+def nearby_places(conn, lat, lng, radius_m, place_type=None, min_rating=None, price_levels=None, limit=5,
+                  place_ids=None):
+    """
+    (lat, lng) から radius_m 以内の場所を、評価の高い順 (同点は評価件数の多い順) に返す。
+    price_levels: 許可する価格帯のリスト (None なら絞り込まない)
+    place_ids: 候補にする place_id のリスト (None なら絞り込まない)
+    各要素は場所の辞書に "lat", "lng", "distance_m" を加えたもの。
+    """
+    # R*Tree で外接矩形に絞ってから、正確な距離で絞り込む
+    dlat = math.degrees(radius_m / _EARTH_RADIUS_M)
+    dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    conditions, params = [], [lat - dlat, lat + dlat, lng - dlng, lng + dlng]
+    if place_type:
+        conditions.append("EXISTS (SELECT 1 FROM place_types AS t WHERE t.place_id = p.place_id AND t.type = ?)")
+        params.append(place_type)
+    if min_rating is not None:
+        conditions.append("p.rating >= ?")
+        params.append(min_rating)
+    if price_levels is not None:
+        conditions.append(f"p.price_level IN ({','.join('?' * len(price_levels))})")
+        params.extend(price_levels)
+    if place_ids is not None:
+        conditions.append(f"p.place_id IN ({','.join('?' * len(place_ids))})")
+        params.extend(place_ids)
+    rows = conn.execute(f'''
+        SELECT {_PLACE_COLUMNS_SQL}, l.lat, l.lng
+        FROM place_locations_rtree AS r
+        JOIN place_locations AS l ON l.id = r.id
+        JOIN places AS p ON p.place_id = l.place_id
+        WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?
+        {"".join(f" AND {condition}" for condition in conditions)}
+        ORDER BY p.rating DESC, l.user_ratings_total DESC
+    ''', params).fetchall()
+    results = []
+    for row in rows:
+        distance = _distance_m(lat, lng, row[6], row[7])
+        if distance <= radius_m:
+            results.append(dict(_place_row_to_dict(row), lat=row[6], lng=row[7], distance_m=round(distance)))
+            if len(results) >= limit:
+                break
+    return results
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Google Maps (Geocoding / Places / Place Details / Place Photo) 関連のヘルパー関数。
+"""
+import json
+import os
+import threading
+import time
+
+from okosy_cache import MISSING, SingleFlight, TTLCache, normalize_text
+from okosy_db import db_connection, index_seen_places, nearby_places, query_coverage
+from okosy_http import get_bytes, get_json
+from okosy_trace import LatencyHistogram, sampled_log, span
+
+# Google Maps APIの接続先 (ベンチマーク時はローカルのスタブサーバーに向ける)
+GOOGLE_MAPS_BASE_URL = os.getenv("OKOSY_GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com").rstrip("/")
+
+# --- ジオコーディングキャッシュの設定 ---
+# 1段目: プロセス内LRU (全セッション共有) / 2段目: SQLite の geocode_cache テーブル
+GEOCODE_CACHE_TTL = float(os.getenv("OKOSY_GEOCODE_CACHE_TTL", 30 * 24 * 3600))        # 成功結果: 30日
+GEOCODE_NEGATIVE_TTL = float(os.getenv("OKOSY_GEOCODE_NEGATIVE_TTL", 10 * 60))          # 見つからなかった結果: 10分
+GEOCODE_CACHE_SIZE = int(os.getenv("OKOSY_GEOCODE_CACHE_SIZE", 2048))
+
+_geocode_memory_cache = TTLCache(maxsize=GEOCODE_CACHE_SIZE, ttl=GEOCODE_CACHE_TTL)
+_geocode_counters = {"db_hits": 0, "api_calls": 0}
+_geocode_counters_lock = threading.Lock()
+
+
+def _load_geocode_from_db(address_key):
+    """SQLiteのキャッシュを引く。見つからない・期限切れなら MISSING を返す"""
+    try:
+        with db_connection() as conn:
+            row = conn.execute(
+                "SELECT coords, expires_at FROM geocode_cache WHERE address_key = ?",
+                (address_key,)
+            ).fetchone()
+    except Exception as e:
+        print(f"Geocodeキャッシュ(DB)読み込みエラー: {e}")
+        return MISSING, None
+    if row is None or row[1] <= time.time():
+        return MISSING, None
+    return row[0], row[1] - time.time()
+
+
+def _store_geocode(address_key, coords):
+    """結果を両方のキャッシュに保存する。見つからなかった結果(None)は短いTTLで保存する"""
+    ttl = GEOCODE_CACHE_TTL if coords else GEOCODE_NEGATIVE_TTL
+    _geocode_memory_cache.set(address_key, coords, ttl=ttl)
+    try:
+        with db_connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO geocode_cache (address_key, coords, expires_at) VALUES (?, ?, ?)",
+                (address_key, coords, time.time() + ttl)
+            )
+    except Exception as e:
+        print(f"Geocodeキャッシュ(DB)書き込みエラー: {e}")
+
+
+def get_geocode_cache_stats():
+    """ジオコーディングキャッシュのヒット/ミス数を返す"""
+    stats = _geocode_memory_cache.stats()
+    with _geocode_counters_lock:
+        stats.update(_geocode_counters)
+    return stats
+
+
+def _fetch_coordinates(address, deadline=None):
+    """
+    Geocoding APIを呼び出して ("緯度,経度" または None, キャッシュしてよいか) を返す (キャッシュなし)。
+    キャッシュしてよい失敗は ZERO_RESULTS (地名が見つからない) だけで、タイムアウト・回路遮断・
+    OVER_QUERY_LIMIT などの一時的な失敗は保存しない (全員の location_bias が10分間無効にならないように)。
+    """
+    geocode_url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/geocode/json"
+    params = {
+        "address": address,
+        "key": os.getenv("GOOGLE_PLACES_API_KEY"),
+        "language": "ja",
+        "region": "JP"
+    }
+    try:
+        results = get_json("geocode", geocode_url, params=params, deadline=deadline)
+        if results["status"] == "OK" and results["results"]:
+            location = results["results"][0]["geometry"]["location"]
+            return f"{location['lat']},{location['lng']}", True
+        else:
+            print(f"Geocoding失敗: {results.get('status')}, {results.get('error_message', '')}")
+            return None, results.get("status") in ("OK", "ZERO_RESULTS")
+    except Exception as e:
+        print(f"Geocodingエラー: {e}")
+        return None, False
+
+
+def get_coordinates(address, deadline=None):
+    """
+    住所・地名から "緯度,経度" を返す。見つからなければ None。
+    プロセス内キャッシュ → SQLiteキャッシュ → Geocoding API の順に引く。
+    deadline: APIを呼ぶ場合の期限 (time.monotonic() の値。okosy_http.get_json を参照)
+    """
+    address_key = normalize_text(address)
+    if not address_key:
+        return None
+
+    with span("geocode", address=address_key) as current:
+        coords = _geocode_memory_cache.get(address_key)
+        if coords is not MISSING:
+            current.set(cache="memory")
+            return coords
+
+        coords, remaining_ttl = _load_geocode_from_db(address_key)
+        if coords is not MISSING:
+            current.set(cache="db")
+            with _geocode_counters_lock:
+                _geocode_counters["db_hits"] += 1
+            _geocode_memory_cache.set(address_key, coords, ttl=remaining_ttl)
+            return coords
+
+        current.set(cache="miss")
+        with _geocode_counters_lock:
+            _geocode_counters["api_calls"] += 1
+        coords, cacheable = _fetch_coordinates(address, deadline)
+        current.set(cacheable=cacheable)
+        if cacheable:
+            _store_geocode(address_key, coords)
+        return coords
+
+
+# --- Places Text Search のキャッシュ設定 ---
+# キャッシュするのはフィルタ前の生の results なので、min_rating / price_levels だけが
+# 異なるリクエストは同じ上流レスポンスから応答できる
+PLACES_CACHE_TTL = float(os.getenv("OKOSY_PLACES_CACHE_TTL", 6 * 3600))
+PLACES_CACHE_SIZE = int(os.getenv("OKOSY_PLACES_CACHE_SIZE", 1024))
+PLACES_SEARCH_RADIUS = 20000
+
+# --- 蓄積した場所の位置索引から答える設定 ---
+# 同じ種類・検索語・地点(約10kmの格子)を最後にAPIで検索してから PLACES_COVERAGE_TTL 以内なら、
+# その検索で返った場所を索引の最新の評価・価格帯で絞り込んで返す (APIを呼ばない)
+PLACES_LOCAL_ENABLED = os.getenv("OKOSY_PLACES_LOCAL", "1") != "0"
+PLACES_COVERAGE_TTL = float(os.getenv("OKOSY_PLACES_COVERAGE_TTL", 7 * 24 * 3600))
+
+_places_cache = TTLCache(maxsize=PLACES_CACHE_SIZE, ttl=PLACES_CACHE_TTL)
+_places_single_flight = SingleFlight()
+_places_counters = {"api_calls": 0, "local_hits": 0, "local_misses": 0}
+_places_counters_lock = threading.Lock()
+_places_local_latency = LatencyHistogram()
+
+
+def normalize_location_bias(location_bias):
+    """"緯度,経度" を小数点以下3桁(約100m)に丸める。解釈できなければ None"""
+    if not location_bias:
+        return None
+    try:
+        lat, lng = [float(x) for x in str(location_bias).split(",")]
+    except ValueError:
+        print(f"location_bias の解析エラー: {location_bias}")
+        return None
+    return f"{lat:.3f},{lng:.3f}"
+
+
+def get_places_cache_stats():
+    """Placesキャッシュのヒット率・上流呼び出し数・まとめられた同時リクエスト数を返す"""
+    stats = _places_cache.stats()
+    with _places_counters_lock:
+        stats.update(_places_counters)
+    stats["coalesced"] = _places_single_flight.coalesced
+    local_total = stats["local_hits"] + stats["local_misses"]
+    stats["local_hit_ratio"] = (stats["local_hits"] / local_total) if local_total else 0.0
+    stats["local_latency"] = _places_local_latency.snapshot()
+    return stats
+
+
+def _fetch_places_raw(query, location_bias, place_type, deadline=None):
+    """
+    Places Text Search APIを呼び出し、フィルタ前のレスポンス
+    {"status", "results", "error_message"} を返す (HTTPエラーは例外)
+    """
+    with _places_counters_lock:
+        _places_counters["api_calls"] += 1
+    base_url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/textsearch/json"
+    params = {
+        "query": query,
+        "key": os.getenv("GOOGLE_PLACES_API_KEY"),
+        "language": "ja",
+        "region": "JP",
+        "type": place_type,
+    }
+    if location_bias:
+        params["location"] = location_bias
+        params["radius"] = PLACES_SEARCH_RADIUS
+    sampled_log("Places リクエストパラメータ", {k: v for k, v in params.items() if k != "key"})
+    results = get_json("places_textsearch", base_url, params=params, deadline=deadline)
+    return {
+        "status": results.get("status"),
+        "results": results.get("results", []),
+        "error_message": results.get("error_message", ""),
+    }
+
+
+def search_places_raw(query, location_bias=None, place_type="tourist_attraction", deadline=None):
+    """
+    キャッシュ付きで生の検索結果を返す。
+    キーは正規化した (query, location_bias, place_type)。
+    同じキーの同時リクエストは1回の上流呼び出しにまとめる (期限は最初に呼び出したものに従う)。
+    """
+    location_bias = normalize_location_bias(location_bias)
+    cache_key = (normalize_text(query), location_bias, place_type)
+    with span("places.search", query=cache_key[0], place_type=place_type) as current:
+        cached = _places_cache.get(cache_key)
+        if cached is not MISSING:
+            current.set(cache="hit")
+            return cached
+        current.set(cache="miss")
+
+        def fetch():
+            # 待っている間に別スレッドが保存した可能性があるので再確認する
+            cached = _places_cache.get(cache_key, count=False)
+            if cached is not MISSING:
+                return cached
+            current.set(upstream=True) # upstream が無いミスは同時リクエストにまとめられたもの
+            raw = _fetch_places_raw(query, location_bias, place_type, deadline)
+            # 正常応答(結果0件を含む)のみキャッシュする。クォータ超過などは毎回問い合わせる
+            if raw["status"] in ("OK", "ZERO_RESULTS"):
+                _places_cache.set(cache_key, raw)
+                _index_raw_places(raw["results"], location_bias, place_type, cache_key[0])
+            return raw
+
+        raw = _places_single_flight.do(cache_key, fetch)
+        current.set(status=raw["status"], result_count=len(raw["results"]))
+        return raw
+
+
+def _index_raw_places(raw_places, location_bias, place_type, query):
+    """APIの検索結果を位置索引に保存し、検索した地点の格子をその検索語で検索済みとして記録する"""
+    center = tuple(float(x) for x in location_bias.split(",")) if location_bias else None
+    try:
+        with db_connection() as conn:
+            index_seen_places(conn.cursor(), raw_places, place_type, center, query)
+    except Exception as e:
+        print(f"場所の位置索引への保存エラー: {e}")
+
+
+def search_places_local(query, location_bias, place_type, min_rating=4.0, price_levels=None, limit=5):
+    """
+    同じ検索語・種類・地点の検索済みの記録があれば、その検索で返った場所のうち location_bias の
+    半径 PLACES_SEARCH_RADIUS 以内で条件に合うものを filter_places と同じ形式で返す (0件なら空のリスト)。
+    未検索・記録が古い場合は None (APIで検索する)。
+    """
+    location_bias = normalize_location_bias(location_bias)
+    if not PLACES_LOCAL_ENABLED or not location_bias:
+        return None
+    lat, lng = (float(x) for x in location_bias.split(","))
+    query = normalize_text(query)
+    with span("places.local", query=query, place_type=place_type) as current:
+        start = time.perf_counter()
+        with db_connection() as conn:
+            coverage = query_coverage(conn, place_type, query, lat, lng)
+            if coverage is None or time.time() - coverage[0] > PLACES_COVERAGE_TTL:
+                result, places = "local_misses", None
+            else:
+                places = nearby_places(conn, lat, lng, PLACES_SEARCH_RADIUS, place_type, min_rating,
+                                       _parse_price_levels(price_levels), limit, place_ids=coverage[1])
+                result = "local_hits"
+        _places_local_latency.record((time.perf_counter() - start) * 1000)
+        with _places_counters_lock:
+            _places_counters[result] += 1
+        current.set(result=result, result_count=len(places) if places is not None else None)
+        if places is None:
+            return None
+        return [{key: place[key] for key in ("name", "address", "rating", "price_level", "types", "place_id")}
+                for place in places]
+
+
+def _parse_price_levels(price_levels):
+    """"1,2" のような価格帯の指定をリストにする。指定なし・解析できない場合は None (絞り込まない)"""
+    if not price_levels:
+        return None
+    try:
+        return [int(x.strip()) for x in price_levels.split(',')]
+    except ValueError:
+        print(f"価格レベルの解析エラー: {price_levels}")
+        return None
+
+
+def filter_places(raw_places, min_rating=4.0, price_levels=None, limit=5):
+    """評価・価格帯で絞り込み、表示・保存用の辞書リストに整形する"""
+    allowed_levels = _parse_price_levels(price_levels)
+    filtered_places = []
+    for place in raw_places:
+        place_rating = place.get("rating", 0)
+        place_price = place.get("price_level", None)
+        if place_rating < min_rating: continue
+        if allowed_levels is not None and place_price not in allowed_levels: continue
+        filtered_places.append({
+            "name": place.get("name"), "address": place.get("formatted_address"),
+            "rating": place_rating, "price_level": place_price,
+            "types": place.get("types", []), "place_id": place.get("place_id"),
+        })
+        if len(filtered_places) >= limit: break
+    return filtered_places
+
+
+def search_google_places(query: str,
+                         location_bias: str = None,
+                         place_type: str = "tourist_attraction",
+                         min_rating: float = 4.0,
+                         price_levels: str = None,
+                         deadline: float = None):
+    try:
+        # 以前に同じ検索をした地域は、蓄積した場所の位置索引から答える (APIを呼ばない)
+        local_places = search_places_local(query, location_bias, place_type, min_rating, price_levels)
+        if local_places is not None:
+            if not local_places:
+                return json.dumps({"error": "条件に合致する場所がありませんでした。"}, ensure_ascii=False)
+            return json.dumps(local_places, ensure_ascii=False)
+        results = search_places_raw(query, location_bias, place_type, deadline)
+        status = results.get("status")
+        if status == "OK":
+            filtered_places = filter_places(results.get("results", []), min_rating, price_levels)
+            if not filtered_places:
+                return json.dumps({"error": "条件に合致する場所がありませんでした。"}, ensure_ascii=False)
+            return json.dumps(filtered_places, ensure_ascii=False)
+        else:
+            error_msg = results.get('error_message', '')
+            print(f"Google Places API エラー: {status}, {error_msg}")
+            return json.dumps({"error": f"Google Places API Error: {status}, {error_msg}"}, ensure_ascii=False)
+    except Exception as e:
+        print(f"HTTPリクエストエラー: {e}")
+        return json.dumps({"error": f"HTTPエラー: {e}"}, ensure_ascii=False)
+
+
+# --- Place Details / Place Photo (表示用の詳細情報。キャッシュは okosy_media.py) ---
+# 場所カードと地図に使う項目だけを取得する (フィールド数で料金が変わるため)
+PLACE_DETAILS_FIELDS = ",".join([
+    "place_id", "name", "formatted_address", "geometry/location", "rating", "user_ratings_total",
+    "price_level", "opening_hours/weekday_text", "website", "url", "formatted_phone_number", "photos",
+])
+
+
+def fetch_place_details(place_id):
+    """
+    Place Details APIを呼び出し、表示用に整形した辞書を返す (キャッシュなし)。
+    {"place_id", "name", "address", "lat", "lng", "rating", "user_ratings_total", "price_level",
+     "opening_hours", "website", "url", "phone", "photo_reference"}
+    見つからない場合は None、HTTPエラーは例外。
+    """
+    params = {
+        "place_id": place_id,
+        "fields": PLACE_DETAILS_FIELDS,
+        "key": os.getenv("GOOGLE_PLACES_API_KEY"),
+        "language": "ja",
+        "region": "JP",
+    }
+    data = get_json("place_details", f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/details/json", params=params)
+    if data.get("status") != "OK":
+        print(f"Place Details 取得失敗 ({place_id}): {data.get('status')}, {data.get('error_message', '')}")
+        return None
+    result = data.get("result") or {}
+    location = (result.get("geometry") or {}).get("location") or {}
+    photos = result.get("photos") or []
+    return {
+        "place_id": result.get("place_id") or place_id,
+        "name": result.get("name"),
+        "address": result.get("formatted_address"),
+        "lat": location.get("lat"),
+        "lng": location.get("lng"),
+        "rating": result.get("rating"),
+        "user_ratings_total": result.get("user_ratings_total"),
+        "price_level": result.get("price_level"),
+        "opening_hours": (result.get("opening_hours") or {}).get("weekday_text") or [],
+        "website": result.get("website"),
+        "url": result.get("url"),
+        "phone": result.get("formatted_phone_number"),
+        "photo_reference": photos[0].get("photo_reference") if photos else None,
+    }
+
+
+def fetch_place_photo(photo_reference, max_width=400):
+    """Place Photo APIから写真を1枚取得し、(バイト列, Content-Type) を返す (キャッシュなし)"""
+    params = {
+        "photo_reference": photo_reference,
+        "maxwidth": max_width,
+        "key": os.getenv("GOOGLE_PLACES_API_KEY"),
+    }
+    return get_bytes("place_photo", f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/photo", params=params)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Google APIs 向けの共通HTTPクライアント。
+- コネクションプール付きの共有 requests.Session (keep-alive)
+- 接続/読み込みタイムアウト
+- 5xx / OVER_QUERY_LIMIT に対するジッター付き指数バックオフでのリトライ
+- 呼び出し全体の期限 (deadline)。リトライ・待ち時間・タイムアウトを期限内に収める
+- エンドポイント毎のサーキットブレーカーとレイテンシヒストグラム
+"""
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from okosy_trace import LatencyHistogram, span
+
+# --- 設定 (環境変数で上書き可能) ---
+CONNECT_TIMEOUT = float(os.getenv("OKOSY_HTTP_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("OKOSY_HTTP_READ_TIMEOUT", 10))
+MAX_RETRIES = int(os.getenv("OKOSY_HTTP_MAX_RETRIES", 3))
+BACKOFF_BASE = float(os.getenv("OKOSY_HTTP_BACKOFF_BASE", 0.5))
+BACKOFF_MAX = float(os.getenv("OKOSY_HTTP_BACKOFF_MAX", 8))
+POOL_MAXSIZE = int(os.getenv("OKOSY_HTTP_POOL_MAXSIZE", 32))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("OKOSY_HTTP_BREAKER_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("OKOSY_HTTP_BREAKER_RESET", 30))
+
+# リトライ対象のHTTPステータスとGoogle APIのレスポンス内ステータス
+RETRY_HTTP_STATUSES = {500, 502, 503, 504}
+RETRY_API_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているためリクエストを送らなかったことを表す"""
+
+
+class DeadlineExceededError(Exception):
+    """呼び出し全体の期限を過ぎたためリクエストを送らなかったことを表す"""
+
+
+class CircuitBreaker:
+    """
+    連続失敗が閾値を超えたら一定時間リクエストを遮断する。
+    遮断時間が過ぎたら1件だけ試行(half-open)し、成功すれば元に戻す。
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._half_open_trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """リクエストを送ってよいか判定する"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            if self._half_open_trial:
+                return False
+            self._half_open_trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._half_open_trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._half_open_trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._half_open_trial = False
+
+
+# --- プロセス内で共有するセッション・統計 ---
+_session = None
+_session_lock = threading.Lock()
+_histograms = {}
+_breakers = {}
+_retry_counts = {}
+_registry_lock = threading.Lock()
+
+
+def get_session():
+    """コネクションプール付きの共有Sessionを返す (初回呼び出し時に作成)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def _get_endpoint_state(endpoint):
+    with _registry_lock:
+        if endpoint not in _histograms:
+            _histograms[endpoint] = LatencyHistogram()
+            _breakers[endpoint] = CircuitBreaker()
+            _retry_counts[endpoint] = 0
+        return _histograms[endpoint], _breakers[endpoint]
+
+
+def _backoff_delay(attempt):
+    """ジッター付き指数バックオフの待ち時間 (full jitter)"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def _clamp_timeout(timeout, remaining):
+    """(接続, 読み込み) のタイムアウトを期限までの残り時間以下にする"""
+    if isinstance(timeout, tuple):
+        return tuple(min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def get_json(endpoint, url, params=None, timeout=None, max_retries=None, deadline=None):
+    """
+    GETしてJSONを返す。endpoint は統計とサーキットブレーカーの単位になる名前。
+    5xx・通信エラー・OVER_QUERY_LIMIT はリトライし、リトライし尽くしたら
+    例外を送出する (APIステータスの場合は最後のレスポンスをそのまま返す)。
+    deadline: 呼び出し全体の期限 (time.monotonic() の値)。期限までに終わらないリトライはせず、
+              各試行のタイムアウトも残り時間までに縮める。最初の試行の前に過ぎていれば DeadlineExceededError
+    """
+    with span(f"google.{endpoint}") as current:
+        return _get(current, endpoint, url, params, timeout, max_retries, lambda response: response.json(), deadline)
+
+
+def get_bytes(endpoint, url, params=None, timeout=None, max_retries=None, deadline=None):
+    """
+    GETして (本文のバイト列, Content-Type) を返す (Place Photo などの画像用)。
+    リトライ・サーキットブレーカー・期限・統計は get_json と共通。
+    """
+    with span(f"google.{endpoint}") as current:
+        response = _get(current, endpoint, url, params, timeout, max_retries, lambda response: response, deadline)
+        current.set(bytes=len(response.content))
+        return response.content, response.headers.get("Content-Type", "")
+
+
+def _get(current, endpoint, url, params, timeout, max_retries, decode, deadline=None):
+    histogram, breaker = _get_endpoint_state(endpoint)
+    if deadline is not None and deadline <= time.monotonic():
+        current.set(deadline_exceeded=True)
+        raise DeadlineExceededError(f"{endpoint} の呼び出しの期限を過ぎています")
+    if not breaker.allow():
+        current.set(breaker="open")
+        raise CircuitOpenError(f"{endpoint} へのリクエストを一時停止中です (サーキットブレーカー作動中)")
+
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    session = get_session()
+    attempt = 0
+    while True:
+        current.set(retries=attempt)
+        attempt_timeout = timeout
+        if deadline is not None:
+            attempt_timeout = _clamp_timeout(timeout, max(deadline - time.monotonic(), 0.001))
+        # 次の試行の前に待つ時間。期限までに待ち終わらないなら、これを最後の試行にする
+        delay = _backoff_delay(attempt)
+        start = time.perf_counter()
+        try:
+            response = session.get(url, params=params, timeout=attempt_timeout)
+            current.set(http_status=response.status_code)
+            response.raise_for_status()
+            data = decode(response)
+        except requests.RequestException as e:
+            histogram.record((time.perf_counter() - start) * 1000)
+            last_attempt = attempt >= max_retries or _out_of_time(deadline, delay)
+            status_code = getattr(getattr(e, "response", None), "status_code", None)
+            if status_code is not None and status_code not in RETRY_HTTP_STATUSES:
+                # 4xx などはリトライしても結果が変わらない。上流は生きているので失敗には数えない
+                breaker.record_success()
+                raise
+            if last_attempt:
+                breaker.record_failure()
+                raise
+            print(f"HTTPリトライ ({endpoint}, {attempt + 1}/{max_retries}): {e}")
+        else:
+            histogram.record((time.perf_counter() - start) * 1000)
+            api_status = data.get("status") if isinstance(data, dict) else None
+            current.set(api_status=api_status)
+            if api_status not in RETRY_API_STATUSES:
+                breaker.record_success()
+                return data
+            if attempt >= max_retries or _out_of_time(deadline, delay):
+                breaker.record_failure()
+                return data
+            print(f"APIリトライ ({endpoint}, {attempt + 1}/{max_retries}): {api_status}")
+
+        with _registry_lock:
+            _retry_counts[endpoint] += 1
+        time.sleep(delay)
+        attempt += 1
+
+
+def _out_of_time(deadline, delay):
+    """待ってから再試行すると期限を過ぎるか"""
+    return deadline is not None and time.monotonic() + delay >= deadline
+
+
+def get_http_stats():
+    """エンドポイント毎のレイテンシ・リトライ回数・ブレーカー状態を返す"""
+    with _registry_lock:
+        endpoints = list(_histograms)
+    stats = {}
+    for endpoint in endpoints:
+        histogram, breaker = _get_endpoint_state(endpoint)
+        stats[endpoint] = histogram.snapshot()
+        stats[endpoint]["retries"] = _retry_counts[endpoint]
+        stats[endpoint]["breaker"] = breaker.state
+    return stats
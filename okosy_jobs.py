@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+しおり生成のバックグラウンドジョブ。
+Streamlitはウィジェット操作の度にスクリプトを再実行するため、生成をスクリプトのスレッドで行うと
+途中のリランで結果が失われ、同じ生成に二重にAPI料金を払うことになる。
+ここでは生成をプロセス内のワーカースレッドで実行し、状態を generation_jobs テーブルに保存する。
+画面側はジョブIDをセッションに持ち、リランされても同じジョブの完了を待つ。
+
+- 同じ条件 (itinerary_cache_key) の実行待ち・実行中ジョブがあれば、新しく作らずそのIDを返す
+- 実行待ちが上限に達していたら受け付けない (JobQueueFullError)
+- OpenAIのレート制限に当たったらワーカーの取り出しを一時停止し、ジョブを待ち行列に戻す
+- プロセスの再起動で中断されたジョブは、起動時に待ち行列へ戻す
+- LONG_TRIP_MIN_DAYS 日以上の旅行は、日毎に並列で生成して結合する (run_long_trip_generation)。
+  一部の日を作成できなかった結果は partial として返し、同じ条件のリクエストに使い回さない
+- 管理画面からのバックアップ(アーカイブの書き出し)も同じ仕組みのジョブとして実行する (submit_archive_export)
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from okosy_agent import (ERROR_REPLIES, LONG_TRIP_MIN_DAYS, RATE_LIMIT_REPLY, run_conversation_with_function_calling,
+                          run_long_trip_generation)
+from okosy_archive import export_archive
+from okosy_cache import itinerary_cache
+from okosy_db import db_connection
+from okosy_prompt import build_itinerary_messages
+from okosy_trace import begin_trace, current_span, end_trace
+
+# --- ジョブキューの設定 ---
+GENERATION_WORKERS = int(os.getenv("OKOSY_GENERATION_WORKERS", 4))
+MAX_PENDING_JOBS = int(os.getenv("OKOSY_MAX_PENDING_JOBS", 32))          # 実行待ちの上限 (超えたら受け付けない)
+MAX_JOB_ATTEMPTS = int(os.getenv("OKOSY_JOB_MAX_ATTEMPTS", 3))          # レート制限時の再試行を含めた実行回数の上限
+RATE_LIMIT_BACKOFF = float(os.getenv("OKOSY_RATE_LIMIT_BACKOFF", 5))     # レート制限時の一時停止(秒)。連続すると倍々に延ばす
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("OKOSY_RATE_LIMIT_BACKOFF_MAX", 60))
+JOB_RETENTION_DAYS = int(os.getenv("OKOSY_JOB_RETENTION_DAYS", 7))       # 終了したジョブを残す日数
+PARTIAL_FLUSH_INTERVAL = 1.0 # 生成途中の本文をDBに書き込む間隔(秒)
+
+# partial: 一部の日を作成できなかった長期旅行 (結果は返すがキャッシュしない)
+FINISHED_STATUSES = ("succeeded", "partial", "failed")
+ARCHIVE_EXPORT_JOB_KEY = "archive_export" # バックアップのジョブは1つずつ実行する (実行中なら合流する)
+
+
+class JobQueueFullError(Exception):
+    """実行待ちのジョブが上限に達していて受け付けられないことを表す"""
+
+
+class _LiveJob:
+    """実行中ジョブの途中経過。画面への反映用にメモリに持ち、DBへは間引いて書き込む"""
+
+    def __init__(self, status="queued", progress=None):
+        self.status = status
+        self.progress = progress
+        self.parts = []
+        self.version = 0
+        self.last_flush = 0.0
+
+
+class GenerationJobManager:
+    """しおり生成ジョブのワーカープール (プロセス内で1つ作る)"""
+
+    def __init__(self, client, workers=GENERATION_WORKERS, max_pending=MAX_PENDING_JOBS, stream=True):
+        self.client = client
+        self.max_pending = max_pending
+        self.stream = stream
+        self._queue = queue.Queue()
+        self._live = {}  # job_id -> _LiveJob (実行待ち・実行中のもの)
+        self._changed = threading.Condition()
+        self._submit_lock = threading.Lock()
+        # レート制限による停止は全ワーカーで共有するので、読み書きは _rate_limit_lock の中で行う
+        self._rate_limit_lock = threading.Lock()
+        self._paused_until = 0.0
+        self._rate_limit_streak = 0
+        self._recover()
+        for index in range(workers):
+            threading.Thread(target=self._worker, name=f"okosy-generation-{index}", daemon=True).start()
+
+    # --- 画面側から使うメソッド ---
+
+    def submit(self, job_key, request):
+        """
+        ジョブを投入してIDを返す。同じ job_key の実行待ち・実行中ジョブがあればそのIDを返す。
+        request: {"dest", "purp", "comp", "days", "budg", "preferences"}
+        """
+        with self._submit_lock:
+            with db_connection() as conn:
+                row = conn.execute(
+                    "SELECT id FROM generation_jobs WHERE job_key = ? AND status IN ('queued', 'running') ORDER BY created_at LIMIT 1",
+                    (job_key,)
+                ).fetchone()
+                if row:
+                    print(f"同じ条件の生成ジョブに合流します: {row[0]}")
+                    return row[0]
+                if self._queue.qsize() >= self.max_pending:
+                    raise JobQueueFullError("ただいま混み合っています。しばらくしてから再度お試しください。")
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO generation_jobs (id, job_key, status, request) VALUES (?, ?, 'queued', ?)",
+                    (job_id, job_key, json.dumps(request, ensure_ascii=False))
+                )
+            with self._changed:
+                self._live[job_id] = _LiveJob()
+        self._queue.put(job_id)
+        return job_id
+
+    def submit_archive_export(self, path, include_photos=True):
+        """
+        アーカイブの書き出しジョブを投入してIDを返す。書き出し中のジョブがあればそのIDを返す。
+        完了したジョブの result_content は件数の辞書(JSON)。
+        """
+        return self.submit(ARCHIVE_EXPORT_JOB_KEY, {"kind": "archive_export", "path": path,
+                                                     "include_photos": include_photos})
+
+    def get(self, job_id):
+        """
+        ジョブの状態を辞書で返す (見つからなければ None)。
+        {"id", "status", "progress", "partial_content", "result_content", "places_data", "error", "version"}
+        """
+        with self._changed:
+            live = self._live.get(job_id)
+            if live is not None:
+                return {
+                    "id": job_id, "status": live.status, "progress": live.progress,
+                    "partial_content": "".join(live.parts), "result_content": None,
+                    "places_data": None, "error": None, "version": live.version,
+                }
+        with db_connection() as conn:
+            row = conn.execute(
+                "SELECT status, progress, partial_content, result_content, places_data, error FROM generation_jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        status, progress, partial_content, result_content, places_data, error = row
+        return {
+            "id": job_id, "status": status, "progress": progress, "partial_content": partial_content,
+            "result_content": result_content, "places_data": places_data, "error": error, "version": -1,
+        }
+
+    def wait(self, job_id, version, timeout=1.0):
+        """ジョブの状態が version から変わる (または終了する) まで最大 timeout 秒待つ"""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._live or self._live[job_id].version != version, timeout=timeout)
+
+    def stats(self):
+        """実行待ち・実行中の件数と、レート制限による停止の残り秒数を返す"""
+        with self._changed:
+            running = sum(1 for live in self._live.values() if live.status == "running")
+        return {
+            "pending": self._queue.qsize(),
+            "running": running,
+            "paused_seconds": max(0.0, self._pause_remaining()),
+        }
+
+    # --- ワーカー ---
+
+    def _recover(self):
+        """前回のプロセスで終わらなかったジョブを待ち行列に戻し、古いジョブを削除する"""
+        with db_connection() as conn:
+            conn.execute(
+                "DELETE FROM generation_jobs WHERE status IN ('succeeded', 'partial', 'failed') AND finished_at < datetime('now', ?)",
+                (f"-{JOB_RETENTION_DAYS} days",)
+            )
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM generation_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            )]
+            conn.execute(
+                "UPDATE generation_jobs SET status = 'queued', partial_content = NULL, updated_at = CURRENT_TIMESTAMP WHERE status = 'running'"
+            )
+        for job_id in job_ids:
+            self._live[job_id] = _LiveJob(progress="再開を待っています")
+            self._queue.put(job_id)
+        if job_ids:
+            print(f"中断されていた生成ジョブを {len(job_ids)} 件再開します")
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            # レート制限中は取り出しを止めて上流の回復を待つ
+            pause = self._pause_remaining()
+            if pause > 0:
+                time.sleep(pause)
+            try:
+                self._run(job_id)
+            except Exception as e:
+                print(f"生成ジョブの実行中にエラーが発生しました ({job_id}): {e}")
+                self._finish(job_id, "failed", error=f"予期せぬエラーが発生しました: {e}")
+
+    def _run(self, job_id):
+        with db_connection() as conn:
+            row = conn.execute(
+                "SELECT job_key, request, attempts FROM generation_jobs WHERE id = ? AND status IN ('queued', 'running')",
+                (job_id,)
+            ).fetchone()
+            if row is None:
+                return
+            conn.execute(
+                "UPDATE generation_jobs SET status = 'running', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (job_id,)
+            )
+        job_key, request, attempts = row[0], json.loads(row[1]), row[2] + 1
+        if request.get("kind") == "archive_export":
+            self._run_archive_export(job_id, request)
+            return
+        self._update(job_id, status="running", progress="AIが旅のしおりを作成しています...")
+
+        on_token = (lambda token: self._append_token(job_id, token)) if self.stream else None
+        trace = begin_trace("generation.job", job_id=job_id, attempt=attempts, days=request["days"])
+        failed_days = []
+        try:
+            if int(request["days"]) >= LONG_TRIP_MIN_DAYS:
+                # 完成した日の本文を積み上げて表示するので、進捗の更新では途中テキストを捨てない
+                content, places_data, failed_days = run_long_trip_generation(
+                    self.client, request,
+                    on_progress=lambda message: self._update(job_id, progress=message),
+                    on_token=on_token)
+            else:
+                messages, preference_tokens_saved = build_itinerary_messages(
+                    request["dest"], request["purp"], request["comp"], request["days"], request["budg"],
+                    request["preferences"])
+                current_span().set(preference_tokens_saved=preference_tokens_saved)
+                content, places_data = run_conversation_with_function_calling(
+                    self.client, messages, dest=request["dest"],
+                    on_progress=lambda message: self._update(job_id, progress=message, clear_parts=True),
+                    on_token=on_token)
+        finally:
+            end_trace(trace)
+
+        if content == RATE_LIMIT_REPLY and attempts < MAX_JOB_ATTEMPTS:
+            self._pause_for_rate_limit()
+            self._requeue(job_id)
+            return
+        if content and content not in ERROR_REPLIES and failed_days:
+            self._reset_rate_limit()
+            self._finish(job_id, "partial", result_content=content, places_data=places_data,
+                         error=f"{', '.join(str(day) for day in failed_days)}日目の提案を作成できませんでした。")
+        elif content and content not in ERROR_REPLIES:
+            self._reset_rate_limit()
+            itinerary_cache.set(job_key, (content, places_data))
+            self._finish(job_id, "succeeded", result_content=content, places_data=places_data)
+        else:
+            self._finish(job_id, "failed", error=content or "しおりの生成中にエラーが発生しました。")
+
+    def _run_archive_export(self, job_id, request):
+        self._update(job_id, status="running", progress="バックアップを作成しています...")
+        trace = begin_trace("archive.export", job_id=job_id, include_photos=request["include_photos"])
+        try:
+            counts = export_archive(request["path"], include_photos=request["include_photos"],
+                                    on_progress=lambda message: self._update(job_id, progress=message))
+        finally:
+            end_trace(trace)
+        self._finish(job_id, "succeeded", result_content=json.dumps(counts, ensure_ascii=False))
+
+    def _pause_remaining(self):
+        with self._rate_limit_lock:
+            return self._paused_until - time.monotonic()
+
+    def _reset_rate_limit(self):
+        with self._rate_limit_lock:
+            self._rate_limit_streak = 0
+
+    def _pause_for_rate_limit(self):
+        with self._rate_limit_lock:
+            self._rate_limit_streak += 1
+            delay = min(RATE_LIMIT_BACKOFF_MAX, RATE_LIMIT_BACKOFF * (2 ** (self._rate_limit_streak - 1)))
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        print(f"OpenAIのレート制限のため生成ジョブの実行を {delay:.1f} 秒停止します")
+
+    def _requeue(self, job_id):
+        progress = "混み合っているため順番を待っています..."
+        with db_connection() as conn:
+            conn.execute(
+                "UPDATE generation_jobs SET status = 'queued', progress = ?, partial_content = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (progress, job_id)
+            )
+        self._update(job_id, status="queued", progress=progress, clear_parts=True)
+        self._queue.put(job_id)
+
+    def _update(self, job_id, status=None, progress=None, clear_parts=False):
+        with self._changed:
+            live = self._live.setdefault(job_id, _LiveJob())
+            if status is not None:
+                live.status = status
+            if progress is not None:
+                live.progress = progress
+            if clear_parts:
+                live.parts.clear() # ツール呼び出し前の途中テキストは捨てる
+            live.version += 1
+            self._changed.notify_all()
+        if progress is not None:
+            with db_connection() as conn:
+                conn.execute(
+                    "UPDATE generation_jobs SET progress = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (progress, job_id)
+                )
+
+    def _append_token(self, job_id, token):
+        with self._changed:
+            live = self._live[job_id]
+            live.parts.append(token)
+            live.version += 1
+            self._changed.notify_all()
+            now = time.monotonic()
+            flush = now - live.last_flush >= PARTIAL_FLUSH_INTERVAL
+            if flush:
+                live.last_flush = now
+                partial_content = "".join(live.parts)
+        if flush:
+            with db_connection() as conn:
+                conn.execute(
+                    "UPDATE generation_jobs SET partial_content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (partial_content, job_id)
+                )
+
+    def _finish(self, job_id, status, result_content=None, places_data=None, error=None):
+        with db_connection() as conn:
+            conn.execute(
+                '''UPDATE generation_jobs
+                   SET status = ?, result_content = ?, places_data = ?, error = ?, partial_content = NULL,
+                       finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = ?''',
+                (status, result_content, places_data, error, job_id)
+            )
+        with self._changed:
+            self._live.pop(job_id, None)
+            self._changed.notify_all()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+場所の詳細情報と写真のローカルキャッシュ。
+しおりの場所カードと地図はここに保存したデータだけで描画し、表示の度に
+Place Details / Place Photo APIを呼ばない。
+
+- search_google_places の結果が出たら、place_id 毎の詳細と写真1枚を裏で並列に取得しておく
+- 詳細は place_media テーブルに、写真は place_id のハッシュをファイル名にしたディレクトリに保存する
+- TTLを過ぎたものは次の先読みで取り直す (表示には期限切れでも手元のデータを使う)
+- 写真の合計サイズが上限を超えたら、最後に表示されてから長い場所の写真から削除する (詳細は残す)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from okosy_db import db_connection
+from okosy_google import fetch_place_details, fetch_place_photo
+from okosy_trace import span
+
+# --- メディアキャッシュの設定 ---
+MEDIA_CACHE_DIR = os.getenv("OKOSY_MEDIA_DIR", "okosy_media")
+MEDIA_CACHE_MAX_BYTES = int(float(os.getenv("OKOSY_MEDIA_CACHE_MAX_MB", 200)) * 1024 * 1024)
+PLACE_MEDIA_TTL = float(os.getenv("OKOSY_PLACE_MEDIA_TTL", 7 * 24 * 3600))          # 取得できた場所: 7日
+PLACE_MEDIA_NEGATIVE_TTL = float(os.getenv("OKOSY_PLACE_MEDIA_NEGATIVE_TTL", 3600))  # 取得できなかった場所: 1時間
+PREFETCH_ENABLED = os.getenv("OKOSY_MEDIA_PREFETCH", "1") != "0"
+PREFETCH_WORKERS = int(os.getenv("OKOSY_MEDIA_PREFETCH_WORKERS", 4))
+PLACE_PHOTO_MAX_WIDTH = 400 # 場所カードは幅200前後で表示するので高解像度ディスプレイ向けに2倍
+
+_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="okosy-media")
+_in_flight = set()  # 取得中の place_id (同じ場所を同時に2回取りに行かない)
+_in_flight_lock = threading.Lock()
+_evict_lock = threading.Lock()
+_counters = {"fetched": 0, "fresh": 0, "failed": 0, "evicted": 0}
+_counters_lock = threading.Lock()
+
+
+def media_abspath(relative_path):
+    """DBに保存している相対パスを実際のファイルパスに変換する"""
+    return os.path.join(MEDIA_CACHE_DIR, relative_path)
+
+
+def _count(name, n=1):
+    with _counters_lock:
+        _counters[name] += n
+
+
+def _write_atomic(path, data):
+    """一時ファイルに書いてからリネームし、途中まで書かれたファイルが見えないようにする"""
+    # okosy_photos にも同じものがあるが、あちらは PIL を読み込むので生成処理からは使わない
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _remove_file(relative_path):
+    if not relative_path:
+        return
+    try:
+        os.remove(media_abspath(relative_path))
+    except FileNotFoundError:
+        pass
+
+
+# --- 先読み ---
+
+def _fetch_and_store(place_id):
+    """
+    1件の場所の詳細と写真を取得して保存する (例外はここで握りつぶす)。
+    取得に失敗した場合は保存済みのデータを残したまま、次に取り直すまでの期限だけ短いTTLで延ばす。
+    """
+    with span("media.fetch", place_id=place_id) as current:
+        details, photo_path, photo_bytes = None, None, 0
+        try:
+            details = fetch_place_details(place_id)
+        except Exception as e:
+            print(f"場所の詳細の取得エラー ({place_id}): {e}")
+        if details and details.get("photo_reference"):
+            try:
+                content, content_type = fetch_place_photo(details["photo_reference"], PLACE_PHOTO_MAX_WIDTH)
+                extension = _EXTENSIONS.get(content_type.split(";")[0].strip().lower())
+                if extension and content:
+                    digest = hashlib.sha256(place_id.encode("utf-8")).hexdigest()
+                    # 1ディレクトリにファイルが集中しないよう、ハッシュの先頭2文字でディレクトリを分ける
+                    photo_path = os.path.join("places", digest[:2], f"{digest}.{extension}")
+                    _write_atomic(media_abspath(photo_path), content)
+                    photo_bytes = len(content)
+                else:
+                    print(f"場所の写真を保存できませんでした ({place_id}): Content-Type={content_type}")
+            except Exception as e:
+                print(f"場所の写真の取得エラー ({place_id}): {e}")
+        current.set(found=details is not None, photo_bytes=photo_bytes)
+        _count("fetched" if details else "failed")
+
+        now = time.time()
+        with db_connection() as conn:
+            previous = conn.execute("SELECT photo_path, photo_bytes FROM place_media WHERE place_id = ?",
+                                    (place_id,)).fetchone()
+            if details is None:
+                # 詳細を取れなかった: 既存の行はそのまま使い、次に取り直すまでの期限だけ延ばす
+                conn.execute(
+                    '''INSERT INTO place_media (place_id, details, photo_path, photo_bytes, fetched_at, expires_at, last_access)
+                       VALUES (?, NULL, NULL, 0, ?, ?, ?)
+                       ON CONFLICT (place_id) DO UPDATE SET expires_at = excluded.expires_at''',
+                    (place_id, now, now + PLACE_MEDIA_NEGATIVE_TTL, now)
+                )
+                return
+            if photo_path is None and previous and previous[0]:
+                # 写真だけ取れなかった場合は以前の写真を使い続ける
+                photo_path, photo_bytes = previous
+            conn.execute(
+                '''INSERT OR REPLACE INTO place_media (place_id, details, photo_path, photo_bytes, fetched_at, expires_at, last_access)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (place_id, json.dumps(details, ensure_ascii=False), photo_path, photo_bytes,
+                 now, now + PLACE_MEDIA_TTL, now)
+            )
+        if previous and previous[0] and previous[0] != photo_path:
+            _remove_file(previous[0])
+    if photo_bytes:
+        _evict_if_needed()
+
+
+def _prefetch_one(place_id):
+    try:
+        _fetch_and_store(place_id)
+    except Exception as e:
+        print(f"場所の詳細・写真の保存エラー ({place_id}): {e}")
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(place_id)
+
+
+def prefetch_place_media(place_ids):
+    """
+    キャッシュに無い・期限切れの場所の詳細と写真を裏で取得する (完了は待たない)。
+    取得を予約した件数を返す。
+    """
+    if not PREFETCH_ENABLED:
+        return 0
+    place_ids = list(dict.fromkeys(place_id for place_id in place_ids if place_id))
+    if not place_ids:
+        return 0
+    placeholders = ",".join("?" * len(place_ids))
+    with db_connection() as conn:
+        fresh = {row[0] for row in conn.execute(
+            f"SELECT place_id FROM place_media WHERE place_id IN ({placeholders}) AND expires_at > ?",
+            (*place_ids, time.time())
+        )}
+    _count("fresh", len(fresh))
+    scheduled = 0
+    for place_id in place_ids:
+        if place_id in fresh:
+            continue
+        with _in_flight_lock:
+            if place_id in _in_flight:
+                continue
+            _in_flight.add(place_id)
+        _prefetch_executor.submit(_prefetch_one, place_id)
+        scheduled += 1
+    return scheduled
+
+
+def prefetch_places_result(places_json):
+    """search_google_places の結果(JSON文字列)に含まれる場所を先読みする。エラー結果は何もしない"""
+    try:
+        places = json.loads(places_json)
+    except (TypeError, json.JSONDecodeError):
+        return 0
+    if not isinstance(places, list):
+        return 0
+    return prefetch_place_media(place.get("place_id") for place in places if isinstance(place, dict))
+
+
+# --- 表示用の読み込み ---
+
+def load_place_media(conn, place_ids):
+    """
+    保存済みの詳細を {place_id: 詳細の辞書} で返す (APIは呼ばない)。
+    詳細の辞書は fetch_place_details の形式に、写真ファイルのパス "photo" (無ければ None) を加えたもの。
+    """
+    place_ids = list(dict.fromkeys(place_id for place_id in place_ids if place_id))
+    if not place_ids:
+        return {}
+    placeholders = ",".join("?" * len(place_ids))
+    rows = conn.execute(
+        f"SELECT place_id, details, photo_path FROM place_media WHERE place_id IN ({placeholders}) AND details IS NOT NULL",
+        place_ids
+    ).fetchall()
+    media = {}
+    for place_id, details, photo_path in rows:
+        entry = json.loads(details)
+        entry["photo"] = media_abspath(photo_path) if photo_path and os.path.exists(media_abspath(photo_path)) else None
+        media[place_id] = entry
+    if media:
+        # 容量超過時の削除順 (最後に表示された時刻) を更新する。リランの度に書き込まないよう1時間単位にする
+        now = time.time()
+        with conn:
+            conn.execute(
+                f"UPDATE place_media SET last_access = ? WHERE place_id IN ({','.join('?' * len(media))}) AND last_access < ?",
+                (now, *media, now - 3600)
+            )
+    return media
+
+
+# --- 容量の管理 ---
+
+def _evict_if_needed():
+    """
+    写真の合計サイズが上限を超えていたら、最後に表示されてから長い場所の写真を削除する。
+    上限は写真の容量なので、詳細の行は残して場所カード・地図はそのまま表示できるようにする。
+    """
+    with _evict_lock:
+        with db_connection() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(photo_bytes), 0) FROM place_media").fetchone()[0]
+            if total <= MEDIA_CACHE_MAX_BYTES:
+                return
+            # 削除の度に上限ちょうどまで減らすと毎回削除が走るので、上限の9割まで減らす
+            target = MEDIA_CACHE_MAX_BYTES * 0.9
+            evicted = []
+            for place_id, photo_path, photo_bytes in conn.execute(
+                "SELECT place_id, photo_path, photo_bytes FROM place_media WHERE photo_bytes > 0 ORDER BY last_access"
+            ).fetchall():
+                if total <= target:
+                    break
+                evicted.append((place_id, photo_path))
+                total -= photo_bytes
+            conn.executemany("UPDATE place_media SET photo_path = NULL, photo_bytes = 0 WHERE place_id = ?",
+                             [(place_id,) for place_id, _ in evicted])
+        for _, photo_path in evicted:
+            _remove_file(photo_path)
+        _count("evicted", len(evicted))
+        print(f"メディアキャッシュが上限を超えたため {len(evicted)} 件の場所の写真を削除しました")
+
+
+def get_media_cache_stats():
+    """先読みの件数・保存件数・写真の合計サイズを返す"""
+    with db_connection() as conn:
+        entries, total_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(photo_bytes), 0) FROM place_media").fetchone()
+    with _counters_lock:
+        stats = dict(_counters)
+    with _in_flight_lock:
+        stats["in_flight"] = len(_in_flight)
+    stats.update(entries=entries, total_bytes=total_bytes, max_bytes=MEDIA_CACHE_MAX_BYTES)
+    return stats
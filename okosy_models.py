@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+チャット補完のモデル選択 (ルーティング) とフォールバック。
+処理の段階(フェーズ)毎に候補のモデルを並べておき、直近のレイテンシ・エラー率を見て呼び出すモデルを決める。
+
+- plan:  ツールの選択・長期旅行の計画 (速くて安いモデル)
+- write: ツールの結果を受けたしおり本文の作成 (品質の高いモデル)
+
+- ストリーミングは最初のチャンクまで、それ以外は応答全体までの時間を別々に記録し、別々のSLOと比べる
+  (長い本文を一括で作る呼び出しが遅いことで、ストリーミングの候補の順が変わらないようにする)
+- 直近 MODEL_STATS_WINDOW 秒の同じ種類の呼び出しの結果で、エラー率が高い・p95がSLOを超えているモデルは
+  候補の後ろに回す
+- 応答がSLOまでに返らなければ、次の候補へ同じリクエストを並行して送り(ヘッジ)、先に返った方を使う
+- タイムアウト・接続エラー・レート制限・5xx は次の候補で再試行する (候補が尽きたら最後のエラーを送出する)
+- 選んだモデルと理由は呼び出し元のスパンの属性に、モデル毎の件数は get_model_stats() で確認できる
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+PHASE_PLAN = "plan"
+PHASE_WRITE = "write"
+
+
+def _model_list(name, default):
+    return [model.strip() for model in os.getenv(name, default).split(",") if model.strip()]
+
+
+# --- モデル選択の設定 ---
+MODEL_ROUTES = {
+    PHASE_PLAN: _model_list("OKOSY_PLAN_MODELS", "gpt-4o-mini,gpt-3.5-turbo"),
+    PHASE_WRITE: _model_list("OKOSY_WRITE_MODELS", "gpt-4o,gpt-4o-mini"),
+}
+# 目標時間(秒)。超えたらヘッジする。(フェーズ, ストリーミングか) 毎に、
+# ストリーミングは最初のチャンクまで、それ以外は応答全体までの時間で決める
+MODEL_LATENCY_SLO = {
+    (PHASE_PLAN, False): float(os.getenv("OKOSY_PLAN_LATENCY_SLO", 4)),
+    (PHASE_PLAN, True): float(os.getenv("OKOSY_PLAN_FIRST_CHUNK_SLO", 4)),
+    (PHASE_WRITE, False): float(os.getenv("OKOSY_WRITE_LATENCY_SLO", 45)),  # 長期旅行の1日分の本文など
+    (PHASE_WRITE, True): float(os.getenv("OKOSY_WRITE_FIRST_CHUNK_SLO", 10)),
+}
+# 1回の呼び出しのタイムアウト(秒)。ストリーミングではチャンク間の待ち時間の上限になる
+MODEL_TIMEOUT = {
+    PHASE_PLAN: float(os.getenv("OKOSY_PLAN_TIMEOUT", 20)),
+    PHASE_WRITE: float(os.getenv("OKOSY_WRITE_TIMEOUT", 60)),
+}
+HEDGING_ENABLED = os.getenv("OKOSY_MODEL_HEDGING", "1") != "0"
+MODEL_STATS_WINDOW = float(os.getenv("OKOSY_MODEL_STATS_WINDOW", 300))      # 直近何秒の結果でモデルの状態を判断するか
+MODEL_MAX_ERROR_RATE = float(os.getenv("OKOSY_MODEL_MAX_ERROR_RATE", 0.5))  # これを超えたモデルは後回しにする
+MODEL_MIN_SAMPLES = 5   # 判断に使う最低の件数 (少ない件数の偶然のエラーで外さない)
+MODEL_MAX_WORKERS = int(os.getenv("OKOSY_MODEL_MAX_WORKERS", 32))
+
+# 別のモデルで再試行すれば成功しうるエラー (リクエストの内容が原因のものは再試行しない)
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError,
+                    openai.NotFoundError)
+
+# 呼び出しは全てこのスレッドプールで行い、呼び出し元はSLOまで待ってからヘッジするか決める
+_model_executor = ThreadPoolExecutor(max_workers=MODEL_MAX_WORKERS, thread_name_prefix="okosy-model")
+
+
+class _ModelStats:
+    """1つの (フェーズ, モデル, ストリーミングか) の直近の結果と累計の件数"""
+
+    def __init__(self):
+        self.samples = deque(maxlen=500)  # (時刻, 応答(ストリーミングなら最初のチャンク)までのms, 成功したか)
+        self.counters = {"calls": 0, "errors": 0, "timeouts": 0, "primary": 0, "hedges": 0, "hedge_wins": 0,
+                         "fallbacks": 0}
+
+    def recent(self, now):
+        while self.samples and self.samples[0][0] < now - MODEL_STATS_WINDOW:
+            self.samples.popleft()
+        latencies = sorted(elapsed_ms for _, elapsed_ms, ok in self.samples if ok)
+        errors = sum(1 for _, _, ok in self.samples if not ok)
+        count = len(self.samples)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))], 1)
+
+        return {"count": count, "error_rate": errors / count if count else 0.0,
+                "p50_ms": percentile(50), "p95_ms": percentile(95)}
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _get_stats(phase, model, stream):
+    # 呼び出し元で _stats_lock を取得していること
+    key = (phase, model, stream)
+    if key not in _stats:
+        _stats[key] = _ModelStats()
+    return _stats[key]
+
+
+def _count(phase, model, stream, name):
+    with _stats_lock:
+        _get_stats(phase, model, stream).counters[name] += 1
+
+
+def _record(phase, model, stream, elapsed_ms, error=None):
+    with _stats_lock:
+        stats = _get_stats(phase, model, stream)
+        stats.samples.append((time.time(), elapsed_ms, error is None))
+        stats.counters["calls"] += 1
+        if error is not None:
+            stats.counters["errors"] += 1
+            if isinstance(error, openai.APITimeoutError):
+                stats.counters["timeouts"] += 1
+
+
+def _unhealthy_reason(phase, model, stream, now):
+    """同じ種類の呼び出しの直近の結果からモデルを後回しにすべき理由を返す (問題なければ None)"""
+    with _stats_lock:
+        recent = _get_stats(phase, model, stream).recent(now)
+    if recent["count"] < MODEL_MIN_SAMPLES:
+        return None
+    if recent["error_rate"] > MODEL_MAX_ERROR_RATE:
+        return f"errors {recent['error_rate']:.0%}"
+    if recent["p95_ms"] is not None and recent["p95_ms"] > MODEL_LATENCY_SLO[(phase, stream)] * 1000:
+        return f"slow p95 {recent['p95_ms']:.0f}ms"
+    return None
+
+
+def route(phase, stream=False):
+    """
+    フェーズの候補を呼び出す順に並べ、(モデルのリスト, 理由) を返す。
+    同じ種類(ストリーミングか)の呼び出しで状態の悪いモデルは後ろに回す (全て悪ければ設定の順のまま)。
+    """
+    now = time.time()
+    healthy, degraded, reasons = [], [], []
+    for model in MODEL_ROUTES[phase]:
+        reason = _unhealthy_reason(phase, model, stream, now)
+        if reason:
+            degraded.append(model)
+            reasons.append(f"{model}: {reason}")
+        else:
+            healthy.append(model)
+    if not healthy:
+        return list(MODEL_ROUTES[phase]), "all degraded: " + "; ".join(reasons)
+    return healthy + degraded, "; ".join(reasons) or "default"
+
+
+def _call(client, phase, model, messages, stream, request_kwargs, max_retries):
+    """
+    1つのモデルを呼び出す (スレッドプールで実行する)。
+    ストリーミングでは最初のチャンクまで読み、(Stream, イテレータ, 最初のチャンク) を返す。
+    """
+    started = time.perf_counter()
+    try:
+        api = client.with_options(timeout=MODEL_TIMEOUT[phase], max_retries=max_retries).chat.completions
+        if not stream:
+            result = api.create(model=model, messages=messages, **request_kwargs)
+        else:
+            response = api.create(model=model, messages=messages, stream=True, **request_kwargs)
+            chunks = iter(response)
+            result = (response, chunks, next(chunks, None))
+    except Exception as e:
+        _record(phase, model, stream, (time.perf_counter() - started) * 1000, e)
+        raise
+    _record(phase, model, stream, (time.perf_counter() - started) * 1000)
+    return result
+
+
+def _discard(future):
+    """ヘッジで使わなかった呼び出しの後始末 (ストリーミングなら接続を閉じる)"""
+    if future.cancel():
+        return
+
+    def close(done):
+        result = None if done.cancelled() or done.exception() else done.result()
+        if isinstance(result, tuple):
+            result[0].close()
+    future.add_done_callback(close)
+
+
+def create_chat_completion(client, phase, messages, stream=False, **request_kwargs):
+    """
+    フェーズの候補のモデルでチャット補完を実行し、(結果, 選択の記録) を返す。
+    結果は stream=False なら ChatCompletion、True ならチャンクのイテレータ。
+    選択の記録: {"phase", "model", "route", "route_reason", "attempts", "hedged", "fallback"}
+    候補が全て失敗した場合は最後のエラー (レート制限があればそれ) を送出する。
+    """
+    models, reason = route(phase, stream)
+    slo = MODEL_LATENCY_SLO[(phase, stream)]
+    decision = {"phase": phase, "model": None, "route": ",".join(models), "route_reason": reason,
+                "attempts": 0, "hedged": False, "fallback": False}
+    pending = {}  # Future -> (モデル, 呼び出しの種類)
+    errors = []
+    next_index = 0
+
+    def launch(kind):
+        nonlocal next_index
+        model = models[next_index]
+        next_index += 1
+        # 後に候補が残っている間はSDKの再試行をせず、次の候補への切り替えで代わりにする
+        max_retries = 0 if next_index < len(models) else client.max_retries
+        pending[_model_executor.submit(_call, client, phase, model, messages, stream, request_kwargs,
+                                       max_retries)] = (model, kind)
+        decision["attempts"] += 1
+        _count(phase, model, stream, kind)
+
+    launch("primary")
+    deadline = time.monotonic() + slo
+    while pending:
+        can_hedge = HEDGING_ENABLED and not decision["hedged"] and next_index < len(models)
+        done, _ = wait(pending, timeout=max(0.0, deadline - time.monotonic()) if can_hedge else None,
+                       return_when=FIRST_COMPLETED)
+        if not done:
+            # SLOを超えたので次の候補へ同じリクエストを送り、先に返った方を使う
+            decision["hedged"] = True
+            launch("hedges")
+            continue
+        for future in done:
+            model, kind = pending.pop(future)
+            error = future.exception()
+            if error is None:
+                for other in pending:
+                    _discard(other)
+                if kind == "hedges":
+                    _count(phase, model, stream, "hedge_wins")
+                decision["model"] = model
+                result = future.result()
+                if stream:
+                    _, chunks, first = result
+                    result = _chain_first(first, chunks)
+                return result, decision
+            if not isinstance(error, RETRYABLE_ERRORS):
+                for other in pending:
+                    _discard(other)
+                raise error
+            print(f"モデルの呼び出しに失敗しました ({phase}/{model}): {type(error).__name__}: {error}")
+            errors.append(error)
+        if not pending and next_index < len(models):
+            decision["fallback"] = True
+            launch("fallbacks")
+            deadline = time.monotonic() + slo
+    rate_limited = [error for error in errors if isinstance(error, openai.RateLimitError)]
+    raise (rate_limited or errors)[-1]
+
+
+def _chain_first(first, chunks):
+    if first is not None:
+        yield first
+        yield from chunks
+
+
+def get_model_stats():
+    """
+    フェーズ・モデル・ストリーミングか 毎の直近のレイテンシ・エラー率と累計の件数を返す
+    (まだ一度も呼び出しを選んでいない種類は含めない)。slo_ms はその種類のSLO。
+    """
+    now = time.time()
+    rows = []
+    with _stats_lock:
+        for phase, models in MODEL_ROUTES.items():
+            for stream in (False, True):
+                for order, model in enumerate(models):
+                    stats = _stats.get((phase, model, stream))
+                    if stats is None:
+                        continue
+                    rows.append(dict(phase=phase, model=model, stream=stream, order=order,
+                                     slo_ms=MODEL_LATENCY_SLO[(phase, stream)] * 1000,
+                                     **stats.recent(now), **stats.counters))
+    for row in rows:
+        row["degraded"] = _unhealthy_reason(row["phase"], row["model"], row["stream"], now)
+    return rows
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+思い出の写真ストア。
+- アップロードされた写真は検証し、EXIFの向きを反映・メタデータを除去したうえで
+  最大 PHOTO_MAX_DIMENSION px に縮小して再エンコード(WebP / プログレッシブJPEG)して保存する
+- 拡大表示用と一覧表示用(サムネイル)の縮小版もアップロード時に1回だけ作成する
+- ファイル名はアップロードされた内容のハッシュ(SHA-256) (同じ写真は1つにまとまる)
+- DBの memories テーブルにはファイルへの参照・画像サイズ・元のバイト数と保存したバイト数だけを保存する
+
+既存のBLOB行の移行:
+    python okosy_photos.py migrate
+"""
+import hashlib
+import io
+import math
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from okosy_db import get_db_connection, init_db
+
+# --- 写真ストアの設定 ---
+PHOTO_STORE_DIR = os.getenv("OKOSY_PHOTO_DIR", "okosy_photos")
+PHOTO_MAX_UPLOAD_BYTES = int(float(os.getenv("OKOSY_PHOTO_MAX_UPLOAD_MB", 25)) * 1024 * 1024)
+PHOTO_MAX_PIXELS = int(os.getenv("OKOSY_PHOTO_MAX_PIXELS", 60_000_000))   # 展開後の画素数の上限 (巨大な画像でメモリを使い果たさないようにする)
+PHOTO_MAX_DIMENSION = int(os.getenv("OKOSY_PHOTO_MAX_DIMENSION", 2048))   # 保存する写真の長辺の上限
+PHOTO_QUALITY = int(os.getenv("OKOSY_PHOTO_QUALITY", 85))
+PHOTO_WORKERS = int(os.getenv("OKOSY_PHOTO_WORKERS", 2))
+DISPLAY_SIZE = (1024, 1024) # 拡大表示用
+THUMBNAIL_SIZE = (300, 300) # 一覧では width=150 で表示するので高解像度ディスプレイ向けに2倍
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+PHOTO_FORMAT = THUMBNAIL_FORMAT
+
+ACCEPTED_FORMATS = {"JPEG", "PNG", "WEBP"}
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+# 写真の処理(デコード・縮小・エンコード)はスクリプトのスレッドから外し、同時に処理する枚数も絞る
+# (大きな写真を複数のセッションで同時に展開してメモリが膨らまないようにする)
+_photo_executor = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix="okosy-photo")
+
+
+class PhotoValidationError(ValueError):
+    """アップロードされたファイルを写真として受け付けられないことを表す (メッセージは画面に表示する)"""
+
+
+def photo_abspath(relative_path):
+    """DBに保存している相対パスを実際のファイルパスに変換する"""
+    return os.path.join(PHOTO_STORE_DIR, relative_path)
+
+
+def _sharded_path(kind, digest, extension):
+    # 1ディレクトリにファイルが集中しないよう、ハッシュの先頭2文字でディレクトリを分ける
+    return os.path.join(kind, digest[:2], f"{digest}.{extension}")
+
+
+def _write_atomic(path, data):
+    """一時ファイルに書いてからリネームし、途中まで書かれたファイルが見えないようにする"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 同じ内容の写真を複数のスレッドが同時に保存することがあるので、一時ファイル名はスレッド毎に分ける
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _encode(image, size, image_format, quality):
+    """
+    size に収まるよう縮小してエンコードし、バイト列を返す (image は向き補正済みのもの)。
+    EXIFなどのメタデータは引き継がない (色の再現に必要なICCプロファイルだけ残す)。
+    """
+    resized = image.copy()
+    resized.thumbnail(size, Image.LANCZOS)
+    if image_format == "JPEG" and resized.mode not in ("RGB", "L"):
+        resized = resized.convert("RGB")
+    elif resized.mode not in ("RGB", "RGBA", "L", "LA"):
+        resized = resized.convert("RGBA" if "transparency" in resized.info else "RGB")
+    options = {"quality": quality}
+    if image.info.get("icc_profile"):
+        options["icc_profile"] = image.info["icc_profile"]
+    if image_format == "JPEG":
+        options.update(progressive=True, optimize=True)
+    elif image_format == "WEBP":
+        options["method"] = 4
+    buffer = io.BytesIO()
+    resized.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def make_thumbnail(image):
+    """一覧表示用のサムネイルを作成し、エンコード済みのバイト列を返す (image は向き補正済みのもの)"""
+    return _encode(image, THUMBNAIL_SIZE, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY)
+
+
+def open_photo(photo_bytes):
+    """
+    アップロードされたバイト列を検証して画像として読み込み、EXIFの向きを反映したものを返す。
+    受け付けられない場合は PhotoValidationError を送出する。
+    """
+    if len(photo_bytes) > PHOTO_MAX_UPLOAD_BYTES:
+        raise PhotoValidationError(
+            f"写真のサイズが大きすぎます ({len(photo_bytes) / 1024 / 1024:.1f}MB、上限 {PHOTO_MAX_UPLOAD_BYTES // 1024 // 1024}MB)")
+    try:
+        image = Image.open(io.BytesIO(photo_bytes))
+    except UnidentifiedImageError:
+        raise PhotoValidationError("画像として読み込めないファイルです")
+    except Image.DecompressionBombError:
+        raise PhotoValidationError("画像の解像度が大きすぎます")
+    if image.format not in ACCEPTED_FORMATS:
+        raise PhotoValidationError(f"対応していない画像形式です ({image.format})")
+    width, height = image.size
+    # 画素数はヘッダーだけで分かるので、展開する前に確認する
+    if width * height > PHOTO_MAX_PIXELS:
+        raise PhotoValidationError(f"画像の解像度が大きすぎます ({width}x{height})")
+    if image.format == "JPEG":
+        # JPEGは縮小したサイズで直接デコードできるので、保存サイズを下回らない範囲で縮小して読む
+        scale = PHOTO_MAX_DIMENSION / max(width, height)
+        if scale < 1:
+            image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    try:
+        image.load()
+    except (OSError, SyntaxError) as e:
+        raise PhotoValidationError(f"画像が壊れているため読み込めません: {e}")
+    return ImageOps.exif_transpose(image)
+
+
+def store_photo(photo_bytes):
+    """
+    写真を検証・縮小・再エンコードして保存し、DBに記録する参照情報
+    {"photo_path", "display_path", "thumb_path", "photo_width", "photo_height", "original_bytes", "stored_bytes"}
+    を返す (stored_bytes は3つのファイルの合計)。同じ内容の写真が保存済みならファイルは書き直さない。
+    受け付けられない場合は PhotoValidationError を送出する。
+    """
+    image = open_photo(photo_bytes)
+    digest = hashlib.sha256(photo_bytes).hexdigest()
+    extension = _EXTENSIONS[PHOTO_FORMAT]
+    variants = [
+        ("photo_path", _sharded_path("photos", digest, extension),
+         (PHOTO_MAX_DIMENSION, PHOTO_MAX_DIMENSION), PHOTO_FORMAT, PHOTO_QUALITY),
+        ("display_path", _sharded_path("display", digest, extension), DISPLAY_SIZE, PHOTO_FORMAT, PHOTO_QUALITY),
+        ("thumb_path", _sharded_path("thumbs", digest, _EXTENSIONS[THUMBNAIL_FORMAT]),
+         THUMBNAIL_SIZE, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY),
+    ]
+    refs = {"original_bytes": len(photo_bytes), "stored_bytes": 0}
+    for key, path, size, image_format, quality in variants:
+        if not os.path.exists(photo_abspath(path)):
+            _write_atomic(photo_abspath(path), _encode(image, size, image_format, quality))
+        refs[key] = path
+        refs["stored_bytes"] += os.path.getsize(photo_abspath(path))
+    # 記録するサイズは保存した(縮小後の)写真のもの
+    image.thumbnail((PHOTO_MAX_DIMENSION, PHOTO_MAX_DIMENSION))
+    refs["photo_width"], refs["photo_height"] = image.size
+    return refs
+
+
+def store_photo_async(photo_bytes):
+    """store_photo を写真処理用のスレッドで実行し、Future を返す"""
+    return _photo_executor.submit(store_photo, photo_bytes)
+
+
+def release_photo(conn, photo_path, thumb_path, display_path=None):
+    """どの思い出からも参照されなくなった写真ファイルを削除する"""
+    if not photo_path:
+        return
+    still_used = conn.execute("SELECT 1 FROM memories WHERE photo_path = ? LIMIT 1", (photo_path,)).fetchone()
+    if still_used:
+        return
+    for path in (photo_path, display_path, thumb_path):
+        if path:
+            try:
+                os.remove(photo_abspath(path))
+            except FileNotFoundError:
+                pass
+
+
+def migrate_memory_photo(conn, memory_id):
+    """
+    1件の思い出のBLOBをファイルストアに移し、BLOB列を空にする。
+    移行後の参照情報(store_photo と同じ形式)を返す (BLOBが無い・壊れている場合は None)。
+    """
+    row = conn.execute("SELECT photo FROM memories WHERE id = ? AND photo_path IS NULL", (memory_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    try:
+        refs = store_photo(row[0])
+    except Exception as e:
+        print(f"写真の移行に失敗しました (memory id={memory_id}): {e}")
+        return None
+    with conn:
+        conn.execute(
+            '''UPDATE memories
+               SET photo_path = ?, display_path = ?, thumb_path = ?, photo_width = ?, photo_height = ?,
+                   original_bytes = ?, stored_bytes = ?, photo = NULL
+               WHERE id = ?''',
+            (refs["photo_path"], refs["display_path"], refs["thumb_path"], refs["photo_width"], refs["photo_height"],
+             refs["original_bytes"], refs["stored_bytes"], memory_id)
+        )
+    return refs
+
+
+def migrate_blob_photos(batch_size=50):
+    """既存のBLOB行をすべてファイルストアへ移行し、移行した件数を返す"""
+    init_db()
+    # VACUUM まで行う長い処理なのでプールのものではなく専用のコネクションを使う
+    conn = get_db_connection()
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM memories WHERE photo IS NOT NULL AND photo_path IS NULL AND id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            )]
+            if not ids:
+                break
+            for memory_id in ids:
+                if migrate_memory_photo(conn, memory_id):
+                    migrated += 1
+            last_id = ids[-1]
+            print(f"{migrated} 件の写真を移行しました...")
+        # BLOBを空にした分の領域を解放する
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        print(f"移行完了: {migrate_blob_photos()} 件")
+    else:
+        print("使い方: python okosy_photos.py migrate")
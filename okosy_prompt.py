@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+しおり生成のプロンプト組み立てとトークン管理。
+- 固定の指示は毎回同じ文字列のシステムメッセージにまとめ、リクエスト毎に変わる内容はユーザーメッセージに分ける
+- 好み・ツール結果は空白や不要な項目を除いた短い表現に変換する
+- 送信前にトークン数を数え、上限を超える場合はツール結果から順に切り詰める
+
+トークン数は tiktoken がインストールされていれば正確に、無ければ文字数からの概算で数える。
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+from okosy_trace import sampled_log
+
+# --- プロンプトの設定 ---
+PROMPT_TOKEN_BUDGET = int(os.getenv("OKOSY_PROMPT_TOKEN_BUDGET", 6000))  # 1リクエストで送るプロンプトの上限
+TOKENIZER_MODEL = "gpt-3.5-turbo"
+MESSAGE_OVERHEAD_TOKENS = 4 # メッセージ毎の区切りなどに使われるトークン数 (概算)
+TRUNCATED_MARK = "…(省略)"
+
+# 全リクエストで共通の指示
+SYSTEM_PROMPT = """あなたは旅のプランナー「Okosy」です。ユーザーの入力情報をもとに、SNS映えや定番から少し離れた、ユーザー自身の感性に寄り添うような、パーソナルな旅のしおりを作成してください。
+
+【出力指示】
+1. **構成:** 指定された日数の旅程を、各日ごとに「午前」「午後」「夜」のセクションに分けて提案してください。
+2. **内容:**
+    * なぜその場所や過ごし方がユーザーの目的・気分・好みに合っているか、**感性的な言葉**で理由や提案コメントを添えてください。
+    * 好みに「隠れた発見をしたい」がある場合は、定番すぎないスポットや体験も提案に含めてください。
+    * 食事や宿泊の好みも反映してください。
+    * `search_google_places`ツールを**必要に応じて**呼び出し、具体的な場所の候補を検索してください。
+    * ツールの結果が得られた場合は、その場所名を旅程に自然に組み込んでください。エラーが返ってきた場合は、代替案を提示してください。
+3. **形式:** 全体を読みやすい**マークダウン形式**で出力してください。
+
+Okosyとして、ユーザーに最高の旅体験をデザインしてください。"""
+
+
+# --- トークン数 ---
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception as e:
+        print(f"tiktoken のエンコーディングを取得できませんでした (概算で数えます): {e}")
+        return None
+
+
+def count_tokens(text):
+    """文字列のトークン数を返す (tiktoken が無い場合は概算)"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 概算: 英数字・記号は約4文字で1トークン、日本語は1文字で約1トークン
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def count_message_tokens(messages):
+    """チャットのメッセージ列全体のトークン数を返す"""
+    total = 3 # 応答の開始部分
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content"))
+        for tool_call in message.get("tool_calls") or []:
+            total += count_tokens(tool_call["function"]["name"]) + count_tokens(tool_call["function"]["arguments"])
+    return total
+
+
+# --- 好みのコンパクト化 ---
+
+_PREFERENCE_LABELS = [
+    ("pace", "ペース"), ("nature", "自然"), ("culture", "歴史文化"), ("art", "アート"),
+    ("food_local", "食事"), ("food_style", "料理"), ("accom_type", "宿"),
+    ("vibe_quiet", "雰囲気"), ("experience", "体験"),
+]
+
+
+def compact_preferences(preferences):
+    """
+    好みの辞書を1行の短い文字列にする (例: "ペース:のんびり/自然:4/料理:和食,カフェ/隠れた発見をしたい")。
+    選ばれていない複数選択やオフのチェックボックスは省く。
+    """
+    preferences = preferences or {}
+    parts = []
+    for key, label in _PREFERENCE_LABELS:
+        value = preferences.get(key)
+        if value in (None, "", []):
+            continue
+        if isinstance(value, list):
+            value = ",".join(str(v) for v in value)
+        if key == "accom_type" and preferences.get("accom_view"):
+            value = f"{value}(景色重視)"
+        parts.append(f"{label}:{value}")
+    if preferences.get("vibe_discover"):
+        parts.append("隠れた発見をしたい")
+    return "/".join(parts)
+
+
+def build_itinerary_messages(dest, purp, comp, days, budg, preferences):
+    """
+    しおり生成の最初のメッセージ列 [system, user] と、
+    従来の形式 (好みをインデント付きJSONで埋め込む) と比べて減らせたトークン数を返す。
+    """
+    user_prompt = _basic_info_text(dest, purp, comp, days, budg, preferences)
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}]
+    verbose_preferences = json.dumps(preferences or {}, ensure_ascii=False, indent=2)
+    tokens_saved = count_tokens(verbose_preferences) - count_tokens(compact_preferences(preferences))
+    return messages, max(0, tokens_saved)
+
+
+# --- 長期旅行 (日毎の並列生成) 用のプロンプト ---
+# 計画 (各日のエリアとテーマ) を1回で決めてから、各日を別々のリクエストで並列に生成する
+
+PLAN_SYSTEM_PROMPT = """あなたは旅のプランナー「Okosy」です。ユーザーの入力情報をもとに、旅行日数分の各日の過ごし方の骨組みを決めてください。
+- 移動が無理なく、日毎に雰囲気が変わるように、各日の中心となるエリアとテーマを1つずつ決めてください。
+- 次の形式のJSONだけを出力してください:
+{"overview": "旅全体のコンセプト (1文)", "days": [{"day": 1, "area": "エリア名", "theme": "テーマ (短く)"}]}"""
+
+DAY_SYSTEM_PROMPT = """あなたは旅のプランナー「Okosy」です。複数日の旅のしおりのうち、指定された1日分だけを作成してください。SNS映えや定番から少し離れた、ユーザー自身の感性に寄り添うような提案にしてください。
+
+【出力指示】
+1. **構成:** 「## N日目 (エリア)」の見出しから始め、「午前」「午後」「夜」の小見出し (###) に分けて提案してください。旅全体の前置きやまとめは書かないでください。
+2. **内容:**
+    * なぜその場所や過ごし方がユーザーの目的・気分・好みに合っているか、**感性的な言葉**で理由や提案コメントを添えてください。
+    * 好みに「隠れた発見をしたい」がある場合は、定番すぎないスポットや体験も提案に含めてください。
+    * 他の日と同じ場所は提案しないでください。
+    * `search_google_places`ツールを**必要に応じて**呼び出し、その日のエリアの具体的な場所の候補を検索してください。
+    * ツールの結果が得られた場合は、その場所名を旅程に自然に組み込んでください。エラーが返ってきた場合は、代替案を提示してください。
+3. **形式:** 読みやすい**マークダウン形式**で出力してください。"""
+
+
+def _basic_info_text(dest, purp, comp, days, budg, preferences):
+    return (
+        f"【基本情報】\n行き先:{dest}\n目的・気分:{purp}\n同行者:{comp}\n"
+        f"旅行日数:{days}日\n予算感:{budg}\n【ユーザーの好み】\n{compact_preferences(preferences)}"
+    )
+
+
+def build_plan_messages(dest, purp, comp, days, budg, preferences):
+    """長期旅行の計画 (各日のエリアとテーマ) を決めるリクエストのメッセージ列を返す"""
+    return [
+        {"role": "system", "content": PLAN_SYSTEM_PROMPT},
+        {"role": "user", "content": _basic_info_text(dest, purp, comp, days, budg, preferences)},
+    ]
+
+
+def parse_trip_plan(content, days, dest):
+    """
+    計画リクエストの応答(JSON)を {"overview", "days": [{"day", "area", "theme"}, ...]} に整える。
+    解釈できない日・足りない日は行き先全体・テーマなしで埋め、必ず days 日分を返す。
+    """
+    try:
+        plan = json.loads(content or "")
+    except json.JSONDecodeError:
+        plan = {}
+    if not isinstance(plan, dict):
+        plan = {}
+    planned = {}
+    for entry in plan.get("days") or []:
+        if isinstance(entry, dict) and isinstance(entry.get("day"), int) and 1 <= entry["day"] <= days:
+            planned.setdefault(entry["day"], entry)
+    day_plans = []
+    for day in range(1, days + 1):
+        entry = planned.get(day, {})
+        day_plans.append({"day": day, "area": str(entry.get("area") or dest), "theme": str(entry.get("theme") or "")})
+    return {"overview": str(plan.get("overview") or ""), "days": day_plans}
+
+
+def build_day_messages(dest, purp, comp, days, budg, preferences, plan, day):
+    """長期旅行の day 日目を生成するリクエストのメッセージ列を返す (他の日の計画も重複回避のため渡す)"""
+    day_plan = plan["days"][day - 1]
+    other_days = " / ".join(
+        f"{p['day']}日目:{p['area']}({p['theme']})" for p in plan["days"] if p["day"] != day)
+    user_prompt = (
+        f"{_basic_info_text(dest, purp, comp, days, budg, preferences)}\n"
+        f"【旅全体のコンセプト】\n{plan['overview']}\n"
+        f"【他の日の予定】\n{other_days}\n"
+        f"【作成する日】\n{day}日目 エリア:{day_plan['area']} テーマ:{day_plan['theme']}"
+    )
+    return [{"role": "system", "content": DAY_SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}]
+
+
+# --- ツール結果のコンパクト化 ---
+
+_ADDRESS_PREFIX = re.compile(r"^(日本、\s*)?(〒\d{3}-\d{4}\s*)?")
+_PRICE_MARKS = {1: "¥", 2: "¥¥", 3: "¥¥¥", 4: "¥¥¥¥"}
+
+
+def _compact_place_line(place):
+    parts = [f"- {place.get('name')}"]
+    if place.get("rating"):
+        parts.append(f"★{place['rating']}")
+    if place.get("price_level") in _PRICE_MARKS:
+        parts.append(_PRICE_MARKS[place["price_level"]])
+    address = _ADDRESS_PREFIX.sub("", place.get("address") or "")
+    if address:
+        parts.append(address)
+    return " ".join(parts)
+
+
+def compact_tool_result(function_response):
+    """
+    search_google_places の結果(JSON文字列)を、モデルに渡す短い表現に変換する。
+    場所は「- 名前 ★評価 ¥¥ 住所」の1行ずつにし、types や place_id などは省く
+    (保存・表示用には元のJSONを別に保持しておくこと)。
+    変換後の文字列と、減らせたトークン数を返す。
+    """
+    try:
+        data = json.loads(function_response)
+    except (TypeError, json.JSONDecodeError):
+        return function_response, 0
+    if isinstance(data, list):
+        compact = "\n".join(_compact_place_line(place) for place in data if isinstance(place, dict))
+    else:
+        compact = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return compact, max(0, count_tokens(function_response) - count_tokens(compact))
+
+
+# --- トークン上限 ---
+
+def _truncate_text(text, max_tokens):
+    """text を max_tokens 程度に収まるよう末尾を切り詰める"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:max(0, max_tokens - 3)]) + TRUNCATED_MARK
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens - 3:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + TRUNCATED_MARK
+
+
+def fit_messages_to_budget(messages, budget=PROMPT_TOKEN_BUDGET, reserved_tokens=0):
+    """
+    メッセージ列が budget トークン (reserved_tokens はツール定義など別枠で送る分) に収まるよう切り詰めた
+    コピーと、削ったトークン数を返す。元のリストは変更しない。
+    1. ツール結果の場所を末尾から1行ずつ減らす (各結果で最低1行は残す)
+    2. それでも超える場合は、システムメッセージ以外で最も長い本文を切り詰める
+    メッセージ自体は削除しない (Tool Callと結果の対応が崩れないようにする)。
+    """
+    limit = budget - reserved_tokens
+    original_tokens = count_message_tokens(messages)
+    if original_tokens <= limit:
+        return messages, 0
+
+    fitted = [dict(message) for message in messages]
+    total = original_tokens
+    tool_lines = {
+        index: message["content"].split("\n")
+        for index, message in enumerate(fitted)
+        if message.get("role") == "tool" and isinstance(message.get("content"), str)
+    }
+    while total > limit:
+        candidates = [index for index, lines in tool_lines.items() if len(lines) > 1]
+        if not candidates:
+            break
+        index = max(candidates, key=lambda i: len(tool_lines[i]))
+        removed = tool_lines[index].pop()
+        fitted[index]["content"] = "\n".join(tool_lines[index])
+        total -= count_tokens(removed) + 1
+
+    while total > limit:
+        candidates = [i for i, m in enumerate(fitted) if m.get("role") != "system" and m.get("content")]
+        if not candidates:
+            break
+        index = max(candidates, key=lambda i: count_tokens(fitted[i]["content"]))
+        content_tokens = count_tokens(fitted[index]["content"])
+        target = max(16, content_tokens - (total - limit))
+        if target >= content_tokens:
+            break
+        fitted[index]["content"] = _truncate_text(fitted[index]["content"], target)
+        total = count_message_tokens(fitted)
+
+    total = count_message_tokens(fitted)
+    # 切り詰めた量は呼び出し元がスパンに記録するので、ログは間引いて出す
+    sampled_log("プロンプトを上限に合わせて切り詰めました",
+                {"original_tokens": original_tokens, "tokens": total, "limit": limit})
+    return fitted, original_tokens - total
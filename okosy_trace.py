@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+計測(トレース)の部品。
+- span("openai.chat") のように処理を囲むと所要時間と属性を記録する
+- 1回のリラン(リクエスト)を1つのトレースとしてまとめ、直近 N 件をメモリに保持する (管理者ページのウォーターフォール表示用)
+- スパン名毎のレイテンシヒストグラムを集計する
+- 終了したトレースはエクスポーター (JSON Lines / OpenTelemetry互換のコレクター) にバックグラウンドで送る
+- 大きなデータのログは sampled_log() でサンプリングし、長さを制限して出力する
+
+設定 (環境変数):
+    OKOSY_TRACING=0                  計測を無効にする
+    OKOSY_TRACE_EXPORTER             none (既定) / jsonl / otlp
+    OKOSY_TRACE_JSONL_PATH           jsonl の出力先 (既定: okosy_traces.jsonl)
+    OKOSY_TRACE_OTLP_ENDPOINT        otlp の送信先 (既定: http://localhost:4318/v1/traces)
+"""
+import bisect
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- 計測の設定 ---
+TRACING_ENABLED = os.getenv("OKOSY_TRACING", "1") != "0"
+TRACE_KEEP = int(os.getenv("OKOSY_TRACE_KEEP", 50))                 # メモリに残すトレースの件数
+TRACE_MAX_SPANS = int(os.getenv("OKOSY_TRACE_MAX_SPANS", 500))      # 1トレースに記録するスパンの上限
+TRACE_EXPORTER = os.getenv("OKOSY_TRACE_EXPORTER", "none")
+TRACE_JSONL_PATH = os.getenv("OKOSY_TRACE_JSONL_PATH", "okosy_traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("OKOSY_TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+SERVICE_NAME = "okosy"
+
+# サンプリングログの設定
+LOG_SAMPLE_RATE = float(os.getenv("OKOSY_LOG_SAMPLE_RATE", 0.05))  # 出力する割合 (0〜1)
+LOG_MAX_CHARS = int(os.getenv("OKOSY_LOG_MAX_CHARS", 2000))         # 1件の最大文字数
+
+
+class LatencyHistogram:
+    """固定バケットのレイテンシヒストグラム (直近のサンプルからパーセンタイルも計算する)"""
+
+    BUCKETS_MS = [25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800]
+
+    def __init__(self, sample_size=2000):
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self._samples = deque(maxlen=sample_size)
+        self._lock = threading.Lock()
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def record(self, elapsed_ms):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BUCKETS_MS, elapsed_ms)] += 1
+            self._samples.append(elapsed_ms)
+            self.total += 1
+            self.sum_ms += elapsed_ms
+
+    def percentile(self, p):
+        """直近サンプルの p パーセンタイル (ms)。サンプルが無ければ None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self):
+        with self._lock:
+            labels = [f"<={b}ms" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+            buckets = dict(zip(labels, self._counts))
+            total, sum_ms = self.total, self.sum_ms
+        return {
+            "count": total,
+            "mean_ms": (sum_ms / total) if total else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": buckets,
+        }
+
+
+def _new_id(nbytes):
+    return random.getrandbits(nbytes * 8).to_bytes(nbytes, "big").hex()
+
+
+class Span:
+    """1つの処理の区間。set() で属性(トークン数・キャッシュヒット等)を追加できる"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start_time", "_start", "duration_ms", "attributes", "error")
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def incr(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self):
+        return {
+            "name": self.name, "span_id": self.span_id, "parent_id": self.parent_id,
+            "start_time": self.start_time, "duration_ms": self.duration_ms,
+            "attributes": self.attributes, "error": self.error,
+        }
+
+
+class Trace:
+    """1回のリクエスト(リラン)で記録したスパンの集まり"""
+
+    def __init__(self, name, attributes=None):
+        self.trace_id = _new_id(16)
+        self.root = Span(name, attributes=attributes)
+        self.spans = [self.root]
+        self.dropped_spans = 0
+        self._lock = threading.Lock()  # ツールの並列実行スレッドからも追加される
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped_spans += 1
+
+    def to_dict(self):
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {
+            "trace_id": self.trace_id, "name": self.root.name, "start_time": self.root.start_time,
+            "duration_ms": self.root.duration_ms, "dropped_spans": self.dropped_spans, "spans": spans,
+        }
+
+
+# 実行中のトレースと親スパン (スレッドプールに渡すときは contextvars.copy_context() で引き継ぐ)
+_current_trace = contextvars.ContextVar("okosy_current_trace", default=None)
+_current_span = contextvars.ContextVar("okosy_current_span", default=None)
+
+_recent_traces = deque(maxlen=TRACE_KEEP)
+_span_histograms = {}
+_registry_lock = threading.Lock()
+
+
+def _record_histogram(name, elapsed_ms):
+    with _registry_lock:
+        histogram = _span_histograms.get(name)
+        if histogram is None:
+            histogram = _span_histograms[name] = LatencyHistogram()
+    histogram.record(elapsed_ms)
+
+
+class _NoopSpan:
+    """計測が無効なときに span() が返すダミー"""
+
+    def set(self, **attributes):
+        pass
+
+    def incr(self, key, amount=1):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    処理を囲んで所要時間を計測するコンテキストマネージャ。
+        with span("openai.chat", phase=phase) as current:
+            ...
+            current.set(prompt_tokens=...)
+    トレースの外で使った場合もスパン名毎の集計には記録される。
+    """
+    if not TRACING_ENABLED:
+        yield _NOOP_SPAN
+        return
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.finish()
+        _record_histogram(name, current.duration_ms)
+        if trace is not None:
+            trace.add(current)
+
+
+def current_span():
+    """実行中のスパン (無ければ何もしないダミー) を返す。下位の処理から属性を追加するのに使う"""
+    return _current_span.get() or _NOOP_SPAN
+
+
+def begin_trace(name, **attributes):
+    """
+    トレースを開始し、以降のスパンをそこに記録する。
+    前のトレースが終わっていなければ (st.stop() などで抜けた場合) 中断扱いで終了させる。
+    """
+    if not TRACING_ENABLED:
+        return None
+    previous = _current_trace.get()
+    if previous is not None:
+        previous.root.set(aborted=True)
+        end_trace(previous)
+    trace = Trace(name, attributes)
+    _current_trace.set(trace)
+    _current_span.set(trace.root)
+    return trace
+
+
+def end_trace(trace, **attributes):
+    """トレースを終了し、直近の一覧に追加してエクスポーターに渡す"""
+    if trace is None:
+        return
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+        _current_span.set(None)
+    trace.root.set(**attributes)
+    trace.root.finish()
+    _record_histogram(trace.root.name, trace.root.duration_ms)
+    data = trace.to_dict()
+    _recent_traces.append(data)
+    _enqueue_export(data)
+
+
+def get_recent_traces():
+    """直近のトレース (新しい順) を辞書のリストで返す"""
+    return list(reversed(_recent_traces))
+
+
+def get_span_stats():
+    """スパン名毎のレイテンシ統計 (count, mean, p50/p95/p99) を返す"""
+    with _registry_lock:
+        histograms = dict(_span_histograms)
+    return {name: histogram.snapshot() for name, histogram in sorted(histograms.items())}
+
+
+# --- エクスポーター ---
+
+class JsonLinesExporter:
+    """1トレースを1行のJSONとしてファイルに追記する"""
+
+    def __init__(self, path=TRACE_JSONL_PATH):
+        self.path = path
+
+    def export(self, trace):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp_json(trace):
+    """トレースを OpenTelemetry の OTLP/JSON (ExportTraceServiceRequest) 形式に変換する"""
+    spans = []
+    for span_data in trace["spans"]:
+        start_ns = int(span_data["start_time"] * 1e9)
+        end_ns = start_ns + int((span_data["duration_ms"] or 0) * 1e6)
+        otlp_span = {
+            "traceId": trace["trace_id"],
+            "spanId": span_data["span_id"],
+            "name": span_data["name"],
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span_data["attributes"].items()],
+            "status": {"code": 2, "message": span_data["error"]} if span_data["error"] else {"code": 1},
+        }
+        if span_data["parent_id"]:
+            otlp_span["parentSpanId"] = span_data["parent_id"]
+        spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}],
+    }]}
+
+
+class OTLPHttpExporter:
+    """OpenTelemetry Collector 等の OTLP/HTTP (JSON) エンドポイントに送信する"""
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, timeout=5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def export(self, trace):
+        import requests
+        # 計測結果の送信自体は計測しない (okosy_http を通さない)
+        requests.post(self.endpoint, json=to_otlp_json(trace), timeout=self.timeout).raise_for_status()
+
+
+def _exporter_from_env():
+    if TRACE_EXPORTER == "jsonl":
+        return JsonLinesExporter()
+    if TRACE_EXPORTER == "otlp":
+        return OTLPHttpExporter()
+    return None
+
+
+_exporter = _exporter_from_env()
+_export_queue = queue.Queue(maxsize=1000)
+_export_thread = None
+_export_thread_lock = threading.Lock()
+_export_dropped = 0
+
+
+def set_exporter(exporter):
+    """エクスポーターを差し替える (export(trace_dict) を持つオブジェクト。None で送信しない)"""
+    global _exporter
+    _exporter = exporter
+
+
+def _export_worker():
+    while True:
+        trace = _export_queue.get()
+        exporter = _exporter
+        if exporter is None:
+            continue
+        try:
+            exporter.export(trace)
+        except Exception as e:
+            print(f"トレースの送信に失敗しました ({type(exporter).__name__}): {e}")
+
+
+def _enqueue_export(trace):
+    """リクエストを待たせないよう、送信はバックグラウンドのスレッドで行う"""
+    global _export_thread, _export_dropped
+    if _exporter is None:
+        return
+    if _export_thread is None:
+        with _export_thread_lock:
+            if _export_thread is None:
+                _export_thread = threading.Thread(target=_export_worker, name="okosy-trace-export", daemon=True)
+                _export_thread.start()
+    try:
+        _export_queue.put_nowait(trace)
+    except queue.Full:
+        _export_dropped += 1
+
+
+# --- サンプリングログ ---
+
+def sampled_log(label, payload, rate=None, max_chars=None):
+    """
+    payload を rate の割合でだけ出力する (出力する場合も max_chars 文字で切り詰める)。
+    プロンプト全体のような大きなデータを毎回printしないためのもの。
+    """
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    if rate <= 0 or random.random() >= rate:
+        return
+    max_chars = LOG_MAX_CHARS if max_chars is None else max_chars
+    if not isinstance(payload, str):
+        payload = json.dumps(payload, ensure_ascii=False, default=str)
+    if len(payload) > max_chars:
+        payload = f"{payload[:max_chars]}... ({len(payload)} 文字中 {max_chars} 文字を表示)"
+    print(f"{label}: {payload}")
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+過去のしおりページの表示用データ(ビューモデル)のキャッシュ。
+Streamlitはキャプションの入力や拡大表示の切り替えでもページ全体を再実行するため、
+その度にJSONの解析・DataFrameの作成・思い出の読み込みをやり直さないようにする。
+
+- キャッシュのキーは しおりのid、値は版数(itineraries.version)付きのビューモデル
+- 版数はしおり・思い出・場所が変わるとDBのトリガーで増えるので、変わったときだけ作り直す
+- 件数の上限を超えたら最も長く表示されていないしおりから追い出す
+- 思い出のサムネイルはパスだけを持ち、バイト列は表示のときに読む (キャッシュの大きさが写真の数に比例しないように)
+"""
+import json
+import os
+
+from okosy_cache import MISSING, TTLCache
+from okosy_db import get_itinerary_version, load_itinerary, load_itinerary_places
+from okosy_trace import span
+
+# --- ビューモデルキャッシュの設定 ---
+ITINERARY_VIEW_CACHE_SIZE = int(os.getenv("OKOSY_ITINERARY_VIEW_CACHE_SIZE", 32))
+ITINERARY_VIEW_CACHE_TTL = float(os.getenv("OKOSY_ITINERARY_VIEW_CACHE_TTL", 3600))  # 場所の評価などの更新を拾うため
+
+_view_cache = TTLCache(maxsize=ITINERARY_VIEW_CACHE_SIZE, ttl=ITINERARY_VIEW_CACHE_TTL)
+
+
+def _parse_preferences(preferences_json):
+    """好みのJSONを解析する。解析できなければ元の文字列を返す"""
+    try:
+        return json.loads(preferences_json)
+    except (TypeError, json.JSONDecodeError):
+        return preferences_json
+
+
+def _places_view(conn, itinerary_id, places_json):
+    """
+    場所の表示用データ {"places", "places_df", "places_error", "places_text"} を作る。
+    正規化したテーブルから読み、無ければ places_data のJSON (エラー結果など) を使う。
+    """
+    view = {"places": [], "places_df": None, "places_error": None, "places_text": None}
+    places = load_itinerary_places(conn, itinerary_id)
+    if not places and places_json:
+        try:
+            places_data = json.loads(places_json)
+        except json.JSONDecodeError:
+            view["places_text"] = places_json
+            return view
+        if isinstance(places_data, list):
+            places = places_data
+        elif isinstance(places_data, dict) and "error" in places_data:
+            view["places_error"] = places_data["error"]
+        else:
+            view["places_text"] = places_json
+    if places:
+        view["places"] = places
+        try:
+            import pandas as pd
+            view["places_df"] = pd.DataFrame(places)
+        except Exception as e:
+            print(f"場所の表の作成エラー (itinerary id={itinerary_id}): {e}")
+    return view
+
+
+def _memories_view(conn, itinerary_id):
+    """思い出の一覧を読み込む (未移行のBLOB行はここでファイルストアへ移す)"""
+    from okosy_photos import migrate_memory_photo
+
+    rows = conn.execute(
+        "SELECT id, caption, photo_path, display_path, thumb_path, creation_date FROM memories WHERE itinerary_id = ? ORDER BY creation_date DESC",
+        (itinerary_id,)
+    ).fetchall()
+    memories = []
+    for memory_id, caption, photo_path, display_path, thumb_path, creation_date in rows:
+        if thumb_path is None:
+            refs = migrate_memory_photo(conn, memory_id)
+            if refs:
+                photo_path, display_path, thumb_path = refs["photo_path"], refs["display_path"], refs["thumb_path"]
+        memories.append({
+            "id": memory_id, "caption": caption, "creation_date": creation_date,
+            "photo_path": photo_path, "display_path": display_path, "thumb_path": thumb_path,
+        })
+    return memories
+
+
+def load_itinerary_view(conn, itinerary_id):
+    """
+    しおりの表示用データを返す (見つからなければ None)。版数が変わっていなければキャッシュを使う。
+    {"id", "name", "creation_date", "content", "version", "preferences",
+     "places", "places_df", "places_error", "places_text", "memories"}
+    """
+    version = get_itinerary_version(conn, itinerary_id)
+    if version is None:
+        _view_cache.pop(itinerary_id)
+        return None
+    with span("view.itinerary", itinerary_id=itinerary_id, version=version) as current:
+        cached = _view_cache.get(itinerary_id)
+        if cached is not MISSING and cached["version"] == version:
+            current.set(cache="hit")
+            return cached
+        current.set(cache="miss" if cached is MISSING else "stale")
+
+        row = load_itinerary(conn, itinerary_id)
+        if row is None:
+            return None
+        _, name, creation_date, preferences_json, content, places_json = row
+        view = {
+            "id": itinerary_id, "name": name, "creation_date": creation_date, "content": content,
+            "preferences": _parse_preferences(preferences_json),
+            "memories": _memories_view(conn, itinerary_id),
+        }
+        view.update(_places_view(conn, itinerary_id, places_json))
+        # BLOB行の移行で版数が上がるので、作り終えた時点の版数で保存する
+        view["version"] = get_itinerary_version(conn, itinerary_id)
+        _view_cache.set(itinerary_id, view)
+        current.set(memories=len(view["memories"]), places=len(view["places"]))
+        return view
+
+
+def get_view_cache_stats():
+    """ビューモデルキャッシュのヒット率などを返す"""
+    return _view_cache.stats()
@@ -1,297 +1,170 @@
 # -*- coding: utf-8 -*-
+import time
+_rerun_started_at = time.perf_counter() # リラン毎の所要時間の計測開始
 import streamlit as st
 st.set_page_config(page_title="Okosy - 自分らしい旅をデザイン", layout="wide")
 st.title("Okosy - 自分らしい旅をデザイン")
 st.caption("SNSや広告にハックされない、“本来の旅”を取り戻す")
-import sqlite3
-import openai
-# ★★★ OpenAI v1.x 対応: OpenAI クラスをインポート ★★★
-from openai import OpenAI
-import requests
 import json
 import os
 import datetime
-from dotenv import load_dotenv
-from PIL import Image
-import io
-import pandas as pd
+from collections import deque
+from okosy_db import (ITINERARY_PAGE_SIZE, db_connection, init_db, list_itineraries, save_itinerary_places,
+                      search_itineraries, sync_itinerary_bigrams)
+from okosy_cache import MISSING, itinerary_cache, itinerary_cache_key
+from okosy_jobs import FINISHED_STATUSES, JobQueueFullError
+from okosy_media import load_place_media
+from okosy_views import get_view_cache_stats, load_itinerary_view
+from okosy_trace import begin_trace, current_span, end_trace, get_recent_traces, get_span_stats, span
+# pandas / PIL(okosy_photos) は重いので、使うページで必要になったときに読み込む
+_rerun_trace = begin_trace("streamlit.rerun") # このリランで実行した処理をトレースとして記録する
+
+# --- 0. プロセス内で1回だけ作るリソース ---
+# Streamlitはウィジェット操作の度にこのスクリプトを先頭から再実行するため、
+# 設定の読み込み・クライアントの生成・DB初期化は st.cache_resource で1回だけ行う
+
+@st.cache_resource
+def get_timing_stats():
+    """起動時(リソース初期化)とリラン毎の所要時間の記録"""
+    return {"startup": {}, "reruns": deque(maxlen=200)}
+
+def _timed_init(name, func):
+    started = time.perf_counter()
+    result = func()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    get_timing_stats()["startup"][name] = elapsed_ms
+    print(f"リソース初期化: {name} {elapsed_ms:.1f}ms")
+    return result
+
+@st.cache_resource
+def load_config():
+    """.env を読み込み、APIキーなどの設定を返す"""
+    def load():
+        from dotenv import load_dotenv
+        load_dotenv()
+        return {
+            "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
+            "GOOGLE_PLACES_API_KEY": os.getenv("GOOGLE_PLACES_API_KEY"),
+        }
+    return _timed_init("config", load)
+
+@st.cache_resource
+def get_openai_client():
+    """OpenAIクライアント (内部のHTTPコネクションプールごと使い回す)"""
+    def create():
+        # ★★★ OpenAI v1.x 対応: クライアントを初期化 ★★★
+        # 環境変数 OPENAI_API_KEY は自動的に読み込まれます
+        from openai import OpenAI
+        return OpenAI()
+    return _timed_init("openai_client", create)
+
+@st.cache_resource
+def get_generation_jobs():
+    """しおり生成ジョブのワーカープール (リランやセッションをまたいで実行を続ける)"""
+    def create():
+        from okosy_jobs import GenerationJobManager
+        return GenerationJobManager(get_openai_client(), stream=STREAM_GENERATION)
+    return _timed_init("generation_jobs", create)
+
+@st.cache_resource
+def init_database():
+    """DB初期化 (コネクションプール・WAL設定・マイグレーションは okosy_db.py に定義)"""
+    _timed_init("database", init_db)
+    return True
 
 # --- 1. 環境変数の読み込みと初期設定 ---
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
+config = load_config()
+OPENAI_API_KEY = config["OPENAI_API_KEY"]
+GOOGLE_PLACES_API_KEY = config["GOOGLE_PLACES_API_KEY"]
 
 if not OPENAI_API_KEY:
     st.error("OpenAI APIキーが見つかりません。.envファイルを確認してください。")
+    load_config.clear() # .env を修正したら次のリランで読み直す
     st.stop()
 
 if not GOOGLE_PLACES_API_KEY:
     st.error("Google Places APIキーが見つかりません。.envファイルを確認してください。")
+    load_config.clear()
     st.stop()
 
-# ★★★ OpenAI v1.x 対応: クライアントを初期化 ★★★
-# 環境変数 OPENAI_API_KEY は自動的に読み込まれます
-client = OpenAI()
+client = get_openai_client()
 
 # --- 2. データベースの初期設定 (SQLite) ---
-DATABASE_NAME = "okosy_data_noauth.db"
-
-def get_db_connection():
-    """SQLiteデータベースへのコネクションを取得する"""
-    return sqlite3.connect(DATABASE_NAME)
-
-def init_db():
-    """
-    データベースのテーブルが存在しなければ作成する
-    - しおり(itineraries)
-    - 思い出(memories)
-    """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # しおりテーブル (usernameなし)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS itineraries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            preferences TEXT,
-            generated_content TEXT,
-            places_data TEXT,
-            creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    # 思い出テーブル
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            itinerary_id INTEGER NOT NULL,
-            caption TEXT,
-            photo BLOB,
-            creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (itinerary_id) REFERENCES itineraries (id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-# DB初期化を実行
-init_db()
+init_database()
 
 # --- 3. 認証関連コードは削除済み ---
 
 # --- 4. Google Maps関連のヘルパー関数 ---
-def get_coordinates(address):
-    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
-    params = {
-        "address": address,
-        "key": GOOGLE_PLACES_API_KEY,
-        "language": "ja",
-        "region": "JP"
-    }
-    try:
-        response = requests.get(geocode_url, params=params)
-        response.raise_for_status()
-        results = response.json()
-        if results["status"] == "OK" and results["results"]:
-            location = results["results"][0]["geometry"]["location"]
-            return f"{location['lat']},{location['lng']}"
-        else:
-            print(f"Geocoding失敗: {results.get('status')}, {results.get('error_message', '')}")
-            return None
-    except Exception as e:
-        print(f"Geocodingエラー: {e}")
-        return None
-
-def search_google_places(query: str,
-                         location_bias: str = None,
-                         place_type: str = "tourist_attraction",
-                         min_rating: float = 4.0,
-                         price_levels: str = None):
-    print("--- Google Places API 呼び出し ---")
-    print(f"Query: {query}, Location Bias: {location_bias}, Type: {place_type}, Rating: {min_rating}, Price: {price_levels}")
-    base_url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
-    params = {
-        "query": query,
-        "key": GOOGLE_PLACES_API_KEY,
-        "language": "ja",
-        "region": "JP",
-        "type": place_type,
-    }
-    if location_bias:
-        params["location"] = location_bias
-        params["radius"] = 20000
-    print(f"リクエストパラメータ: {params}")
-    try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-        results = response.json()
-        status = results.get("status")
-        if status == "OK":
-            filtered_places = []
-            count = 0
-            for place in results.get("results", []):
-                place_rating = place.get("rating", 0)
-                place_price = place.get("price_level", None)
-                if place_rating < min_rating: continue
-                if price_levels:
-                    try:
-                        allowed_levels = [int(x.strip()) for x in price_levels.split(',')]
-                        if place_price not in allowed_levels: continue
-                    except ValueError: print(f"価格レベルの解析エラー: {price_levels}")
-                filtered_places.append({
-                    "name": place.get("name"), "address": place.get("formatted_address"),
-                    "rating": place_rating, "price_level": place_price,
-                    "types": place.get("types", []), "place_id": place.get("place_id"),
-                })
-                count += 1
-                if count >= 5: break
-            if not filtered_places:
-                return json.dumps({"error": "条件に合致する場所がありませんでした。"}, ensure_ascii=False)
-            return json.dumps(filtered_places, ensure_ascii=False)
-        else:
-            error_msg = results.get('error_message', '')
-            print(f"Google Places API エラー: {status}, {error_msg}")
-            return json.dumps({"error": f"Google Places API Error: {status}, {error_msg}"}, ensure_ascii=False)
-    except Exception as e:
-        print(f"HTTPリクエストエラー: {e}")
-        return json.dumps({"error": f"HTTPエラー: {e}"}, ensure_ascii=False)
-
+# get_coordinates / search_google_places はキャッシュ付きで okosy_google.py に定義
+# (リランやセッションをまたいでキャッシュを共有するため)
+# 場所の詳細・写真は生成中に okosy_media.py が先読みしておき、画面はそれだけで描画する
 
-# --- 5. OpenAIのFunction Callingを組み込むための準備 ---
+PRICE_LEVEL_LABELS = {0: "無料", 1: "¥", 2: "¥¥", 3: "¥¥¥", 4: "¥¥¥¥"}
 
-# ★★★ OpenAI v1.x 対応: functions -> tools 形式に変更 ★★★
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "search_google_places",
-            "description": "Google Places APIを使って観光名所やレストランなどを検索する。隠れ家的なお店や、静かなカフェ、旅館など具体的な場所情報が必要なときに呼び出す。",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {"type": "string", "description": "検索したい場所のキーワード (例: '京都 抹茶 スイーツ')"},
-                    "location_bias": {"type": "string", "description": "検索の中心とする緯度経度 (例: '35.0116,135.7681')。行き先の座標を指定すると精度が上がる。"},
-                    "place_type": {
-                        "type": "string",
-                        "description": "検索する場所の種類",
-                        "enum": [
-                            "tourist_attraction", "restaurant", "lodging", "cafe",
-                            "museum", "park", "art_gallery", "store"
-                        ]
-                    },
-                    "min_rating": {"type": "number", "description": "検索結果に含める最低評価 (例: 4.0)"},
-                    "price_levels": {"type": "string", "description": "検索結果に含める価格帯（カンマ区切り、例: '1,2'）。1:安い, 2:普通, 3:やや高い, 4:高い"}
-                },
-                "required": ["query", "place_type"]
-            }
-        }
-    }
-]
-# --- ここまで tools 定義 ---
-
-# --- 呼び出し可能な関数名と実際の関数オブジェクトのマッピング (変更なし) ---
-available_functions = {
-    "search_google_places": search_google_places
-}
-# --- ここまで 関数マッピング ---
-
-# ★★★ OpenAI v1.x 対応: API呼び出しとレスポンス処理を修正 ★★★
-def run_conversation_with_function_calling(messages):
+def render_place_cards(conn, places):
     """
-    OpenAIに対しチャットを送信し、もしTool Callがあれば実行して結果を再度OpenAIに渡す。
-    最終的に得られたアシスタントからのテキスト返信と、関数が呼ばれた場合はその結果(JSON文字列)を返す。
+    場所カード(写真・評価・営業時間)と地図を、先読み済みのデータだけで表示する (APIは呼ばない)。
+    先読みが済んでいる場所が1件も無ければ何も表示せず False を返す。
     """
-    try:
-        # --- OpenAI API v1.x 呼び出し (1回目) ---
-        response = client.chat.completions.create(
-            # model="gpt-3.5-turbo-0613", # 古いモデル名
-            model="gpt-3.5-turbo",     # 推奨: 最新のgpt-3.5-turboモデル
-            messages=messages,
-            tools=tools,              # ★ functions -> tools
-            tool_choice="auto"        # ★ function_call -> tool_choice
-        )
-        # --- ここまで OpenAI API呼び出し (1回目) ---
-        response_message = response.choices[0].message # ★ レスポンスオブジェクト取得
-
-        # ★ Tool Call が要求されているかチェック (旧 Function Call)
-        tool_calls = response_message.tool_calls
-        if tool_calls:
-            # 最初のTool Callを処理（複数Tool Callには対応しないシンプルな実装）
-            tool_call = tool_calls[0]
-            function_name = tool_call.function.name
-            function_to_call = available_functions.get(function_name)
-
-            if function_to_call:
-                # 引数を取得
-                function_args = json.loads(tool_call.function.arguments)
-
-                # location_biasの補完ロジック (変更なし)
-                if 'location_bias' not in function_args and 'dest' in st.session_state and st.session_state.dest:
-                     coords = get_coordinates(st.session_state.dest)
-                     if coords:
-                         function_args['location_bias'] = coords
-                         print(f"座標が見つかりました。location_bias を補完: {coords}")
-                     else:
-                         print(f"座標が見つかりませんでした。location_bias はなしで検索します。")
-
-                # ★ 実際の関数を実行
-                function_response = function_to_call(**function_args)
-
-                # ★★★ Tool Call の結果をメッセージ履歴に追加 ★★★
-                messages.append(response_message) # AIの応答（Tool Call指示）を履歴に追加
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id, # ★ Tool Call ID が必要
-                        "role": "tool",             # ★ role は "tool"
-                        "name": function_name,
-                        "content": function_response, # 関数の実行結果(JSON文字列)
-                    }
-                )
-                # --- ここまで toolロールメッセージ追加 ---
-
-                # 2回目のリクエスト (ツールの結果を考慮した最終応答)
-                print("--- Sending tool results back to OpenAI ---") # デバッグ用
-                print(f"Messages sent (2nd req): {messages}")      # デバッグ用
-                second_response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=messages # ツール結果を含むメッセージ履歴
-                )
-                # --- ここまで OpenAI API呼び出し (2回目) ---
-
-                # ★ 最終応答と関数結果(JSON文字列)を返す
-                final_content = second_response.choices[0].message.content
-                return final_content, function_response
-            else:
-                # 指定された関数が見つからない場合
-                print(f"Error: Function '{function_name}' not found in available_functions.")
-                return f"エラー: 内部関数 '{function_name}' が見つかりません。", None
-        else:
-            # --- Tool Call なしの通常返信 ---
-            final_content = response_message.content
-            return final_content, None
-            # --- ここまで 通常返信の場合 ---
-
-    except openai.APIError as e:
-        # OpenAI API自体から返されたエラー (例: レート制限、認証エラー)
-        st.error(f"OpenAI APIエラーが発生しました: {e}")
-        print(f"OpenAI API Error: {e.status_code} - {e.message}") # 詳細ログ
-        return "申し訳ありません、AIとの通信中にAPIエラーが発生しました。", None
-    except Exception as e:
-        # その他の予期せぬエラー
-        st.error(f"OpenAIとの通信中に予期せぬエラーが発生しました: {e}")
-        import traceback
-        st.error(traceback.format_exc()) # 詳細なトレースバックを表示
-        return "申し訳ありません、AIとの通信中に予期せぬエラーが発生しました。", None
+    media = load_place_media(conn, [place.get("place_id") for place in places])
+    if not media:
+        return False
+    with span("render.place_cards", places=len(places), cached=len(media)):
+        points = [{"lat": m["lat"], "lon": m["lng"]} for m in media.values()
+                  if m.get("lat") is not None and m.get("lng") is not None]
+        if points:
+            import pandas as pd
+            st.map(pd.DataFrame(points), size=40, height=300)
+        card_cols = st.columns(3)
+        for index, place_id in enumerate(pid for pid in dict.fromkeys(p.get("place_id") for p in places) if pid in media):
+            m = media[place_id]
+            with card_cols[index % 3]:
+                with st.container(border=True):
+                    if m["photo"]:
+                        st.image(m["photo"], use_container_width=True)
+                    title = f"**[{m['name']}]({m['url']})**" if m.get("url") else f"**{m['name']}**"
+                    st.markdown(title)
+                    facts = []
+                    if m.get("rating") is not None:
+                        facts.append(f"★{m['rating']}" + (f" ({m['user_ratings_total']}件)" if m.get("user_ratings_total") else ""))
+                    if m.get("price_level") in PRICE_LEVEL_LABELS:
+                        facts.append(PRICE_LEVEL_LABELS[m["price_level"]])
+                    if facts:
+                        st.caption(" / ".join(facts))
+                    if m.get("address"):
+                        st.caption(m["address"])
+                    if m.get("opening_hours"):
+                        st.caption("  \n".join(m["opening_hours"]))
+                    if m.get("website"):
+                        st.markdown(f"[公式サイト]({m['website']})")
+    return True
+
+
+# --- 5. OpenAIのFunction Callingを組み込むための準備 ---
+
+# tools 定義・関数マッピング・run_conversation_with_function_calling は okosy_agent.py に定義
+# (ツール実行用のスレッドプールをプロセス内で共有するため)
+# 生成はバックグラウンドのジョブ (okosy_jobs.py) で実行し、画面はその完了を待つ
+
+# しおり生成をストリーミング表示するか (OKOSY_STREAMING=0 で従来のスピナー表示)
+STREAM_GENERATION = os.getenv("OKOSY_STREAMING", "1") != "0"
+STREAM_RENDER_INTERVAL = 0.05 # ストリーミング中の再描画間隔(秒)
 
 
 # --- 6. Streamlitの画面構成 (認証なし) ---
 
 # --- サイドバー ---
 st.sidebar.header("メニュー")
-menu_choice = st.sidebar.radio("", ["新しい旅を計画する", "過去の旅のしおりを見る"], key="main_menu", label_visibility="collapsed")
+# 管理者用ページは OKOSY_ADMIN_TOKEN を設定し、URLに ?admin=<トークン> を付けたときだけ表示する
+ADMIN_TOKEN = os.getenv("OKOSY_ADMIN_TOKEN")
+is_admin = bool(ADMIN_TOKEN) and st.query_params.get("admin") == ADMIN_TOKEN
+menu_options = ["新しい旅を計画する", "過去の旅のしおりを見る"] + (["トレース (管理者用)"] if is_admin else [])
+menu_choice = st.sidebar.radio("", menu_options, key="main_menu", label_visibility="collapsed")
+current_span().set(page=menu_choice)
 
 # --- セッションステート初期化 ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "generation_job_id" not in st.session_state:
+    st.session_state.generation_job_id = None
 if "itinerary_generated" not in st.session_state:
     st.session_state.itinerary_generated = False
 # ...(他のセッションステートも同様)...
@@ -301,6 +174,8 @@ if "final_places_data" not in st.session_state:
     st.session_state.final_places_data = None
 if "basic_info_submitted" not in st.session_state:
     st.session_state.basic_info_submitted = False
+if "archive_job_id" not in st.session_state:
+    st.session_state.archive_job_id = None
 if "preferences_submitted" not in st.session_state:
     st.session_state.preferences_submitted = False
 if "preferences" not in st.session_state:
@@ -351,6 +226,7 @@ if menu_choice == "新しい旅を計画する":
             st.session_state.pref_vibe_quiet = st.radio("好み雰囲気", ["静かで落ち着いた", "活気のある"], index=["静かで落ち着いた", "活気のある"].index(st.session_state.get('pref_vibe_quiet', '静かで落ち着いた')))
             st.session_state.pref_vibe_discover = st.checkbox("隠れた発見をしたい", value=st.session_state.get('pref_vibe_discover', True))
             st.session_state.pref_experience = st.multiselect("興味ある体験", ["温泉", "ものづくり", "寺社仏閣", "食べ歩き", "ショッピング", "何もしない"], default=st.session_state.get('pref_experience', []))
+            regenerate = st.checkbox("同じ条件でも新しい提案を生成する", value=False, help="オフの場合、同じ条件で作成済みのしおりがあれば再利用します")
             submitted_prefs = st.form_submit_button("好みを確定して旅のしおりを生成")
 
         if submitted_prefs:
@@ -363,43 +239,74 @@ if menu_choice == "新しい旅を計画する":
                 "vibe_quiet": st.session_state.pref_vibe_quiet, "vibe_discover": st.session_state.pref_vibe_discover,
                 "experience": st.session_state.pref_experience
             }
-            st.info("しおりを作成中です。少々お待ちください...")
-            prompt = f"""
-あなたは旅のプランナー「Okosy」です。ユーザーの入力情報をもとに、SNS映えや定番から少し離れた、ユーザー自身の感性に寄り添うような、パーソナルな旅のしおりを作成してください。
-
-【基本情報】
-- 行き先: {st.session_state.dest}
-- 目的・気分: {st.session_state.purp}
-- 同行者: {st.session_state.comp}
-- 旅行日数: {st.session_state.days}日
-- 予算感: {st.session_state.budg}
-
-【ユーザーの好み】
-{json.dumps(st.session_state.preferences, ensure_ascii=False, indent=2)}
-
-【出力指示】
-1.  **構成:** {st.session_state.days}日間の旅程を、各日ごとに「午前」「午後」「夜」のセクションに分けて提案してください。
-2.  **内容:**
-    * なぜその場所や過ごし方がユーザーの目的・気分・好みに合っているか、**感性的な言葉**で理由や提案コメントを添えてください。
-    * ユーザーの「隠れた発見をしたい」という気持ち（`vibe_discover`がTrueの場合）を考慮し、定番すぎないスポットや体験も提案に含めてください。
-    * 食事や宿泊の好みも反映してください。
-    * `search_google_places`ツールを**必要に応じて**呼び出し、具体的な場所の候補を検索してください。
-    * ツールの結果が得られた場合は、その場所名を旅程に自然に組み込んでください。エラーが返ってきた場合は、代替案を提示してください。
-3.  **形式:** 全体を読みやすい**マークダウン形式**で出力してください。
-
-Okosyとして、ユーザーに最高の旅体験をデザインしてください。
-            """
-            st.session_state.messages = [{"role": "user", "content": prompt}]
-            with st.spinner("AIが旅のしおりを作成しています..."):
-                # ★★★ run_conversation_with_function_calling を呼び出す ★★★
-                final_response, places_api_result = run_conversation_with_function_calling(st.session_state.messages)
-            if final_response:
+            cache_key = itinerary_cache_key(
+                st.session_state.dest, st.session_state.purp, st.session_state.comp,
+                st.session_state.days, st.session_state.budg, st.session_state.preferences)
+            cached_itinerary = MISSING if regenerate else itinerary_cache.get(cache_key)
+            if cached_itinerary is not MISSING:
+                # 同じ条件のしおりがキャッシュにあれば OpenAI / Google を呼ばずに再利用する
+                final_response, places_api_result = cached_itinerary
+                cache_stats = itinerary_cache.stats()
+                print(f"しおりキャッシュ ヒット (ヒット率: {cache_stats['hit_ratio']:.1%})")
+                current_span().set(itinerary_cache="hit")
+                st.caption("同じ条件で作成済みのしおりを表示しています。作り直す場合は「同じ条件でも新しい提案を生成する」にチェックしてください。")
                 st.session_state.itinerary_generated = True
                 st.session_state.generated_shiori_content = final_response
                 st.session_state.final_places_data = places_api_result
                 st.success("旅のしおりが完成しました！")
             else:
-                st.error("しおりの生成中にエラーが発生しました。")
+                # 生成はバックグラウンドのジョブで行い、ここではジョブIDだけを覚えておく
+                # (完了を待つ間にリランされても、同じジョブの結果を受け取れる)
+                current_span().set(itinerary_cache="miss")
+                try:
+                    st.session_state.generation_job_id = get_generation_jobs().submit(cache_key, {
+                        "dest": st.session_state.dest, "purp": st.session_state.purp,
+                        "comp": st.session_state.comp, "days": st.session_state.days,
+                        "budg": st.session_state.budg, "preferences": st.session_state.preferences,
+                    })
+                    st.session_state.itinerary_generated = False
+                except JobQueueFullError as e:
+                    st.warning(str(e))
+
+        if st.session_state.generation_job_id:
+            # --- 生成ジョブの完了待ち (進捗と、ストリーミング時は途中の本文を表示する) ---
+            generation_jobs = get_generation_jobs()
+            job_id = st.session_state.generation_job_id
+            status_box = st.status("AIが旅のしおりを作成しています...", expanded=True)
+            stream_placeholder = st.empty()
+            shown_progress = None
+            with span("generation.wait", job_id=job_id):
+                while True:
+                    job = generation_jobs.get(job_id)
+                    if job is None or job["status"] in FINISHED_STATUSES:
+                        break
+                    progress = job["progress"] or ("順番を待っています..." if job["status"] == "queued" else None)
+                    if progress and progress != shown_progress:
+                        status_box.write(progress)
+                        status_box.update(label=progress)
+                        shown_progress = progress
+                    if STREAM_GENERATION and job["partial_content"]:
+                        stream_placeholder.markdown(job["partial_content"] + "▌")
+                    else:
+                        stream_placeholder.empty()
+                    generation_jobs.wait(job_id, job["version"])
+                    time.sleep(STREAM_RENDER_INTERVAL) # 再描画は間引く (トークン毎にMarkdown全体を描き直さない)
+            # 完成版は下の「あなたの旅のしおり」で表示するのでプレースホルダーは消す
+            stream_placeholder.empty()
+            st.session_state.generation_job_id = None
+            if job and job["status"] in ("succeeded", "partial"):
+                status_box.update(label="しおりの作成が完了しました", state="complete", expanded=False)
+                st.session_state.itinerary_generated = True
+                st.session_state.generated_shiori_content = job["result_content"]
+                st.session_state.final_places_data = job["places_data"]
+                if job["status"] == "partial":
+                    # 一部の日が欠けた結果はキャッシュしていないので、もう一度作成すれば全日そろう可能性がある
+                    st.warning(f"{job['error']} もう一度作成すると、その日の提案も作成し直します。")
+                else:
+                    st.success("旅のしおりが完成しました！")
+            else:
+                status_box.update(label="しおりの作成に失敗しました", state="error", expanded=False)
+                st.error(job["error"] if job else "しおりの生成中にエラーが発生しました。")
 
     if st.session_state.itinerary_generated and st.session_state.generated_shiori_content:
         st.subheader("あなたの旅のしおり")
@@ -411,7 +318,10 @@ Okosyとして、ユーザーに最高の旅体験をデザインしてくださ
                 try:
                     places = json.loads(st.session_state.final_places_data)
                     if isinstance(places, list):
+                        with db_connection() as conn:
+                            render_place_cards(conn, places)
                         try:
+                            import pandas as pd
                             df = pd.DataFrame(places)
                             st.dataframe(df)
                         except Exception as e: st.write(places)
@@ -433,15 +343,15 @@ Okosyとして、ユーザーに最高の旅体験をデザインしてくださ
                 st.warning("しおりの名前を入力してください。")
             else:
                 try:
-                    conn = get_db_connection()
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "INSERT INTO itineraries (name, preferences, generated_content, places_data) VALUES (?, ?, ?, ?)",
-                        (shiori_name, json.dumps(st.session_state.preferences, ensure_ascii=False),
-                         st.session_state.generated_shiori_content, st.session_state.final_places_data)
-                    )
-                    conn.commit()
-                    conn.close()
+                    with db_connection() as conn:
+                        cursor = conn.execute(
+                            "INSERT INTO itineraries (name, preferences, generated_content, places_data) VALUES (?, ?, ?, ?)",
+                            (shiori_name, json.dumps(st.session_state.preferences, ensure_ascii=False),
+                             st.session_state.generated_shiori_content, st.session_state.final_places_data)
+                        )
+                        # 場所は place_id で重複をまとめて places テーブルにも保存する
+                        save_itinerary_places(cursor, cursor.lastrowid, st.session_state.final_places_data)
+                        sync_itinerary_bigrams(cursor) # 2文字の語の検索用インデックスにも登録する
                     st.success(f"しおり「{shiori_name}」を保存しました！")
                     # 状態リセット (変更なし)
                     keys_to_reset = [
@@ -462,118 +372,340 @@ Okosyとして、ユーザーに最高の旅体験をデザインしてくださ
 
 # --- 8. 過去の旅のしおりを見る ---
 elif menu_choice == "過去の旅のしおりを見る":
+    from okosy_photos import PhotoValidationError, photo_abspath, release_photo, store_photo_async
     st.header("過去の旅のしおり")
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, creation_date, preferences, generated_content, places_data FROM itineraries ORDER BY creation_date DESC")
-        past_itineraries = cursor.fetchall()
-
-        if not past_itineraries:
-            st.info("保存されているしおりはありません。")
-        else:
-            if 'selected_itinerary_id' not in st.session_state:
-                st.session_state.selected_itinerary_id = None
-
-            itinerary_options = {f"{row[1]} ({row[2].split()[0]})": row[0] for row in past_itineraries}
-            if itinerary_options:
-                 selected_name = st.selectbox("表示するしおりを選択してください", options=list(itinerary_options.keys()), index=0)
-                 st.session_state.selected_itinerary_id = itinerary_options.get(selected_name)
-
-            selected_itinerary = None
-            if st.session_state.selected_itinerary_id is not None:
-                for row in past_itineraries:
-                    if row[0] == st.session_state.selected_itinerary_id:
-                        selected_itinerary = row
-                        break
-
-            if selected_itinerary:
-                iti_id, iti_name, iti_date, iti_prefs_json, iti_content, iti_places_json = selected_itinerary
-                st.subheader(f"しおり: {iti_name}")
-                st.caption(f"作成日: {iti_date}")
-                st.markdown("---")
-                st.markdown(iti_content)
-                st.markdown("---")
-
-                with st.expander("このしおりを作成した時の好み"):
-                    # (好み表示部分は変更なし)
-                    try:
-                        prefs_dict = json.loads(iti_prefs_json)
-                        st.json(prefs_dict)
-                    except Exception as e: st.text(iti_prefs_json) # エラー時はテキスト表示
-
-                if iti_places_json:
-                    with st.expander("関連する場所の情報 (Google Places APIの結果)"):
-                         # (場所情報表示部分は変更なし)
-                        try:
-                            places_data = json.loads(iti_places_json)
-                            if isinstance(places_data, list):
-                                 try:
-                                    df = pd.DataFrame(places_data)
-                                    st.dataframe(df)
-                                 except Exception as e: st.write(places_data)
-                            elif isinstance(places_data, dict) and 'error' in places_data:
-                                st.warning(f"場所情報の取得時にエラーが記録されています: {places_data['error']}")
-                            else: st.write(places_data)
-                        except json.JSONDecodeError: st.text(iti_places_json) # エラー時はテキスト表示
-                        except Exception as e: st.text(iti_places_json) # エラー時はテキスト表示
-
-                st.subheader("旅の思い出")
-                with st.form("memory_form"):
-                    # (思い出フォーム部分は変更なし)
-                    memory_caption = st.text_area("キャプション", key=f"mem_caption_{iti_id}")
-                    uploaded_photo = st.file_uploader("写真を選択", type=["jpg", "jpeg", "png"], key=f"mem_photo_{iti_id}")
-                    submitted_memory = st.form_submit_button("思い出を追加")
-                    if submitted_memory:
-                        if uploaded_photo is not None:
-                            photo_bytes = uploaded_photo.getvalue()
-                            try:
-                                conn_mem = get_db_connection()
-                                cursor_mem = conn_mem.cursor()
-                                cursor_mem.execute("INSERT INTO memories (itinerary_id, caption, photo) VALUES (?, ?, ?)",
-                                    (iti_id, memory_caption, photo_bytes))
-                                conn_mem.commit()
-                                conn_mem.close()
-                                st.success("思い出を追加しました！")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"思い出の保存中にエラーが発生しました: {e}")
-                                import traceback
-                                st.error(traceback.format_exc())
-                        else: st.warning("写真を選択してください。")
-
-                cursor.execute("SELECT id, caption, photo, creation_date FROM memories WHERE itinerary_id = ? ORDER BY creation_date DESC", (iti_id,))
-                past_memories = cursor.fetchall()
-                if past_memories:
-                    st.write("---")
-                    st.write("**登録済みの思い出:**")
-                    for mem_id, mem_caption, mem_photo_blob, mem_date in past_memories:
-                        # (思い出表示部分は変更なし)
-                        cols = st.columns([1, 3])
-                        with cols[0]:
-                            try:
-                                image = Image.open(io.BytesIO(mem_photo_blob))
-                                st.image(image, width=150)
-                            except Exception as e: st.warning(f"画像表示エラー: {e}")
-                        with cols[1]:
-                            st.write(f"**{mem_date.split()[0]}**")
-                            st.write(mem_caption if mem_caption else "(キャプションなし)")
-                            if st.button("削除", key=f"delete_mem_{mem_id}"):
+        # ページ描画の間はプールのコネクションを1つ借りて使う (st.rerun() で抜けても返却される)
+        with db_connection() as conn:
+            browse_mode = st.radio("しおりの探し方", ["一覧から選ぶ", "キーワードで検索"], horizontal=True, key="itinerary_browse_mode")
+            search_results = None
+            page_cursors = [None]
+            has_next_page = False
+            if browse_mode == "キーワードで検索":
+                # --- 名前・本文・場所名の全文検索 (FTS5) ---
+                search_query = st.text_input("キーワード (例: 嵐山、旅館)", key="itinerary_search_query").strip()
+                search_results = search_itineraries(conn, search_query) if search_query else []
+                page_rows = [row[:3] for row in search_results]
+                empty_message = "キーワードに一致するしおりはありません。" if search_query else "キーワードを入力してください。"
+            else:
+                # --- 一覧は id, name, creation_date だけをページ単位で読み込む ---
+                name_filter = st.text_input("しおりの名前で絞り込み", key="itinerary_name_filter").strip()
+                if st.session_state.get("itinerary_page_filter") != name_filter:
+                    # 絞り込み条件が変わったら1ページ目に戻る
+                    st.session_state.itinerary_page_filter = name_filter
+                    st.session_state.itinerary_page_cursors = [None]
+                page_cursors = st.session_state.setdefault("itinerary_page_cursors", [None])
+
+                # 次ページの有無を判定するため1件多く取得する
+                page_rows = list_itineraries(conn, limit=ITINERARY_PAGE_SIZE + 1, after=page_cursors[-1], name_filter=name_filter)
+                has_next_page = len(page_rows) > ITINERARY_PAGE_SIZE
+                page_rows = page_rows[:ITINERARY_PAGE_SIZE]
+                empty_message = "条件に合うしおりはありません。" if name_filter else "保存されているしおりはありません。"
+
+            if not page_rows and len(page_cursors) == 1:
+                st.info(empty_message)
+            else:
+                if 'selected_itinerary_id' not in st.session_state:
+                    st.session_state.selected_itinerary_id = None
+
+                itinerary_labels = {row[0]: f"{row[1]} ({str(row[2]).split()[0]})" for row in page_rows}
+                if itinerary_labels:
+                     st.session_state.selected_itinerary_id = st.selectbox(
+                         "表示するしおりを選択してください", options=list(itinerary_labels.keys()),
+                         format_func=itinerary_labels.get, index=0)
+
+                if search_results is not None:
+                    # 検索結果は関連度順に、一致箇所を強調した抜粋付きで表示する
+                    with st.expander(f"検索結果 ({len(search_results)} 件)", expanded=True):
+                        for _, result_name, result_date, result_snippet in search_results:
+                            st.markdown(f"**{result_name}** ({str(result_date).split()[0]})  \n{result_snippet}")
+                else:
+                    nav_cols = st.columns([1, 1, 4])
+                    with nav_cols[0]:
+                        if st.button("← 前へ", disabled=len(page_cursors) == 1, key="itinerary_prev_page"):
+                            page_cursors.pop()
+                            st.rerun()
+                    with nav_cols[1]:
+                        if st.button("次へ →", disabled=not has_next_page, key="itinerary_next_page"):
+                            page_cursors.append((page_rows[-1][2], page_rows[-1][0]))
+                            st.rerun()
+                    with nav_cols[2]:
+                        st.caption(f"{len(page_cursors)} ページ目")
+
+                # 選択されたしおりの表示用データ (好み・場所の表・思い出のサムネイル) は
+                # しおりの版数が変わったときだけ作り直す (okosy_views.py)
+                itinerary_view = None
+                if st.session_state.selected_itinerary_id is not None:
+                    itinerary_view = load_itinerary_view(conn, st.session_state.selected_itinerary_id)
+
+                if itinerary_view:
+                    iti_id = itinerary_view["id"]
+                    st.subheader(f"しおり: {itinerary_view['name']}")
+                    st.caption(f"作成日: {itinerary_view['creation_date']}")
+                    st.markdown("---")
+                    st.markdown(itinerary_view["content"])
+                    st.markdown("---")
+
+                    with st.expander("このしおりを作成した時の好み"):
+                        if isinstance(itinerary_view["preferences"], dict):
+                            st.json(itinerary_view["preferences"])
+                        else: st.text(itinerary_view["preferences"]) # 解析できなかった場合はテキスト表示
+
+                    if itinerary_view["places"] or itinerary_view["places_error"] or itinerary_view["places_text"]:
+                        with st.expander("関連する場所の情報 (Google Places APIの結果)"):
+                            if itinerary_view["places"]:
+                                render_place_cards(conn, itinerary_view["places"])
+                                if itinerary_view["places_df"] is not None:
+                                    st.dataframe(itinerary_view["places_df"])
+                                else: st.write(itinerary_view["places"])
+                            elif itinerary_view["places_error"]:
+                                st.warning(f"場所情報の取得時にエラーが記録されています: {itinerary_view['places_error']}")
+                            else: st.text(itinerary_view["places_text"]) # 解析できなかった場合はテキスト表示
+
+                    st.subheader("旅の思い出")
+                    with st.form("memory_form"):
+                        # (思い出フォーム部分は変更なし)
+                        memory_caption = st.text_area("キャプション", key=f"mem_caption_{iti_id}")
+                        uploaded_photo = st.file_uploader("写真を選択", type=["jpg", "jpeg", "png"], key=f"mem_photo_{iti_id}")
+                        submitted_memory = st.form_submit_button("思い出を追加")
+                        if submitted_memory:
+                            if uploaded_photo is not None:
+                                photo_bytes = uploaded_photo.getvalue()
                                 try:
-                                    conn_del = get_db_connection()
-                                    cursor_del = conn_del.cursor()
-                                    cursor_del.execute("DELETE FROM memories WHERE id = ?", (mem_id,))
-                                    conn_del.commit()
-                                    conn_del.close()
-                                    st.success("思い出を削除しました。")
+                                    # 写真は縮小・再エンコードしてファイルストアへ。DBには参照とサイズのみ保存
+                                    with st.spinner("写真を処理しています..."):
+                                        photo_refs = store_photo_async(photo_bytes).result()
+                                    with conn:
+                                        conn.execute(
+                                            '''INSERT INTO memories (itinerary_id, caption, photo_path, display_path, thumb_path,
+                                                                   photo_width, photo_height, original_bytes, stored_bytes)
+                                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                            (iti_id, memory_caption, photo_refs["photo_path"], photo_refs["display_path"],
+                                             photo_refs["thumb_path"], photo_refs["photo_width"], photo_refs["photo_height"],
+                                             photo_refs["original_bytes"], photo_refs["stored_bytes"]))
+                                    print(f"写真を保存しました: {photo_refs['original_bytes'] / 1024:.0f}KB → {photo_refs['stored_bytes'] / 1024:.0f}KB")
+                                    st.success("思い出を追加しました！")
                                     st.rerun()
-                                except Exception as e: st.error(f"削除中にエラー: {e}")
+                                except PhotoValidationError as e:
+                                    st.error(f"この写真は追加できません: {e}")
+                                except Exception as e:
+                                    st.error(f"思い出の保存中にエラーが発生しました: {e}")
+                                    import traceback
+                                    st.error(traceback.format_exc())
+                            else: st.warning("写真を選択してください。")
+
+                    # 思い出の一覧はビューモデルに読み込み済みのサムネイルで表示する
+                    # (未移行のBLOB行はビューモデルを作るときにファイルストアへ移している)
+                    past_memories = itinerary_view["memories"]
+                    if past_memories:
                         st.write("---")
-                else: st.info("このしおりにはまだ思い出が登録されていません。")
-
-        conn.close() # DB接続を閉じる
+                        st.write("**登録済みの思い出:**")
+                        for memory in past_memories:
+                            mem_id, mem_caption, mem_date = memory["id"], memory["caption"], memory["creation_date"]
+                            mem_photo_path, mem_display_path, mem_thumb_path = (
+                                memory["photo_path"], memory["display_path"], memory["thumb_path"])
+                            cols = st.columns([1, 3])
+                            zoom = False
+                            with cols[0]:
+                                try:
+                                    # サムネイルはキャッシュに持たず、表示の度にファイルから読む
+                                    if mem_thumb_path and os.path.exists(photo_abspath(mem_thumb_path)):
+                                        st.image(photo_abspath(mem_thumb_path), width=150)
+                                        # 拡大表示は開いたときだけ読み込む
+                                        zoom = st.toggle("拡大", key=f"zoom_mem_{mem_id}")
+                                    else: st.warning("画像がありません")
+                                except Exception as e: st.warning(f"画像表示エラー: {e}")
+                            with cols[1]:
+                                st.write(f"**{mem_date.split()[0]}**")
+                                st.write(mem_caption if mem_caption else "(キャプションなし)")
+                                if st.button("削除", key=f"delete_mem_{mem_id}"):
+                                    try:
+                                        with conn:
+                                            conn.execute("DELETE FROM memories WHERE id = ?", (mem_id,))
+                                        release_photo(conn, mem_photo_path, mem_thumb_path, mem_display_path)
+                                        st.success("思い出を削除しました。")
+                                        st.rerun()
+                                    except Exception as e: st.error(f"削除中にエラー: {e}")
+                            if zoom:
+                                # 拡大表示用が無い古い行は保存した写真をそのまま表示する
+                                st.image(photo_abspath(mem_display_path or mem_photo_path), use_container_width=True)
+                            st.write("---")
+                    else: st.info("このしおりにはまだ思い出が登録されていません。")
 
     except Exception as e:
         st.error(f"過去のしおりの読み込み中にエラーが発生しました: {e}")
         import traceback
-        st.error(traceback.format_exc())
\ No newline at end of file
+        st.error(traceback.format_exc())
+
+# --- 9. トレース (管理者用) ---
+elif menu_choice == "トレース (管理者用)" and is_admin:
+    import pandas as pd
+    st.header("トレース (管理者用)")
+
+    st.subheader("処理毎のレイテンシ")
+    span_stats = get_span_stats()
+    if span_stats:
+        st.dataframe(pd.DataFrame([
+            {"処理": name, "回数": stats["count"], "平均(ms)": stats["mean_ms"],
+             "p50(ms)": stats["p50_ms"], "p95(ms)": stats["p95_ms"], "p99(ms)": stats["p99_ms"]}
+            for name, stats in span_stats.items()
+        ]), hide_index=True)
+
+    st.subheader("生成ジョブ")
+    job_stats = get_generation_jobs().stats()
+    job_cols = st.columns(3)
+    job_cols[0].metric("実行待ち", job_stats["pending"])
+    job_cols[1].metric("実行中", job_stats["running"])
+    job_cols[2].metric("レート制限による停止(秒)", f"{job_stats['paused_seconds']:.0f}")
+
+    st.subheader("モデルの選択")
+    from okosy_models import MODEL_STATS_WINDOW, get_model_stats
+    st.caption(f"レイテンシ・エラー率は直近{MODEL_STATS_WINDOW:.0f}秒、件数は起動からの累計。"
+               "ストリーミングは最初のチャンクまで、それ以外は応答全体までの時間を別々に集計する")
+    model_stats = get_model_stats()
+    if not model_stats:
+        st.info("まだモデルの呼び出しがありません。")
+    else:
+        st.dataframe(pd.DataFrame([
+            {"フェーズ": stats["phase"], "計測": "最初のチャンク" if stats["stream"] else "応答全体",
+             "モデル": stats["model"], "優先順": stats["order"] + 1, "状態": stats["degraded"] or "正常",
+             "p50(ms)": stats["p50_ms"], "p95(ms)": stats["p95_ms"], "SLO(ms)": stats["slo_ms"],
+             "エラー率": f"{stats['error_rate'] * 100:.0f}%", "呼び出し": stats["calls"], "タイムアウト": stats["timeouts"],
+             "ヘッジ (勝ち / 送信)": f"{stats['hedge_wins']} / {stats['hedges']}", "フォールバック": stats["fallbacks"]}
+            for stats in model_stats
+        ]), hide_index=True)
+
+    st.subheader("Places検索")
+    from okosy_google import get_places_cache_stats
+    places_stats = get_places_cache_stats()
+    places_cols = st.columns(4)
+    places_cols[0].metric("API呼び出し", places_stats["api_calls"])
+    places_cols[1].metric("位置索引から応答", places_stats["local_hits"],
+                          help=f"未検索・記録が古い検索語: {places_stats['local_misses']}")
+    places_cols[2].metric("位置索引のヒット率", f"{places_stats['local_hit_ratio'] * 100:.0f}%")
+    places_cols[3].metric("位置索引の検索 p95(ms)", places_stats["local_latency"]["p95_ms"] or 0)
+
+    st.subheader("場所の詳細・写真のキャッシュ")
+    from okosy_media import get_media_cache_stats
+    media_stats = get_media_cache_stats()
+    media_cols = st.columns(4)
+    media_cols[0].metric("保存済みの場所", media_stats["entries"])
+    media_cols[1].metric("写真の容量(MB)", f"{media_stats['total_bytes'] / 1024 / 1024:.1f} / {media_stats['max_bytes'] / 1024 / 1024:.0f}")
+    media_cols[2].metric("先読み (取得 / 取得済み / 失敗)", f"{media_stats['fetched']} / {media_stats['fresh']} / {media_stats['failed']}")
+    media_cols[3].metric("容量超過による削除", media_stats["evicted"])
+
+    st.subheader("過去のしおりの表示用データのキャッシュ")
+    view_stats = get_view_cache_stats()
+    view_cols = st.columns(3)
+    view_cols[0].metric("キャッシュ中のしおり", f"{view_stats['size']} / {view_stats['maxsize']}")
+    view_cols[1].metric("ヒット率", f"{view_stats['hit_ratio'] * 100:.0f}%")
+    view_cols[2].metric("追い出し", view_stats["evictions"])
+
+    st.subheader("思い出の写真")
+    with db_connection() as conn:
+        photo_count, original_bytes, stored_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(original_bytes), 0), COALESCE(SUM(stored_bytes), 0) FROM memories WHERE original_bytes IS NOT NULL"
+        ).fetchone()
+    photo_cols = st.columns(3)
+    photo_cols[0].metric("縮小して保存した写真", photo_count)
+    photo_cols[1].metric("アップロード時の容量(MB)", f"{original_bytes / 1024 / 1024:.1f}")
+    photo_cols[2].metric("保存した容量(MB)", f"{stored_bytes / 1024 / 1024:.1f}",
+                         delta=f"{(stored_bytes - original_bytes) / 1024 / 1024:.1f}MB", delta_color="inverse")
+
+    st.subheader("バックアップ")
+    from okosy_archive import ARCHIVE_DIR, archive_download_parts, read_archive_part
+    st.caption("取り込みはサーバーで `python okosy_archive.py import <ファイル>` を実行してください。")
+    backup_cols = st.columns(2)
+    include_photos = backup_cols[1].checkbox("写真を含める", value=True)
+    if backup_cols[0].button("バックアップを作成"):
+        # 書き出しはジョブのワーカーで行う (リランされても途中で止まらない)
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        archive_name = f"okosy_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.tar.gz"
+        try:
+            st.session_state.archive_job_id = get_generation_jobs().submit_archive_export(
+                os.path.join(ARCHIVE_DIR, archive_name), include_photos=include_photos)
+        except JobQueueFullError as e:
+            st.warning(str(e))
+    archive_job = get_generation_jobs().get(st.session_state.archive_job_id) if st.session_state.archive_job_id else None
+    if archive_job and archive_job["status"] not in FINISHED_STATUSES:
+        backup_status_cols = st.columns([4, 1])
+        backup_status_cols[0].info(archive_job["progress"] or "バックアップの作成を待っています...")
+        backup_status_cols[1].button("状態を更新")
+    elif archive_job and archive_job["status"] == "succeeded":
+        archive_counts = json.loads(archive_job["result_content"])
+        st.success(f"バックアップを作成しました (しおり {archive_counts['itineraries']} 件 / 思い出 {archive_counts['memories']} 件)")
+    elif archive_job:
+        st.error(archive_job["error"] or "バックアップの作成に失敗しました。")
+    archive_names = sorted((name for name in os.listdir(ARCHIVE_DIR) if name.endswith((".tar", ".tar.gz", ".tgz")))
+                           if os.path.isdir(ARCHIVE_DIR) else [], reverse=True)
+    if archive_names:
+        archive_name = st.selectbox("作成済みのバックアップ", archive_names,
+                                    format_func=lambda name: f"{name} ({os.path.getsize(os.path.join(ARCHIVE_DIR, name)) / 1024 / 1024:.1f}MB)")
+        archive_path = os.path.join(ARCHIVE_DIR, archive_name)
+        # data に関数を渡し、押されたときにその部分だけを読み込む (リランの度にファイルを読まない)。
+        # 1回に読み込む大きさを抑えるため、大きなアーカイブは部分ファイルに分けて渡す
+        parts = archive_download_parts(archive_path)
+        if len(parts) > 1:
+            st.caption(f"{len(parts)} 個の部分ファイルに分かれています。全てダウンロードしてから "
+                       f"`cat {archive_name}.* > {archive_name}` (Windowsは `copy /b`) で結合してください。")
+        for index, (offset, length) in enumerate(parts, start=1):
+            part_name = archive_name if len(parts) == 1 else f"{archive_name}.{index:03d}"
+            st.download_button(f"ダウンロード: {part_name} ({length / 1024 / 1024:.1f}MB)",
+                               data=lambda offset=offset, length=length: read_archive_part(archive_path, offset, length),
+                               file_name=part_name, mime="application/gzip", on_click="ignore",
+                               key=f"archive_download_{archive_name}_{index}")
+
+    st.subheader("直近のリクエスト")
+    recent_traces = get_recent_traces()
+    if not recent_traces:
+        st.info("まだトレースがありません。")
+    else:
+        def trace_label(index):
+            trace = recent_traces[index]
+            started_at = datetime.datetime.fromtimestamp(trace["start_time"]).strftime("%H:%M:%S")
+            page = trace["spans"][0]["attributes"].get("page", "")
+            return f"{started_at} {page} {trace['duration_ms']:.0f}ms ({len(trace['spans'])} spans)"
+
+        trace_index = st.selectbox("トレース", range(len(recent_traces)), format_func=trace_label)
+        trace = recent_traces[trace_index]
+        # ウォーターフォール: 開始位置(リラン開始からの経過)と長さで各スパンを横棒で表示する
+        depths = {}
+        rows = []
+        for order, span_data in enumerate(sorted(trace["spans"], key=lambda s: s["start_time"])):
+            depth = depths.get(span_data["parent_id"], -1) + 1
+            depths[span_data["span_id"]] = depth
+            start_ms = (span_data["start_time"] - trace["start_time"]) * 1000
+            rows.append({
+                "順序": order, "処理": f"{order:03d} {'  ' * depth}{span_data['name']}",
+                "開始(ms)": round(start_ms, 1), "終了(ms)": round(start_ms + (span_data["duration_ms"] or 0), 1),
+                "所要(ms)": round(span_data["duration_ms"] or 0, 1),
+                "属性": json.dumps(span_data["attributes"], ensure_ascii=False, default=str),
+                "エラー": span_data["error"] or "",
+            })
+        spans_df = pd.DataFrame(rows)
+        import altair as alt
+        chart = alt.Chart(spans_df).mark_bar().encode(
+            x=alt.X("開始(ms):Q", title="リラン開始からの経過 (ms)"), x2="終了(ms):Q",
+            y=alt.Y("処理:N", sort=None, title=None),
+            color=alt.condition(alt.datum["エラー"] != "", alt.value("#d62728"), alt.value("#1f77b4")),
+            tooltip=["処理", "所要(ms)", "属性", "エラー"],
+        ).properties(height=max(120, 22 * len(rows)))
+        st.altair_chart(chart, use_container_width=True)
+        if trace["dropped_spans"]:
+            st.caption(f"スパン数の上限を超えたため {trace['dropped_spans']} 件は記録していません。")
+        st.dataframe(spans_df.drop(columns=["順序"]), hide_index=True)
+
+# --- 10. リランの所要時間 ---
+# OKOSY_SHOW_TIMINGS=1 のときはサイドバーに起動時・リラン毎の所要時間を表示する
+_rerun_elapsed_ms = (time.perf_counter() - _rerun_started_at) * 1000
+_timing_stats = get_timing_stats()
+_timing_stats["reruns"].append(_rerun_elapsed_ms)
+if os.getenv("OKOSY_SHOW_TIMINGS") == "1":
+    with st.sidebar.expander("パフォーマンス (起動・リラン時間)"):
+        for resource_name, resource_ms in _timing_stats["startup"].items():
+            st.write(f"起動時 {resource_name}: {resource_ms:.1f} ms")
+        rerun_samples = sorted(_timing_stats["reruns"])
+        st.write(f"このリラン: {_rerun_elapsed_ms:.1f} ms")
+        st.write(f"直近{len(rerun_samples)}回 中央値: {rerun_samples[len(rerun_samples) // 2]:.1f} ms / 最大: {rerun_samples[-1]:.1f} ms")
+
+end_trace(_rerun_trace)